@@ -1,5 +1,6 @@
 import React from 'react'
 import {Link} from 'react-router-dom'
+import {Button} from 'reactstrap'
 import requests from '../utils/requests'
 import {Loading, NotFound} from '../general/Errors'
 import PromptUpdate from '../general/PromptUpdate'
@@ -10,8 +11,10 @@ class Category extends React.Component {
     super(props)
     this.state = {
       events: null,
+      next: null,
     }
     this.cat_info = this.cat_info.bind(this)
+    this.more_events = this.more_events.bind(this)
     this.props.register(this.get_data.bind(this))
   }
 
@@ -20,7 +23,7 @@ class Category extends React.Component {
     if (!cat) {
       return
     }
-    this.setState({events: null})
+    this.setState({events: null, next: null})
     this.props.ctx.setRootState({
       page_title: cat.name,
       background: cat.image,
@@ -28,7 +31,16 @@ class Category extends React.Component {
     })
     try {
       const data = await requests.get(`cat/${this.props.match.params.category}/`)
-      this.setState({events: data.events})
+      this.setState({events: data.events, next: data.next})
+    } catch (error) {
+      this.props.ctx.setError(error)
+    }
+  }
+
+  async more_events () {
+    try {
+      const data = await requests.get(`cat/${this.props.match.params.category}/`, {after: this.state.next})
+      this.setState({events: [...this.state.events, ...data.events], next: data.next})
     } catch (error) {
       this.props.ctx.setError(error)
     }
@@ -64,6 +76,9 @@ class Category extends React.Component {
             ) : <Loading/>
           }
         </div>
+        {this.state.next && <div className="text-center my-4">
+          <Button color="primary" onClick={this.more_events}>More Events</Button>
+        </div>}
       </div>
     )
   }
@@ -1,6 +1,7 @@
 import React from 'react'
 import ReactGA from 'react-ga'
 import requests from '../utils/requests'
+import {sleep} from '../utils'
 import AsModal from '../general/Modal'
 import BookingLogin from './BookingLogin'
 import BookingTickets from './BookingTickets'
@@ -16,7 +17,8 @@ class BookForm extends React.Component {
       booking_info: null,
       reservation: null,
       submitting_reservation: false,
-      ticket_type: null
+      ticket_type: null,
+      admission_token: null
     }
     this.finished = this.finished.bind(this)
   }
@@ -98,8 +100,19 @@ class BookForm extends React.Component {
 
     let r
     try {
+      const admission_token = this.state.admission_token
       r = await requests.post(`events/${this.props.event.id}/reserve/`,
-          {tickets, ticket_type}, {expected_statuses: [200, 470]})
+          {tickets, ticket_type, admission_token}, {expected_statuses: [200, 429, 470]})
+      if (r._response_status === 429) {
+        if (r.waiting_room) {
+          // the event's waiting room is active, wait until we're admitted then try again
+          await this.wait_in_queue()
+        } else {
+          // the event is busy with other bookings, try again shortly
+          await sleep((r.retry_after || 1) * 1000)
+        }
+        return this.reserve(e)
+      }
     } catch (error) {
       this.props.ctx.setError(error)
       return
@@ -117,6 +130,25 @@ class BookForm extends React.Component {
     }
   }
 
+  async wait_in_queue () {
+    const event_id = this.props.event.id
+    let r = this.state.admission_token ? {token: this.state.admission_token} : {}
+    if (!r.token) {
+      r = await requests.post(`events/${event_id}/queue/join/`)
+      this.setState({admission_token: r.token})
+    }
+    const token = r.token
+    while (!r.admitted) {
+      if (r.ahead !== undefined) {
+        const people = r.ahead === 1 ? 'person' : 'people'
+        this.setState({reservation_error: `You're in the queue with ${r.ahead} ${people} ahead of you, please wait.`})
+      }
+      await sleep((r.retry_after || 1) * 1000)
+      r = await requests.get(`events/${event_id}/queue/`, {token})
+    }
+    this.setState({reservation_error: null})
+  }
+
   finished (complete) {
     if (complete) {
       this.props.set_complete()
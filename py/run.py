@@ -5,7 +5,6 @@ import logging.config
 import sys
 
 import uvloop
-from aiohttp import web
 from arq import RunWorkerProcess
 
 from shared.db import reset_database, run_patch
@@ -40,11 +39,9 @@ def main():
                 args.remove('--live')
             return run_patch(settings, live, args[0] if args else None)
         elif command == 'web':
-            logger.info('running web server...')
-            from web.main import create_app
+            from web.supervisor import start_web
 
-            app = create_app(settings=settings)
-            web.run_app(app, port=settings.port, shutdown_timeout=6, access_log=None, print=lambda *args: None)
+            start_web(settings, args)
         elif command == 'worker':
             logger.info('running worker...')
             RunWorkerProcess('shared/worker.py', 'Worker')
@@ -2,6 +2,7 @@ from arq import Actor, DatetimeJob
 from buildpg import asyncpg
 
 from .settings import Settings
+from .trace import TracingPool
 
 
 class BaseActor(Actor):
@@ -16,6 +17,8 @@ class BaseActor(Actor):
 
     async def startup(self):
         self.pg = self.pg or await asyncpg.create_pool_b(dsn=self.settings.pg_dsn, min_size=2)
+        if self.settings.sql_trace_threshold is not None:
+            self.pg = TracingPool(self.pg)
 
     async def shutdown(self):
         if self.client:
@@ -731,3 +731,88 @@ async def add_external_donations(conn, **kwargs):
     add the external_donation_url column to events
     """
     await conn.execute('ALTER TABLE events ADD COLUMN external_donation_url VARCHAR(255)')
+
+
+@patch
+async def add_event_category_listing_index(conn, **kwargs):
+    """
+    add the index used to list events in a category
+    """
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS event_category_listing ON events '
+        'USING btree (category, status, public, start_ts, id)'
+    )
+
+
+@patch
+async def add_tickets_taken_triggers(conn, settings, **kwargs):
+    """
+    add tickets.reservation_expired and the triggers which maintain events.tickets_taken, then recount tickets_taken
+    for all events
+    """
+    await conn.execute(
+        'ALTER TABLE tickets ADD COLUMN IF NOT EXISTS reservation_expired BOOLEAN NOT NULL DEFAULT FALSE'
+    )
+    await conn.execute(
+        """
+        UPDATE tickets SET reservation_expired=TRUE
+        WHERE status='reserved' AND created_ts <= now() - ($1 || ' seconds')::interval
+        """,
+        str(settings.ticket_ttl),
+    )
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS ticket_event_reserved ON tickets USING btree (event, created_ts) '
+        "WHERE status='reserved'"
+    )
+    await conn.execute(settings.logic_sql)
+    await conn.execute('SELECT recount_tickets_taken(id) FROM events')
+
+
+@patch
+async def add_ticket_status_created_ts_index(conn, **kwargs):
+    """
+    add the index used by ReservationsActor to find old reservations
+    """
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS ticket_status_created_ts ON tickets USING btree (status, created_ts)'
+    )
+
+
+@patch
+async def add_stripe_customer_verified_ts(conn, **kwargs):
+    """
+    add users.stripe_customer_verified_ts
+    """
+    await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_customer_verified_ts TIMESTAMPTZ')
+
+
+@patch
+async def add_stripe_events(conn, settings, **kwargs):
+    """
+    create stripe_events table and indexes
+    """
+    models_sql = settings.models_sql
+    m = re.search('-- { stripe-events(.*)-- } stripe-events', models_sql, flags=re.DOTALL)
+    stripe_events_sql = m.group(1).strip(' \n')
+    print('running stripe-events table sql...')
+    await conn.execute(stripe_events_sql)
+
+
+@patch
+async def add_booking_nowait(conn, settings, **kwargs):
+    """
+    add events.booking_nowait and update reserve_tickets to take an advisory lock on the event
+    """
+    await conn.execute('ALTER TABLE events ADD COLUMN IF NOT EXISTS booking_nowait BOOLEAN NOT NULL DEFAULT FALSE')
+    await conn.execute(settings.logic_sql)
+
+
+@patch
+async def add_waiting_room_rate(conn, **kwargs):
+    """
+    add events.waiting_room_rate, waiting rooms set before this was added need to be set again
+    """
+    await conn.execute(
+        'ALTER TABLE events ADD COLUMN IF NOT EXISTS waiting_room_rate INT '
+        'CONSTRAINT waiting_room_rate_gt_0 CHECK (waiting_room_rate > 0)'
+    )
@@ -0,0 +1,97 @@
+"""
+Optional counter in redis of the ticket slots available for each event, ReserveTickets decrements it first so
+requests for sold out events are rejected without touching postgres.
+
+Each event has a hash with the slots "available" and the slots used by each of its ticket types.
+
+Postgres is still what prevents overselling (via ticket_limit_check), the counter can drift, for example when
+reservations expire, so reconcile_inventory resets it from postgres regularly. Events without a counter in redis
+just skip the fast path.
+"""
+import logging
+from typing import Optional, Tuple
+
+logger = logging.getLogger('nosht.inventory')
+# counters expire if they're not reconciled, eg. if the worker isn't running
+INVENTORY_TTL = 300
+
+# returns nil if there's no counter for the event or ticket type (ARGV[1]), otherwise the slots needed for ARGV[2]
+# tickets and the slots remaining after taking them, which is negative and leaves the counter unchanged if there
+# weren't enough slots
+take_inventory_lua = """
+local slots_used = redis.call('hget', KEYS[1], 'tt:' .. ARGV[1])
+if not slots_used then
+  return nil
+end
+local slots = tonumber(slots_used) * tonumber(ARGV[2])
+local remaining = tonumber(redis.call('hget', KEYS[1], 'available')) - slots
+if remaining >= 0 then
+  redis.call('hincrby', KEYS[1], 'available', -slots)
+end
+return {slots, remaining}
+"""
+return_inventory_lua = """
+if redis.call('hexists', KEYS[1], 'available') == 1 then
+  return redis.call('hincrby', KEYS[1], 'available', ARGV[1])
+end
+"""
+inventory_events_sql = """
+SELECT
+  e.id,
+  e.ticket_limit - e.tickets_taken,
+  array_agg(tt.id),
+  array_agg(CASE WHEN tt.mode='ticket' THEN tt.slots_used ELSE 0 END)
+FROM events AS e
+JOIN ticket_types AS tt ON e.id = tt.event
+WHERE e.status='published' AND e.ticket_limit IS NOT NULL AND e.external_ticket_url IS NULL AND
+      e.start_ts > now() AND tt.active=TRUE
+GROUP BY e.id
+"""
+
+
+def inventory_key(event_id: int) -> str:
+    return f'inventory:{event_id}'
+
+
+async def take_inventory(redis, event_id: int, ticket_type_id: int, ticket_count: int) -> Optional[Tuple[int, int]]:
+    """
+    Take the slots required for ticket_count tickets from the event's counter if enough are available.
+
+    :return: None if the event or ticket type has no counter, otherwise a tuple of the slots required and the slots
+      remaining, negative if there weren't enough.
+    """
+    r = await redis.eval(take_inventory_lua, keys=[inventory_key(event_id)], args=[ticket_type_id, ticket_count])
+    return r and tuple(r)
+
+
+async def return_inventory(redis, event_id: int, slots: int) -> None:
+    """
+    Return slots to the event's counter, eg. when a reservation fails or tickets are cancelled.
+    """
+    if slots:
+        await redis.eval(return_inventory_lua, keys=[inventory_key(event_id)], args=[slots])
+
+
+async def clear_inventory(redis, event_id: int) -> None:
+    """
+    Remove the event's counter after changes to its ticket limit or ticket types, it's recreated by
+    reconcile_inventory.
+    """
+    await redis.delete(inventory_key(event_id))
+
+
+async def reconcile_inventory(conn, redis) -> int:
+    """
+    Set counters for all upcoming events with a ticket limit from events.tickets_taken.
+    """
+    events = await conn.fetch(inventory_events_sql)
+    if events:
+        tr = redis.multi_exec()
+        for event_id, available, ticket_type_ids, slots_used in events:
+            key = inventory_key(event_id)
+            tr.delete(key)
+            tr.hmset_dict(key, available=available, **{f'tt:{tt}': s for tt, s in zip(ticket_type_ids, slots_used)})
+            tr.expire(key, INVENTORY_TTL)
+        await tr.execute()
+    logger.info('inventory reconciled for %d events', len(events))
+    return len(events)
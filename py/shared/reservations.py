@@ -0,0 +1,70 @@
+"""
+Reserved tickets are expired and eventually deleted by the worker rather than by booking requests.
+"""
+import logging
+
+from arq import cron
+
+from .actor import BaseActor
+from .inventory import reconcile_inventory
+from .waiting_room import restore_waiting_rooms
+
+logger = logging.getLogger('nosht.reservations')
+# reserved tickets are deleted after a week, this allows time for webhooks to succeed even after the reservation
+# has "expired"
+RESERVATION_DELETE_AGE = 7 * 24 * 3600
+
+# the update_tickets_taken trigger updates tickets_taken of each event touched
+expire_reservations_sql = """
+UPDATE tickets SET reservation_expired=TRUE
+WHERE id IN (
+  SELECT id FROM tickets
+  WHERE status='reserved' AND created_ts <= now() - ($1 || ' seconds')::interval AND NOT reservation_expired
+  ORDER BY created_ts
+  LIMIT $2
+  FOR UPDATE SKIP LOCKED
+)
+"""
+delete_reservations_sql = """
+DELETE FROM tickets
+WHERE id IN (
+  SELECT id FROM tickets
+  WHERE status='reserved' AND created_ts <= now() - ($1 || ' seconds')::interval
+  ORDER BY created_ts
+  LIMIT $2
+  FOR UPDATE SKIP LOCKED
+)
+"""
+
+
+async def _run_in_batches(conn, sql: str, age: int, batch_size: int) -> int:
+    total = 0
+    while True:
+        v = await conn.execute(sql, str(age), batch_size)
+        count = int(v.split(' ')[-1])
+        total += count
+        if count < batch_size:
+            return total
+
+
+class ReservationsActor(BaseActor):
+    @cron(run_at_startup=True)  # every minute
+    async def reap_reservations(self):
+        """
+        Expire reservations older than ticket_ttl and delete those older than a week, in batches so neither
+        tickets nor events are locked for long, then reconcile redis inventory if it's enabled and restore waiting
+        rooms in redis.
+
+        :return: tuple of the number of reservations expired and deleted.
+        """
+        batch_size = self.settings.reservation_reap_batch
+        async with self.pg.acquire() as conn:
+            expired = await _run_in_batches(conn, expire_reservations_sql, self.settings.ticket_ttl, batch_size)
+            deleted = await _run_in_batches(conn, delete_reservations_sql, RESERVATION_DELETE_AGE, batch_size)
+            redis = await self.get_redis()
+            if self.settings.redis_inventory:
+                await reconcile_inventory(conn, redis)
+            await restore_waiting_rooms(conn, redis)
+        if expired or deleted:
+            logger.info('%d reservations expired, %d deleted', expired, deleted)
+        return expired, deleted
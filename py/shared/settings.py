@@ -18,7 +18,31 @@ class Settings(BaseSettings):
     auth_key = 'v7RI7qwZB7rxCyrpX4QwpZCUCF7X_HtnMSFuJfZTmfs='
     cookie_max_age = 25 * 3600
     cookie_update_age = 600
+    # in-process cache of decrypted session cookies
+    session_cache_size = 10000
+    # in-process cache of company domains and user companies used by user_middleware, domains are only cleared in
+    # the process which edited the company so they expire sooner
+    company_cache_size = 1000
+    company_cache_ttl = 300
+    domain_cache_ttl = 30
+    # the company part of the index response is cached in redis for this many seconds
+    index_cache_ttl = 300
+    # the public part of event_get responses is cached in redis for this many seconds
+    event_cache_ttl = 300
+    # in-process cache of event ids and signatures used by check_event_sig, kept short as it's only cleared
+    # in the process which modified the event
+    event_sig_cache_size = 10000
+    event_sig_cache_ttl = 30
+    # identical anonymous requests to public views share a response for this many seconds
+    single_flight_ttl: float = 1
+    single_flight_cache_size = 1000
+    # if set, postgres queries are traced and logged for requests and jobs which take longer than this many seconds
+    sql_trace_threshold: float = None
     port: int = 8000
+    # number of web server processes, each with its own postgres pool of up to pg_pool_max_size connections
+    web_workers: conint(ge=1) = 1
+    pg_pool_min_size = 2
+    pg_pool_max_size = 10
     on_docker: bool = False
     on_heroku: bool = False
     min_password_length: conint(gt=5) = 7
@@ -58,12 +82,21 @@ class Settings(BaseSettings):
     stripe_root_url = 'https://api.stripe.com/v1/'
     stripe_idempotency_extra = ''
     stripe_api_version = '2019-05-16'  # https://stripe.com/docs/upgrades
+    # stripe customers are only checked to still exist before creating payment intents this often
+    stripe_customer_verify_ttl = 24 * 3600
 
     default_email_address: str = 'Nosht <nosht@scolvin.com>'
 
     max_tickets = 20  # maximum number of tickets per purchase, needs to match MAX_TICKETS in BookingTickets.js
     ticket_ttl = 600
     ticket_reservation_precheck = True  # should only be set to false during a few specific tests
+    # keep a counter of available tickets for each event in redis so ReserveTickets can reject requests for sold out
+    # events without using postgres, see shared/inventory.py
+    redis_inventory = False
+    # queue tokens issued by event waiting rooms are valid for this many seconds, see web/waiting_room.py
+    waiting_room_token_ttl = 3600
+    # maximum number of reservations expired or deleted by each query of ReservationsActor.reap_reservations
+    reservation_reap_batch = 1000
 
     custom_static_dir: Path = None  # for tests only
 
@@ -105,6 +138,7 @@ class Settings(BaseSettings):
     class Config:
         fields = {
             'port': {'env': 'PORT'},
+            'web_workers': {'env': 'WEB_CONCURRENCY'},
             'pg_dsn': {'env': 'DATABASE_URL'},
             'redis_settings': {'env': 'REDISCLOUD_URL'},
         }
@@ -0,0 +1,121 @@
+"""
+sitemap.xml for each company is built by the worker and stored gzipped in redis so the web view can serve it
+without querying postgres.
+"""
+import gzip
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from arq import cron
+
+from .actor import BaseActor
+
+logger = logging.getLogger('nosht.sitemap')
+# sitemaps are rebuilt at least this often, so changes not recorded as event actions still show up eventually
+SITEMAP_TTL = 24 * 3600
+LAST_BUILD_KEY = 'sitemap-last-build'
+
+sitemap_events_sql = """
+SELECT cat.slug || '/', cat.slug || '/' || e.slug || '/', MAX(a.ts), e.highlight
+FROM actions as a
+JOIN events as e ON a.event = e.id
+JOIN categories AS cat ON e.category = cat.id
+WHERE
+  cat.company = $1 AND (a.type = 'create-event' OR a.type = 'edit-event') AND
+  cat.live = TRUE AND e.status = 'published' AND e.public = TRUE AND e.start_ts > now()
+GROUP BY cat.slug, e.slug, e.highlight
+"""
+# companies with events which have been created or edited, or which have started (and should therefore be removed
+# from the sitemap) since the last build
+changed_companies_sql = """
+SELECT company FROM actions
+WHERE ts > $1 AND (type = 'create-event' OR type = 'edit-event')
+UNION
+SELECT cat.company
+FROM events AS e
+JOIN categories AS cat ON e.category = cat.id
+WHERE e.start_ts > $1 AND e.start_ts <= now()
+"""
+
+
+def sitemap_cache_key(company_id: int) -> str:
+    return f'sitemap:{company_id}'
+
+
+def _url(domain: str, uri: str, last_mod: datetime, priority: float) -> str:
+    return (
+        f'<url>'
+        f'<loc>https://{domain}/{uri}</loc>'
+        f'<lastmod>{last_mod:%Y-%m-%d}</lastmod>'
+        f'<changefreq>daily</changefreq>'
+        f'<priority>{priority:0.1f}</priority>'
+        f'</url>\n'
+    )
+
+
+async def build_sitemap(conn, redis, company_id: int) -> Tuple[bytes, datetime]:
+    """
+    Build sitemap.xml for a company and store it gzipped in redis.
+
+    :return: tuple of the gzipped xml and when the sitemap was last modified, this is when it was built rather than
+      the latest event change as that can go backwards when events are unpublished.
+    """
+    built = datetime.now(timezone.utc)
+    domain = await conn.fetchval('SELECT domain FROM companies WHERE id=$1', company_id)
+    urls = []
+    cats = {}
+    for cat_uri, uri, latest_update, highlight in await conn.fetch(sitemap_events_sql, company_id):
+        cat_latest_update = cats.get(cat_uri)
+        if cat_latest_update is None or latest_update > cat_latest_update:
+            cats[cat_uri] = latest_update
+        urls.append(_url(domain, uri, latest_update, 0.7 if highlight else 0.5))
+
+    for cat_uri, latest_update in cats.items():
+        urls.append(_url(domain, cat_uri, latest_update, 0.9))
+
+    urls.append(_url(domain, '', max(cats.values()) if cats else built, 1))
+
+    xml = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    xml += ''.join(urls) + '</urlset>\n'
+    xml_gz = gzip.compress(xml.encode())
+    key = sitemap_cache_key(company_id)
+    await redis.hmset_dict(key, xml=xml_gz, last_modified=str(built.timestamp()))
+    await redis.expire(key, SITEMAP_TTL)
+    return xml_gz, built
+
+
+async def get_sitemap(conn, redis, company_id: int) -> Tuple[bytes, datetime]:
+    """
+    Get the gzipped sitemap.xml for a company and when it was last modified, it's built if it's not in redis.
+    """
+    xml_gz, last_modified = await redis.hmget(sitemap_cache_key(company_id), 'xml', 'last_modified')
+    if xml_gz is None or last_modified is None:
+        return await build_sitemap(conn, redis, company_id)
+    else:
+        return xml_gz, datetime.fromtimestamp(float(last_modified), timezone.utc)
+
+
+class SitemapActor(BaseActor):
+    @cron(minute=set(range(0, 60, 10)), run_at_startup=True)
+    async def build_sitemaps(self) -> int:
+        """
+        Rebuild sitemaps for companies where events have changed since the last build.
+        """
+        redis = await self.get_redis()
+        last_build: Optional[bytes] = await redis.get(LAST_BUILD_KEY)
+        async with self.pg.acquire() as conn:
+            build_start = await conn.fetchval('SELECT now()')
+            if last_build is None:
+                rows = await conn.fetch('SELECT id FROM companies')
+            else:
+                since = datetime.fromtimestamp(float(last_build), timezone.utc)
+                rows = await conn.fetch(changed_companies_sql, since)
+
+            company_ids = [r[0] for r in rows]
+            for company_id in company_ids:
+                await build_sitemap(conn, redis, company_id)
+
+        await redis.set(LAST_BUILD_KEY, str(build_start.timestamp()))
+        logger.info('%d sitemaps built', len(company_ids))
+        return len(company_ids)
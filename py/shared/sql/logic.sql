@@ -10,28 +10,200 @@ $$ LANGUAGE plpgsql;
 DROP TRIGGER IF EXISTS update_user_ts ON actions;
 CREATE TRIGGER update_user_ts AFTER INSERT ON actions FOR EACH ROW EXECUTE PROCEDURE update_user_ts();
 
-CREATE OR REPLACE FUNCTION check_tickets_remaining(event_id INT, ttl INT) RETURNS INT AS $$
+-- slots a ticket takes up in events.tickets_taken, reservations stop counting once they've expired
+CREATE OR REPLACE FUNCTION ticket_slots(ticket_type_id INT, status TICKET_STATUS, reservation_expired BOOLEAN)
+    RETURNS INT AS $$
   DECLARE
-    tickets_taken_ INT;
+    slots INT;
   BEGIN
-    -- delete reserved tickets after a week,
-    -- this allows time for webhooks to succeed even after the reservation has "expired"
-    DELETE FROM tickets
-    WHERE status='reserved' AND event=event_id AND now() - created_ts > '604800 seconds'::interval;
+    IF status = 'booked' OR (status = 'reserved' AND NOT reservation_expired) THEN
+      SELECT slots_used INTO slots FROM ticket_types WHERE id=ticket_type_id AND mode='ticket';
+    END IF;
+    return coalesce(slots, 0);
+  END;
+$$ LANGUAGE plpgsql;
 
-    SELECT coalesce(SUM(tt.slots_used), 0) INTO tickets_taken_
-    FROM tickets
-    JOIN ticket_types AS tt ON tickets.ticket_type=tt.id
-    WHERE tickets.event=event_id AND tt.mode='ticket' AND
-          (status='booked' or (status='reserved' and now() - created_ts < (ttl || ' seconds')::interval));
+-- keep events.tickets_taken up to date as tickets are created, change status, expire or are deleted,
+-- ticket_limit_check on events means this fails if too many tickets are taken
+CREATE OR REPLACE FUNCTION update_tickets_taken() RETURNS trigger AS $$
+  DECLARE
+    old_slots INT = 0;
+    new_slots INT = 0;
+  BEGIN
+    IF TG_OP = 'DELETE' OR TG_OP = 'UPDATE' THEN
+      old_slots := ticket_slots(OLD.ticket_type, OLD.status, OLD.reservation_expired);
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+      new_slots := ticket_slots(NEW.ticket_type, NEW.status, NEW.reservation_expired);
+    END IF;
 
-    UPDATE events SET tickets_taken=tickets_taken_ WHERE id=event_id;
+    IF TG_OP = 'UPDATE' AND OLD.event != NEW.event THEN
+      UPDATE events SET tickets_taken=tickets_taken - old_slots WHERE id=OLD.event AND old_slots != 0;
+      UPDATE events SET tickets_taken=tickets_taken + new_slots WHERE id=NEW.event AND new_slots != 0;
+    ELSIF new_slots != old_slots THEN
+      IF TG_OP = 'DELETE' THEN
+        UPDATE events SET tickets_taken=tickets_taken - old_slots WHERE id=OLD.event;
+      ELSE
+        UPDATE events SET tickets_taken=tickets_taken + new_slots - old_slots WHERE id=NEW.event;
+      END IF;
+    END IF;
+    return NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS update_tickets_taken ON tickets;
+CREATE TRIGGER update_tickets_taken
+  AFTER INSERT OR UPDATE OF status, reservation_expired, ticket_type, event OR DELETE ON tickets
+  FOR EACH ROW EXECUTE PROCEDURE update_tickets_taken();
+
+-- recalculate events.tickets_taken from scratch, used when ticket types change and when patching
+CREATE OR REPLACE FUNCTION recount_tickets_taken(event_id INT) RETURNS VOID AS $$
+  BEGIN
+    UPDATE events SET tickets_taken=(
+      SELECT coalesce(SUM(tt.slots_used), 0)
+      FROM tickets
+      JOIN ticket_types AS tt ON tickets.ticket_type=tt.id
+      WHERE tickets.event=event_id AND tt.mode='ticket' AND
+            (tickets.status='booked' OR (tickets.status='reserved' AND NOT tickets.reservation_expired))
+    )
+    WHERE id=event_id;
+  END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_ticket_type_slots() RETURNS trigger AS $$
+  BEGIN
+    PERFORM recount_tickets_taken(NEW.event);
+    return NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS update_ticket_type_slots ON ticket_types;
+CREATE TRIGGER update_ticket_type_slots AFTER UPDATE OF slots_used, mode ON ticket_types
+  FOR EACH ROW WHEN (OLD.slots_used IS DISTINCT FROM NEW.slots_used OR OLD.mode IS DISTINCT FROM NEW.mode)
+  EXECUTE PROCEDURE update_ticket_type_slots();
+
+CREATE OR REPLACE FUNCTION check_tickets_remaining(event_id INT, ttl INT) RETURNS INT AS $$
+  BEGIN
+    -- reservations older than ttl no longer count towards tickets_taken, the update_tickets_taken trigger
+    -- updates the event. ReservationsActor does the same for all events and deletes old reservations, this
+    -- just means reservations which have only just expired are released immediately.
+    UPDATE tickets SET reservation_expired=TRUE
+    WHERE event=event_id AND status='reserved' AND NOT reservation_expired AND
+          created_ts <= now() - (ttl || ' seconds')::interval;
 
     return (SELECT ticket_limit - tickets_taken FROM events WHERE id=event_id);
   END;
 $$ LANGUAGE plpgsql;
 
 
+-- like check_tickets_remaining but read only, reservations older than ttl which haven't yet been marked as expired
+-- are added back on, used by booking_info
+CREATE OR REPLACE FUNCTION tickets_remaining(event_id INT, ttl INT) RETURNS INT AS $$
+  SELECT e.ticket_limit - e.tickets_taken + coalesce((
+    SELECT sum(ticket_slots(t.ticket_type, t.status, t.reservation_expired))
+    FROM tickets AS t
+    WHERE t.event=event_id AND t.status='reserved' AND NOT t.reservation_expired AND
+          t.created_ts <= now() - (ttl || ' seconds')::interval
+  ), 0)::INT
+  FROM events AS e
+  WHERE e.id=event_id
+$$ LANGUAGE sql STABLE;
+
+
+-- reserve tickets in one round trip, used by ReserveTickets. If the reservation isn't possible error_code is set,
+-- the ticket_limit_check constraint is what finally prevents too many tickets being reserved.
+-- Reservations for the same event are serialized with an advisory lock on the event id taken before the precheck,
+-- lock_wait is the time in seconds spent waiting for it. For events with booking_nowait set the lock isn't waited
+-- for and error_code is "event-busy" if it's held.
+-- dropped first as the OUT parameters have changed
+DROP FUNCTION IF EXISTS reserve_tickets(
+  INT, INT, INT, INT, INT, BOOLEAN, BOOLEAN, BOOLEAN, JSONB, VARCHAR(255)[], VARCHAR(255)[], VARCHAR(255)[], TEXT[]
+);
+CREATE OR REPLACE FUNCTION reserve_tickets(
+    company_id_ INT, user_id_ INT, event_id_ INT, ticket_type_id_ INT, ttl INT, precheck BOOLEAN,
+    cover_costs BOOLEAN, allow_marketing_ BOOLEAN, action_extra JSONB,
+    emails VARCHAR(255)[], first_names VARCHAR(255)[], last_names VARCHAR(255)[], extra_infos TEXT[],
+    OUT error_code VARCHAR(63), OUT event_name VARCHAR(150), OUT reserve_action_id INT,
+    OUT item_price NUMERIC(7, 2), OUT item_extra_donated NUMERIC, OUT tickets_remaining INT,
+    OUT update_user_preferences BOOLEAN, OUT lock_wait FLOAT
+  ) AS $$
+  DECLARE
+    status_ EVENT_STATUS;
+    external_ticket_url_ VARCHAR(255);
+    cover_costs_percentage_ NUMERIC(5, 2);
+    booking_nowait_ BOOLEAN;
+    lock_start_ TIMESTAMPTZ;
+  BEGIN
+    SELECT e.status, e.external_ticket_url, e.name, c.cover_costs_percentage, e.booking_nowait
+    INTO status_, external_ticket_url_, event_name, cover_costs_percentage_, booking_nowait_
+    FROM events AS e
+    JOIN categories c on e.category = c.id
+    WHERE c.company=company_id_ AND e.id=event_id_;
+
+    IF NOT FOUND THEN
+      error_code := 'event-not-found';
+      RETURN;
+    ELSIF status_ != 'published' THEN
+      error_code := 'event-not-published';
+      RETURN;
+    ELSIF external_ticket_url_ IS NOT NULL THEN
+      error_code := 'external-ticketing';
+      RETURN;
+    END IF;
+
+    SELECT price INTO item_price FROM ticket_types WHERE event=event_id_ AND active=TRUE AND id=ticket_type_id_;
+    IF NOT FOUND THEN
+      error_code := 'ticket-type-not-found';
+      RETURN;
+    END IF;
+
+    lock_start_ := clock_timestamp();
+    IF booking_nowait_ THEN
+      IF NOT pg_try_advisory_xact_lock(event_id_) THEN
+        error_code := 'event-busy';
+        RETURN;
+      END IF;
+    ELSE
+      PERFORM pg_advisory_xact_lock(event_id_);
+    END IF;
+    lock_wait := extract(epoch FROM clock_timestamp() - lock_start_);
+
+    IF precheck THEN
+      tickets_remaining := check_tickets_remaining(event_id_, ttl);
+      IF tickets_remaining IS NOT NULL AND array_length(emails, 1) > tickets_remaining THEN
+        error_code := 'tickets-remaining';
+        RETURN;
+      END IF;
+    END IF;
+
+    IF coalesce(item_price, 0) > 0 AND coalesce(cover_costs_percentage_, 0) > 0 AND cover_costs THEN
+      item_extra_donated := item_price * cover_costs_percentage_ / 100;
+    END IF;
+
+    INSERT INTO users (company, role, email)
+    SELECT company_id_, 'guest'::USER_ROLE, lower(email) FROM unnest(emails) AS email WHERE email IS NOT NULL
+    ON CONFLICT (company, email) DO NOTHING;
+
+    update_user_preferences := allow_marketing_ IS NOT NULL AND
+                               coalesce(emails[1] = (SELECT email FROM users WHERE id=user_id_), FALSE);
+    IF update_user_preferences THEN
+      UPDATE users SET allow_marketing=allow_marketing_ WHERE id=user_id_;
+    END IF;
+
+    INSERT INTO actions (company, user_id, event, type, extra)
+    VALUES (company_id_, user_id_, event_id_, 'reserve-tickets', action_extra)
+    RETURNING id INTO reserve_action_id;
+
+    INSERT INTO tickets (event, reserve_action, ticket_type, price, extra_donated, user_id,
+                         first_name, last_name, extra_info)
+    SELECT event_id_, reserve_action_id, ticket_type_id_, item_price, item_extra_donated, u.id,
+           v.first_name, v.last_name, v.extra_info
+    FROM unnest(emails, first_names, last_names, extra_infos) AS v (email, first_name, last_name, extra_info)
+    LEFT JOIN users AS u ON lower(v.email)=u.email AND u.company=company_id_;
+  END;
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION full_name(first_name VARCHAR(255), last_name VARCHAR(255),
     email VARCHAR(255) DEFAULT NULL) RETURNS VARCHAR(255) AS $$
   DECLARE
@@ -35,6 +35,7 @@ CREATE TABLE users (
   phone_number VARCHAR(63),
   password_hash VARCHAR(63),
   stripe_customer_id VARCHAR(31),
+  stripe_customer_verified_ts TIMESTAMPTZ,  -- when stripe_customer_id was last known to exist
   receive_emails BOOLEAN DEFAULT TRUE,
   allow_marketing BOOLEAN DEFAULT FALSE,
   created_ts TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
@@ -109,6 +110,8 @@ CREATE TABLE events (
   ticket_limit INT CONSTRAINT ticket_limit_gt_0 CHECK (ticket_limit > 0),
   donation_target NUMERIC(10, 2) CONSTRAINT donation_target_gte_1 CHECK (donation_target > 0),
   tickets_taken INT NOT NULL DEFAULT 0,  -- sold and reserved
+  booking_nowait BOOLEAN NOT NULL DEFAULT FALSE,  -- reservations fail rather than wait for others, see reserve_tickets
+  waiting_room_rate INT CONSTRAINT waiting_room_rate_gt_0 CHECK (waiting_room_rate > 0),  -- see waiting_room.py
   image VARCHAR(255),
   secondary_image VARCHAR(255),
   CONSTRAINT ticket_limit_check CHECK (tickets_taken <= ticket_limit)
@@ -120,6 +123,7 @@ CREATE INDEX event_public ON events USING btree (public);
 CREATE INDEX event_highlight ON events USING btree (highlight);
 CREATE INDEX event_start_ts ON events USING btree (start_ts);
 CREATE INDEX event_category ON events USING btree (category);
+CREATE INDEX event_category_listing ON events USING btree (category, status, public, start_ts, id);
 
 
 CREATE TYPE ACTION_TYPES AS ENUM (
@@ -192,13 +196,18 @@ CREATE TABLE tickets (
   cancel_action INT REFERENCES actions ON DELETE SET NULL,
   status TICKET_STATUS NOT NULL DEFAULT 'reserved',
   created_ts TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  -- set by check_tickets_remaining once a reservation is older than ticket_ttl, it then stops counting towards
+  -- events.tickets_taken
+  reservation_expired BOOLEAN NOT NULL DEFAULT FALSE,
   extra_info TEXT
 );
 CREATE INDEX ticket_event ON tickets USING btree (event);
+CREATE INDEX ticket_event_reserved ON tickets USING btree (event, created_ts) WHERE status='reserved';
 CREATE INDEX ticket_user ON tickets USING btree (user_id);
 CREATE INDEX ticket_reserve_action ON tickets USING btree (reserve_action);
 CREATE INDEX ticket_status ON tickets USING btree (status);
 CREATE INDEX ticket_created_ts ON tickets USING btree (created_ts);
+CREATE INDEX ticket_status_created_ts ON tickets USING btree (status, created_ts);
 
 -- must match triggers from emails/defaults.py!
 CREATE TYPE EMAIL_TRIGGERS AS ENUM (
@@ -322,3 +331,19 @@ CREATE TABLE IF NOT EXISTS waiting_list (
 );
 CREATE UNIQUE INDEX IF NOT EXISTS waiting_list_event_users ON waiting_list USING btree (event, user_id);
 -- } waiting-list
+
+-- { stripe-events
+CREATE TABLE IF NOT EXISTS stripe_events (
+  id SERIAL PRIMARY KEY,
+  stripe_id VARCHAR(255) NOT NULL UNIQUE,
+  company INT NOT NULL REFERENCES companies ON DELETE CASCADE,
+  event INT NOT NULL,  -- not a foreign key as it comes from the webhook's metadata
+  payload JSONB NOT NULL,
+  received_ts TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  processed_ts TIMESTAMPTZ,
+  attempts SMALLINT NOT NULL DEFAULT 0,
+  result VARCHAR(255)
+);
+CREATE INDEX IF NOT EXISTS stripe_event_event ON stripe_events USING btree (event) WHERE processed_ts IS NULL;
+CREATE INDEX IF NOT EXISTS stripe_event_processed_ts ON stripe_events USING btree (processed_ts);
+-- } stripe-events
@@ -0,0 +1,272 @@
+"""
+Stripe webhooks are saved to stripe_events by the stripe-webhook view and acknowledged immediately,
+StripeEventsActor then completes the purchase or donation.
+
+Events are deduplicated on stripe's event id, events for the same nosht event are processed one at a time in the
+order they were received and events which fail are retried by a cron job.
+"""
+import json
+import logging
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout
+from arq import concurrent, cron
+from buildpg import Values
+from buildpg.asyncpg import BuildPgConnection, CheckViolationError
+from pydantic import BaseModel
+
+from .actions import ActionTypes
+from .actor import BaseActor
+from .donorfy import DonorfyActor
+from .emails import EmailActor
+from .settings import Settings
+
+logger = logging.getLogger('nosht.stripe_events')
+# events which fail are retried until they've been attempted this many times, later events for the same nosht event
+# wait until then
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+# processed events are kept this long so retries from stripe are still deduplicated
+STRIPE_EVENT_DELETE_AGE = 30 * 24 * 3600
+# first key of the advisory lock held while processing a nosht event's stripe events, the second is the event id
+STRIPE_EVENTS_LOCK = 1
+
+next_event_sql = """
+SELECT id, company, payload FROM stripe_events
+WHERE event=$1 AND processed_ts IS NULL AND attempts < $2
+ORDER BY id
+LIMIT 1
+FOR UPDATE
+"""
+retry_events_sql = """
+SELECT DISTINCT event FROM stripe_events
+WHERE processed_ts IS NULL AND attempts < $1 AND received_ts < now() - '60 seconds'::interval
+"""
+
+
+class MetadataPurpose(str, Enum):
+    buy_tickets = 'buy-tickets'
+    donate = 'donate'
+    donate_direct = 'donate-direct'
+
+
+class MetadataModel(BaseModel):
+    purpose: MetadataPurpose
+    user_id: int
+    event_id: int
+    reserve_action_id: int
+
+
+class StripeEventError(RuntimeError):
+    """
+    The event can't be processed and shouldn't be retried.
+    """
+
+
+class StripeEventsActor(BaseActor):
+    def __init__(self, *, email_actor: EmailActor = None, donorfy_actor: DonorfyActor = None, **kwargs):
+        super().__init__(**kwargs)
+        self.email_actor = email_actor
+        self.donorfy_actor = donorfy_actor
+
+    async def startup(self):
+        await super().startup()
+        if not self.email_actor:
+            # in the worker these are only used to enqueue jobs
+            redis = await self.get_redis()
+            self.client = ClientSession(timeout=ClientTimeout(total=10), loop=self.loop)
+            self.email_actor = EmailActor(settings=self.settings, existing_redis=redis, http_client=self.client)
+            self.donorfy_actor = DonorfyActor(settings=self.settings, existing_redis=redis)
+
+    @concurrent
+    async def process_events(self, event_id: int):
+        """
+        Process outstanding stripe events for a nosht event.
+        """
+        async with self.pg.acquire() as conn:
+            return await self._process_events(conn, event_id)
+
+    @cron(run_at_startup=True)  # every minute
+    async def retry_events(self):
+        """
+        Retry stripe events which failed or weren't processed, and delete old processed events.
+        """
+        async with self.pg.acquire() as conn:
+            event_ids = await conn.fetch(retry_events_sql, STRIPE_EVENT_MAX_ATTEMPTS)
+            for (event_id,) in event_ids:
+                await self._process_events(conn, event_id)
+            await conn.execute(
+                "DELETE FROM stripe_events WHERE processed_ts < now() - ($1 || ' seconds')::interval",
+                str(STRIPE_EVENT_DELETE_AGE),
+            )
+
+    async def _process_events(self, conn, event_id: int) -> int:
+        processed = 0
+        while True:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1, $2)', STRIPE_EVENTS_LOCK, event_id)
+                r = await conn.fetchrow(next_event_sql, event_id, STRIPE_EVENT_MAX_ATTEMPTS)
+                if not r:
+                    return processed
+                stripe_event_id, company_id, payload = r
+                result = purpose = action_id = None
+                try:
+                    async with conn.transaction():
+                        purpose, action_id = await process_event(conn, self.settings, company_id, json.loads(payload))
+                except StripeEventError as e:
+                    result = str(e)
+                except Exception as e:
+                    # the outer transaction is still usable, so the failure is recorded, later events for the same
+                    # nosht event wait until this one is retried by retry_events so they're still processed in order
+                    logger.exception('error processing stripe event %d', stripe_event_id)
+                    await conn.execute(
+                        'UPDATE stripe_events SET attempts=attempts + 1, result=$2 WHERE id=$1',
+                        stripe_event_id,
+                        repr(e)[:255],
+                    )
+                    return processed
+                await conn.execute(
+                    'UPDATE stripe_events SET attempts=attempts + 1, processed_ts=now(), result=$2 WHERE id=$1',
+                    stripe_event_id,
+                    result,
+                )
+            processed += 1
+            if purpose == MetadataPurpose.buy_tickets:
+                await self.donorfy_actor.tickets_booked(action_id)
+                await self.email_actor.send_event_conf(action_id)
+            elif purpose:
+                await self.donorfy_actor.donation(action_id)
+                await self.email_actor.send_donation_thanks(action_id)
+
+
+async def process_event(
+    conn: BuildPgConnection, settings: Settings, company_id: int, webhook: dict
+) -> Tuple[MetadataPurpose, Optional[int]]:
+    """
+    Complete the purchase or donation for a "payment_intent.succeeded" webhook.
+
+    :return: tuple of the webhook's purpose and the id of the buy-tickets or donate action created.
+    """
+    data = webhook['data']['object']
+    metadata = MetadataModel(**data['metadata'])
+    charge = data['charges']['data'][0]
+    card = charge['payment_method_details']['card']
+    action_extra = json.dumps(
+        {
+            'charge_id': charge['id'],
+            'stripe_balance_transaction': charge['balance_transaction'],
+            'brand': card['brand'],
+            'card_last4': card['last4'],
+            'card_expiry': f"{card['exp_month']}/{card['exp_year'] - 2000}",
+            '3DS': card['three_d_secure'],
+            'payment_metadata': metadata.dict(),
+        }
+    )
+
+    if metadata.purpose == MetadataPurpose.buy_tickets:
+        try:
+            action_id = await _complete_purchase(conn, settings, metadata, webhook, company_id, action_extra)
+        except CheckViolationError as e:
+            if 'violates check constraint "ticket_limit_check"' in str(e):
+                raise StripeEventError('ticket limit exceeded') from e
+            else:  # pragma: no cover
+                raise
+    else:
+        action_id = await _complete_donation(conn, metadata, webhook, company_id, action_extra)
+    return metadata.purpose, action_id
+
+
+async def _complete_purchase(
+    conn: BuildPgConnection,
+    settings: Settings,
+    metadata: MetadataModel,
+    webhook: dict,
+    company_id: int,
+    action_extra: str,
+) -> int:
+    r = await conn.fetchrow(
+        'select status, created_ts from tickets where reserve_action=$1 for update', metadata.reserve_action_id
+    )
+    if not r:
+        logger.warning('ticket %s not found', metadata.reserve_action_id, extra={'webhook': webhook})
+        raise StripeEventError('ticket not found')
+    ticket_status, ticket_created = r
+    if ticket_status != 'reserved':
+        logger.warning('ticket not in reserved state %r', ticket_status, extra={'webhook': webhook})
+        raise StripeEventError('ticket not reserved')
+
+    charge_created = datetime.fromtimestamp(webhook['data']['object']['charges']['data'][0]['created'], timezone.utc)
+    payment_delay = (charge_created - ticket_created).total_seconds()
+    if payment_delay > settings.ticket_ttl:
+        logger.warning('ticket bought too late: %0.2fs', payment_delay, extra={'webhook': webhook})
+        raise StripeEventError('ticket bought too late')
+
+    action_id = await conn.fetchval_b(
+        'INSERT INTO actions (:values__names) VALUES :values RETURNING id',
+        values=Values(
+            company=company_id,
+            user_id=metadata.user_id,
+            type=ActionTypes.buy_tickets,
+            event=metadata.event_id,
+            extra=action_extra,
+        ),
+    )
+    await conn.execute(
+        "UPDATE tickets SET status='booked', booked_action=$1 WHERE reserve_action=$2",
+        action_id,
+        metadata.reserve_action_id,
+    )
+    await conn.execute('delete from waiting_list where event=$1 and user_id=$2', metadata.event_id, metadata.user_id)
+    return action_id
+
+
+async def _complete_donation(
+    conn: BuildPgConnection, metadata: MetadataModel, webhook: dict, company_id: int, action_extra: str
+) -> int:
+    amount_cents = webhook['data']['object']['amount']
+
+    r = await conn.fetchrow(
+        """
+        select extra->'gift_aid', extra->>'donation_option_id', extra->>'ticket_type_id', extra->>'complete'
+        from actions where id=$1
+        for update
+        """,
+        metadata.reserve_action_id,
+    )
+    if not r:
+        logger.warning('no action found for action %s', metadata.reserve_action_id, extra={'webhook': webhook})
+        raise StripeEventError('action not found')
+
+    gift_aid_info, donation_option_id, ticket_type_id, complete = r
+    if complete:
+        logger.warning(
+            'donation already performed with action %s', metadata.reserve_action_id, extra={'webhook': webhook}
+        )
+        raise StripeEventError('donation already performed')
+
+    action_id = await conn.fetchval_b(
+        'INSERT INTO actions (:values__names) VALUES :values RETURNING id',
+        values=Values(
+            company=company_id,
+            user_id=metadata.user_id,
+            type=ActionTypes.donate,
+            event=metadata.event_id,
+            extra=action_extra,
+        ),
+    )
+    gift_aid = bool(gift_aid_info)
+    don_values = dict(amount=amount_cents / 100, gift_aid=gift_aid, action=action_id)
+    if donation_option_id:
+        don_values['donation_option'] = int(donation_option_id)
+    else:
+        don_values['ticket_type'] = int(ticket_type_id)
+
+    if gift_aid:
+        don_values.update(json.loads(gift_aid_info))
+    await conn.fetchval_b('INSERT INTO donations (:values__names) VALUES :values', values=Values(**don_values))
+
+    await conn.execute(
+        """update actions set extra=extra || '{"complete": true}' where id=$1""", metadata.reserve_action_id,
+    )
+    return action_id
@@ -0,0 +1,176 @@
+"""
+Opt-in tracing of postgres queries, enabled by setting "sql_trace_threshold".
+
+Queries are recorded per request (see LazyConnection in web/middleware.py) or per arq job (see Worker.run_job),
+when a request or job takes longer than the threshold the full waterfall of queries is logged.
+"""
+import asyncio
+import logging
+import re
+from time import time
+from typing import List, NamedTuple, Optional
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger('nosht.trace')
+WHITESPACE = re.compile(r'\s+')
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+_task_traces = WeakKeyDictionary()
+
+
+def normalize_sql(sql: str, max_length=200) -> str:
+    sql = WHITESPACE.sub(' ', sql).strip(' ')
+    if len(sql) > max_length:
+        sql = sql[: max_length - 1] + '…'
+    return sql
+
+
+def row_count(method: str, result) -> Optional[int]:
+    if method.startswith(('fetchval', 'fetchrow')):
+        return int(result is not None)
+    elif method.startswith('fetch'):
+        return len(result)
+    elif isinstance(result, str):
+        # execute returns the status, eg. "UPDATE 3" or "INSERT 0 1"
+        count = result.rsplit(' ', 1)[-1]
+        if count.isdigit():
+            return int(count)
+
+
+class TracedQuery(NamedTuple):
+    method: str
+    sql: str
+    start: float
+    duration: float
+    rows: Optional[int]
+
+
+class QueryTrace:
+    __slots__ = 'start', 'queries'
+
+    def __init__(self):
+        self.start = time()
+        self.queries: List[TracedQuery] = []
+
+    async def run(self, conn, method: str, sql: str, *args, **kwargs):
+        start = time()
+        result = None
+        try:
+            result = await getattr(conn, method)(sql, *args, **kwargs)
+            return result
+        finally:
+            self.queries.append(
+                TracedQuery(
+                    method=method,
+                    sql=normalize_sql(sql),
+                    start=start - self.start,
+                    duration=time() - start,
+                    rows=row_count(method, result),
+                )
+            )
+
+    def log_if_slow(self, name: str, threshold: float):
+        duration = time() - self.start
+        if duration < threshold:
+            return
+        query_time = sum(q.duration for q in self.queries)
+        waterfall = '\n'.join(
+            f'{q.start * 1000:8.2f}ms {q.duration * 1000:8.2f}ms {"-" if q.rows is None else q.rows:>6} '
+            f'{q.method:10} {q.sql}'
+            for q in self.queries
+        )
+        logger.warning(
+            '%s slow: %0.2fms, %d queries taking %0.2fms\n%s',
+            name,
+            duration * 1000,
+            len(self.queries),
+            query_time * 1000,
+            waterfall,
+            extra={
+                'fingerprint': ['slow', name],
+                'data': {
+                    'duration': duration,
+                    'query_time': query_time,
+                    'queries': [q._asdict() for q in self.queries],
+                },
+            },
+        )
+
+
+def start_task_trace() -> QueryTrace:
+    """
+    Start a trace which TracingPool will record queries from the current task into.
+    """
+    trace = QueryTrace()
+    _task_traces[_current_task()] = trace
+    return trace
+
+
+async def _traced_query(target, method, sql, *args, **kwargs):
+    task = _current_task()
+    trace = task and _task_traces.get(task)
+    if trace is None:
+        return await getattr(target, method)(sql, *args, **kwargs)
+    else:
+        return await trace.run(target, method, sql, *args, **kwargs)
+
+
+class _TracingMethods:
+    __slots__ = ('_target',)
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, item):
+        return getattr(self._target, item)
+
+    async def execute(self, *args, **kwargs):
+        return await _traced_query(self._target, 'execute', *args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetch', *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetchval', *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetchrow', *args, **kwargs)
+
+    async def execute_b(self, *args, **kwargs):
+        return await _traced_query(self._target, 'execute_b', *args, **kwargs)
+
+    async def fetch_b(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetch_b', *args, **kwargs)
+
+    async def fetchval_b(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetchval_b', *args, **kwargs)
+
+    async def fetchrow_b(self, *args, **kwargs):
+        return await _traced_query(self._target, 'fetchrow_b', *args, **kwargs)
+
+
+class TracingConnection(_TracingMethods):
+    __slots__ = ()
+
+
+class _TracingAcquire:
+    __slots__ = ('_acquire_cm',)
+
+    def __init__(self, acquire_cm):
+        self._acquire_cm = acquire_cm
+
+    async def __aenter__(self):
+        return TracingConnection(await self._acquire_cm.__aenter__())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self._acquire_cm.__aexit__(exc_type, exc_val, exc_tb)
+
+
+class TracingPool(_TracingMethods):
+    """
+    Wraps a pool so queries made by the current task are recorded in the trace started by start_task_trace.
+    """
+
+    __slots__ = ()
+
+    def acquire(self):
+        return _TracingAcquire(self._target.acquire())
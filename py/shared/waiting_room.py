@@ -0,0 +1,52 @@
+"""
+Redis state of event waiting rooms, see web/waiting_room.py for joining the queue and admitting guests.
+
+events.waiting_room_rate is the source of truth, the rate is copied to redis where the queue and token bucket are
+kept. ReservationsActor restores the rate from postgres in case the redis key is lost.
+"""
+import logging
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger('nosht.waiting_room')
+# waiting rooms are removed from redis this long after the event starts
+WAITING_ROOM_TTL = 24 * 3600
+
+waiting_rooms_sql = """
+SELECT id, waiting_room_rate, start_ts FROM events
+WHERE waiting_room_rate IS NOT NULL AND start_ts > now() - ($1 || ' seconds')::interval
+"""
+
+
+def waiting_room_key(event_id: int) -> str:
+    return f'waiting-room:{event_id}'
+
+
+async def set_waiting_room(redis, event_id: int, rate: Optional[int], start_ts: datetime) -> None:
+    """
+    Activate the waiting room for an event admitting "rate" guests per second, or remove it if rate is None.
+    """
+    key = waiting_room_key(event_id)
+    if rate is None:
+        await redis.delete(key)
+    else:
+        tr = redis.multi_exec()
+        tr.hset(key, 'rate', rate)
+        tr.expireat(key, int(start_ts.timestamp()) + WAITING_ROOM_TTL)
+        await tr.execute()
+
+
+async def restore_waiting_rooms(conn, redis) -> int:
+    """
+    Set the rate in redis for all events with a waiting room, the queue and admissions are kept if the key exists.
+    """
+    events = await conn.fetch(waiting_rooms_sql, str(WAITING_ROOM_TTL))
+    if events:
+        tr = redis.multi_exec()
+        for event_id, rate, start_ts in events:
+            key = waiting_room_key(event_id)
+            tr.hset(key, 'rate', rate)
+            tr.expireat(key, int(start_ts.timestamp()) + WAITING_ROOM_TTL)
+        await tr.execute()
+    logger.info('waiting rooms restored for %d events', len(events))
+    return len(events)
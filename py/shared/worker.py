@@ -3,12 +3,16 @@ from arq import BaseWorker, DatetimeJob
 
 from .donorfy import DonorfyActor
 from .emails import EmailActor
+from .reservations import ReservationsActor
 from .settings import Settings
+from .sitemap import SitemapActor
+from .stripe_events import StripeEventsActor
+from .trace import start_task_trace
 
 
 class Worker(BaseWorker):
     job_class = DatetimeJob
-    shadows = [DonorfyActor, EmailActor]
+    shadows = [DonorfyActor, EmailActor, ReservationsActor, SitemapActor, StripeEventsActor]
 
     def __init__(self, **kwargs):  # pragma: no cover
         self.settings = Settings()
@@ -21,3 +25,13 @@ class Worker(BaseWorker):
         # not sure why but the worker sometimes crashes with no explanation on start, this might help
         await asyncio.sleep(2)
         return kwargs
+
+    async def run_job(self, j):
+        trace_threshold = self.settings.sql_trace_threshold
+        if trace_threshold is None:
+            return await super().run_job(j)
+        trace = start_task_trace()
+        try:
+            return await super().run_job(j)
+        finally:
+            trace.log_if_slow(f'{j.class_name}.{j.func_name}', trace_threshold)
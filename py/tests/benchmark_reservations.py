@@ -0,0 +1,201 @@
+"""
+Benchmark reserving tickets with the reserve_tickets sql function against making one query per step as
+ReserveTickets used to.
+
+Requires a database created with "./run.py reset_database", run from the py directory with:
+
+    python -m tests.benchmark_reservations --concurrency 20 --requests 2000 --latency 2
+
+"--latency" adds a delay (in milliseconds) to every round trip to imitate a remote database.
+"""
+import argparse
+import asyncio
+import json
+from time import perf_counter
+from uuid import uuid4
+
+from buildpg import asyncpg
+
+from shared.settings import Settings
+
+event_sql = """
+SELECT e.status, e.external_ticket_url, e.name, c.cover_costs_percentage
+FROM events AS e
+JOIN categories c on e.category = c.id
+WHERE c.company=$1 AND e.id=$2
+"""
+insert_tickets_sql = """
+INSERT INTO tickets (event, reserve_action, ticket_type, price, user_id, first_name)
+SELECT $1, $2, $3, $4, u.id, 'Benchmark' FROM users AS u WHERE u.email=$5 AND u.company=$6
+"""
+reserve_tickets_sql = 'SELECT * FROM reserve_tickets($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)'
+
+
+class Latency:
+    """
+    Wrap a connection so every query, and starting and finishing transactions, is delayed.
+    """
+
+    def __init__(self, conn, latency: float):
+        self.conn = conn
+        self.latency = latency
+
+    def __getattr__(self, item):
+        func = getattr(self.conn, item)
+
+        async def run(*args):
+            await asyncio.sleep(self.latency)
+            return await func(*args)
+
+        return run
+
+    def transaction(self):
+        return _LatencyTransaction(self.conn.transaction(), self.latency)
+
+
+class _LatencyTransaction:
+    def __init__(self, tr, latency: float):
+        self.tr = tr
+        self.latency = latency
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.latency)
+        await self.tr.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await asyncio.sleep(self.latency)
+        if exc_type:
+            await self.tr.rollback()
+        else:
+            await self.tr.commit()
+
+
+async def reserve_queries(conn, ids, ttl: int):
+    company_id, user_id, event_id, ticket_type_id = ids
+    email = f'{uuid4().hex}@example.org'
+    await conn.fetchrow(event_sql, company_id, event_id)
+    price = await conn.fetchval(
+        'SELECT price FROM ticket_types WHERE event=$1 AND active=TRUE AND id=$2', event_id, ticket_type_id
+    )
+    await conn.fetchval('SELECT check_tickets_remaining($1, $2)', event_id, ttl)
+    async with conn.transaction():
+        await conn.execute(
+            "INSERT INTO users (company, role, email) VALUES ($1, 'guest', $2) ON CONFLICT (company, email) DO NOTHING",
+            company_id,
+            email,
+        )
+        await conn.fetchval('SELECT email FROM users WHERE id=$1', user_id)
+        action_id = await conn.fetchval(
+            "INSERT INTO actions (company, user_id, event, type) VALUES ($1, $2, $3, 'reserve-tickets') RETURNING id",
+            company_id,
+            user_id,
+            event_id,
+        )
+        await conn.execute(insert_tickets_sql, event_id, action_id, ticket_type_id, price, email, company_id)
+
+
+async def reserve_function(conn, ids, ttl: int):
+    company_id, user_id, event_id, ticket_type_id = ids
+    email = f'{uuid4().hex}@example.org'
+    r = await conn.fetchrow(
+        reserve_tickets_sql,
+        company_id,
+        user_id,
+        event_id,
+        ticket_type_id,
+        ttl,
+        True,
+        False,
+        None,
+        json.dumps({'benchmark': True}),
+        [email],
+        ['Benchmark'],
+        [None],
+        [None],
+    )
+    assert r['error_code'] is None, r['error_code']
+
+
+async def create_data(conn):
+    name = f'benchmark-{uuid4().hex[:8]}'
+    company_id = await conn.fetchval(
+        'INSERT INTO companies (name, slug, domain) VALUES ($1, $1, $1) RETURNING id', name
+    )
+    user_id = await conn.fetchval(
+        "INSERT INTO users (company, role, status, email) VALUES ($1, 'admin', 'active', $2) RETURNING id",
+        company_id,
+        f'{name}@example.org',
+    )
+    cat_id = await conn.fetchval(
+        "INSERT INTO categories (company, name, slug) VALUES ($1, 'Benchmark', 'benchmark') RETURNING id", company_id
+    )
+    event_id = await conn.fetchval(
+        """
+        INSERT INTO events (category, status, host, name, slug, start_ts)
+        VALUES ($1, 'published', $2, 'Benchmark', 'benchmark', now() + '30 days'::interval)
+        RETURNING id
+        """,
+        cat_id,
+        user_id,
+    )
+    ticket_type_id = await conn.fetchval(
+        "INSERT INTO ticket_types (event, name, price) VALUES ($1, 'Standard', 10) RETURNING id", event_id
+    )
+    return company_id, user_id, event_id, ticket_type_id
+
+
+async def delete_data(conn, company_id, event_id):
+    await conn.execute('DELETE FROM events WHERE id=$1', event_id)
+    await conn.execute('DELETE FROM companies WHERE id=$1', company_id)
+
+
+async def run(name, func, pool, ids, args):
+    latencies = []
+    queue = list(range(args.requests))
+
+    async def worker():
+        async with pool.acquire() as conn:
+            if args.latency:
+                conn = Latency(conn, args.latency / 1000)
+            while queue:
+                queue.pop()
+                start = perf_counter()
+                await func(conn, ids, args.ttl)
+                latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    time_taken = perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(
+        f'{name:>8}: {len(latencies)} reservations in {time_taken:0.2f}s, {len(latencies) / time_taken:0.0f}/s, '
+        f'p50 {p50:0.2f}ms, p99 {p99:0.2f}ms'
+    )
+
+
+async def main(args):
+    settings = Settings()
+    pool = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=args.concurrency, max_size=args.concurrency)
+    try:
+        async with pool.acquire() as conn:
+            ids = await create_data(conn)
+        try:
+            await run('queries', reserve_queries, pool, ids, args)
+            await run('function', reserve_function, pool, ids, args)
+        finally:
+            async with pool.acquire() as conn:
+                await delete_data(conn, ids[0], ids[2])
+    finally:
+        await pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark reserving tickets')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to each round trip')
+    parser.add_argument('--ttl', type=int, default=600)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -27,6 +27,7 @@ from shared.actions import ActionTypes
 from shared.db import SimplePgPool, create_demo_data as _create_demo_data, prepare_database
 from shared.settings import Settings
 from shared.utils import encrypt_json, mk_password, slugify
+from web.cache import PURGE_CHANNEL
 from web.main import create_app
 from web.stripe import BookFreeModel, Reservation, book_free
 
@@ -100,7 +101,13 @@ def _fix_settings(dummy_server, request, tmpdir):
     if real_stripe:
         fields.remove('stripe_root_url')
     server_name = dummy_server.app['server_name']
-    return Settings(custom_static_dir=str(tmpdir), **{f: f'{server_name}/{f}/' for f in fields}, **settings_args)
+    # fields can be overridden for a test with @pytest.mark.settings(...)
+    marker = request.node.get_closest_marker('settings')
+    return Settings(
+        custom_static_dir=str(tmpdir),
+        **{f: f'{server_name}/{f}/' for f in fields},
+        **{**settings_args, **(marker.kwargs if marker else {})},
+    )
 
 
 @pytest.fixture(name='db_conn')
@@ -306,7 +313,6 @@ class Factory:
         await self.conn.execute_b(
             'INSERT INTO tickets (:values__names) VALUES :values', values=MultipleValues(*ticket_values)
         )
-        await self.conn.execute('SELECT check_tickets_remaining($1, $2)', event_id, self.settings.ticket_ttl)
         return Reservation(
             user_id=user_id,
             action_id=action_id,
@@ -332,6 +338,7 @@ class Factory:
         expected_status=204,
         fire_delay=0,
         metadata=None,
+        stripe_event_id=None,
     ):
         return await self._fire_stripe_webhook(
             user_id=user_id or self.user_id,
@@ -344,6 +351,7 @@ class Factory:
             expected_status=expected_status,
             fire_delay=fire_delay,
             metadata=metadata,
+            stripe_event_id=stripe_event_id,
         )
 
     async def book_free(self, reservation: Reservation, user_id=None):
@@ -427,6 +435,32 @@ async def redis(loop, settings: Settings):
     await redis.wait_closed()
 
 
+@pytest.yield_fixture(name='purged_keys')
+async def _fix_purged_keys(loop, settings: Settings, redis):
+    """
+    Stand-in for a caching proxy, returns a function giving the surrogate keys purged since it was last called.
+    """
+    addr = settings.redis_settings.host, settings.redis_settings.port
+    sub_redis = await create_redis(addr, loop=loop)
+    (channel,) = await sub_redis.subscribe(PURGE_CHANNEL)
+
+    async def purged_keys():
+        # messages are received in order so all purges have been received once the marker arrives
+        await redis.publish(PURGE_CHANNEL, '__marker__')
+        keys = []
+        with timeout(2):
+            while True:
+                msg = await channel.get(encoding='utf8')
+                if msg == '__marker__':
+                    return keys
+                keys.extend(msg.split(' '))
+
+    yield purged_keys
+
+    sub_redis.close()
+    await sub_redis.wait_closed()
+
+
 async def pre_startup_app(app):
     app['main_app']['pg'] = SimplePgPool(app['test_conn'])
 
@@ -437,6 +471,8 @@ async def post_startup_app(app):
     inner_app['email_actor']._concurrency_enabled = False
     inner_app['donorfy_actor'].pg = inner_app['pg']
     inner_app['donorfy_actor']._concurrency_enabled = False
+    inner_app['stripe_events_actor'].pg = inner_app['pg']
+    inner_app['stripe_events_actor']._concurrency_enabled = False
     await inner_app['donorfy_actor'].startup()
 
 
@@ -531,6 +567,7 @@ async def _fix_fire_stripe_webhook(url, settings, cli, loop):
         expected_status,
         fire_delay,
         metadata,
+        stripe_event_id=None,
     ):
         if metadata is None:
             metadata = {
@@ -540,6 +577,7 @@ async def _fix_fire_stripe_webhook(url, settings, cli, loop):
                 'reserve_action_id': reserve_action_id,
             }
         data = {
+            'id': stripe_event_id or f'evt_{uuid.uuid4().hex}',
             'type': webhook_type,
             'data': {
                 'object': {
@@ -68,6 +68,9 @@ async def stripe_post_customers(request):
 
 async def stripe_create_payment_intent(request):
     data = await request.post()
+    if data.get('customer') == 'cus_deleted':
+        error = {'code': 'resource_missing', 'param': 'customer', 'message': "No such customer: 'cus_deleted'"}
+        return json_response({'error': error}, status=400)
     action_id = data['metadata[reserve_action_id]']
     return json_response({'id': f'payment_intent_{action_id}', 'client_secret': f'payment_intent_secret_{action_id}'})
 
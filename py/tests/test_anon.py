@@ -1,10 +1,15 @@
+import asyncio
 import re
 from datetime import datetime, timezone
+from time import time
 
+import pytest
 from buildpg import Values
 from pytest_toolbox.comparison import RegexStr
 
 from shared.actions import ActionTypes
+from shared.sitemap import SitemapActor, sitemap_cache_key
+from web.cache import clear_index_cache, index_cache_key
 
 from .conftest import Factory
 
@@ -56,7 +61,136 @@ async def test_root(cli, url, factory: Factory):
     }
 
 
-async def test_sitemap(cli, url, factory: Factory, db_conn):
+# responses would be shared with the request before the change
+@pytest.mark.settings(single_flight_ttl=0)
+async def test_root_etag(cli, url, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    etag = r.headers['ETag']
+    assert etag == RegexStr(r'"[0-9a-f]{32}"')
+
+    r = await cli.get(url('index'), headers={'If-None-Match': etag})
+    assert r.status == 304, await r.text()
+    assert r.headers['ETag'] == etag
+    assert await r.read() == b''
+
+    r = await cli.get(url('index'), headers={'If-None-Match': f'"other", W/{etag}'})
+    assert r.status == 304, await r.text()
+
+    await db_conn.execute("UPDATE categories SET name='Changed'")
+    await clear_index_cache(cli.app['main_app'], factory.company_id)
+    r = await cli.get(url('index'), headers={'If-None-Match': etag})
+    assert r.status == 200, await r.text()
+    assert r.headers['ETag'] != etag
+    assert (await r.json())['categories'][0]['name'] == 'Changed'
+
+
+async def test_root_etag_compressed(cli, url, factory: Factory):
+    await factory.create_company()
+    # enough categories for the response to be compressed
+    for i in range(10):
+        await factory.create_cat(name=f'Category {i}', description='x' * 140)
+    r = await cli.get(url('index'), headers={'Accept-Encoding': 'gzip'})
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Encoding'] == 'gzip'
+    etag = r.headers['ETag']
+    assert etag == RegexStr(r'W/"[0-9a-f]{32}"')
+
+    r = await cli.get(url('index'), headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert r.status == 304, await r.text()
+    assert r.headers['ETag'] == etag
+
+    # the 200 wouldn't be compressed so the 304 has the strong ETag
+    r = await cli.get(url('index'), headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert r.status == 304, await r.text()
+    assert r.headers['ETag'] == etag[2:]
+
+
+async def test_root_single_flight(cli, url, factory: Factory, login, mocker):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    # called once by each call of the index view
+    cache_key = mocker.patch('web.views.index_cache_key', side_effect=index_cache_key)
+
+    responses = await asyncio.gather(*[cli.get(url('index')) for _ in range(3)])
+    assert [r.status for r in responses] == [200, 200, 200]
+    assert len({await r.text() for r in responses}) == 1
+    assert len({r.headers['ETag'] for r in responses}) == 1
+    assert cache_key.call_count == 1
+
+    r = await cli.head(url('index'))
+    assert r.status == 200, await r.text()
+    r = await cli.head(url('index'))
+    assert r.status == 200, await r.text()
+    assert cache_key.call_count == 3
+
+    await login()
+    responses = await asyncio.gather(*[cli.get(url('index')) for _ in range(2)])
+    assert [r.status for r in responses] == [200, 200]
+    assert (await responses[0].json())['user']['id'] == factory.user_id
+    assert cache_key.call_count == 5
+
+
+async def test_root_cache_headers(cli, url, factory: Factory, login):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    assert r.headers['Cache-Control'] == 'public, max-age=60, stale-while-revalidate=600'
+    assert r.headers['Surrogate-Key'] == f'index-{factory.company_id} company-{factory.company_id}'
+    assert 'Cookie' in r.headers.getall('Vary')
+
+    await login()
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    assert r.headers['Cache-Control'] == 'private, no-cache'
+    assert 'Surrogate-Key' not in r.headers
+
+    r = await cli.get(url('event-categories'))
+    assert r.status == 200, await r.text()
+    assert 'Cache-Control' not in r.headers
+
+
+async def test_root_cached(cli, url, factory: Factory, db_conn, login, redis):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(highlight=True, status='published')
+
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['categories'][0]['name'] == 'Supper Clubs'
+    assert data['user'] is None
+    assert await redis.exists(f'index:{factory.company_id}')
+
+    # cached
+    await db_conn.execute("UPDATE categories SET name='Changed'")
+    await db_conn.execute('UPDATE events SET ticket_limit=tickets_taken')
+    await login()
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['categories'][0]['name'] == 'Supper Clubs'
+    assert data['highlight_events'][0]['sold_out'] is True
+    assert data['user']['id'] == factory.user_id
+
+    r = await cli.json_post(url('event-switch-highlight', id=factory.event_id))
+    assert r.status == 200, await r.text()
+    assert not await redis.exists(f'index:{factory.company_id}')
+
+    r = await cli.get(url('index'))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['categories'][0]['name'] == 'Changed'
+    assert data['highlight_events'] == []
+
+
+async def test_sitemap(cli, url, factory: Factory, db_conn, redis):
     await factory.create_company()
     await factory.create_cat()
     await factory.create_user()
@@ -124,6 +258,21 @@ async def test_sitemap(cli, url, factory: Factory, db_conn):
         '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
     ]
 
+    # as if the sitemap was built an hour ago
+    await redis.hset(sitemap_cache_key(factory.company_id), 'last_modified', str(time() - 3600))
+    r = await cli.get(url('sitemap'))
+    assert r.status == 200, await r.text()
+    last_modified = r.headers['Last-Modified']
+
+    # the latest event change is now before last_modified, but the sitemap has still changed
+    await db_conn.execute("UPDATE events SET status='suspended' WHERE id=$1", factory.event_id)
+    await redis.delete(sitemap_cache_key(factory.company_id))
+    r = await cli.get(url('sitemap'), headers={'If-Modified-Since': last_modified})
+    text = await r.text()
+    assert r.status == 200, text
+    assert 'the-event-name' not in text
+    assert r.headers['Last-Modified'] != last_modified
+
 
 async def test_sitemap_none(cli, url, factory: Factory):
     await factory.create_company()
@@ -143,6 +292,43 @@ async def test_sitemap_none(cli, url, factory: Factory):
     )
 
 
+async def test_sitemap_cron(cli, url, factory: Factory, db_conn, settings, db_pool, redis):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published')
+    await db_conn.execute_b(
+        'INSERT INTO actions (:values__names) VALUES :values',
+        values=Values(
+            company=factory.company_id, user_id=factory.user_id, type=ActionTypes.create_event, event=factory.event_id
+        ),
+    )
+    c2 = await factory.create_company(name='Other', domain='other.example.org')
+    cat2 = await factory.create_cat(company_id=c2, name='Other Cat')
+    await factory.create_event(category_id=cat2, name='Other Event', status='published')
+
+    actor = SitemapActor(settings=settings, pg=db_pool, concurrency_enabled=False)
+    await actor.startup()
+    try:
+        assert 2 == await actor.build_sitemaps.direct()
+        assert await redis.exists(f'sitemap:{factory.company_id}')
+        # nothing has changed
+        assert 0 == await actor.build_sitemaps.direct()
+    finally:
+        await actor.close(shutdown=True)
+
+    r = await cli.get(url('sitemap'), headers={'Accept-Encoding': 'gzip'})
+    text = await r.text()
+    assert r.status == 200, text
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'https://127.0.0.1/supper-clubs/the-event-name/' in text
+    assert 'other' not in text.lower()
+    last_modified = r.headers['Last-Modified']
+
+    r = await cli.get(url('sitemap'), headers={'If-Modified-Since': last_modified})
+    assert r.status == 304, await r.text()
+
+
 async def test_sitemap_error(cli, url, factory: Factory):
     await factory.create_company()
     r = await cli.get(url('sitemap'))
@@ -164,3 +350,27 @@ async def test_get_company_links(cli, url, factory: Factory, db_conn):
     assert data['company']['footer_links'] == [
         {'url': 'https://www.example.com', 'title': 'foo', 'new_tab': True},
     ]
+
+
+async def test_metrics(cli, url, login, factory: Factory):
+    await factory.create_company()
+    await factory.create_user()
+
+    r = await cli.get(url('metrics'))
+    assert r.status == 401, await r.text()
+
+    await login()
+    r = await cli.get(url('index'), headers={'X-Request-Start': '1000'})
+    assert r.status == 200, await r.text()
+
+    r = await cli.get(url('metrics'))
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Type'] == 'text/plain; charset=utf-8'
+    text = await r.text()
+    assert '# TYPE nosht_request_duration_seconds histogram\n' in text
+    assert 'nosht_request_duration_seconds_count{route="index"} 1\n' in text
+    assert 'nosht_request_duration_seconds_count{route="login"} 1\n' in text
+    assert 'nosht_pg_queries_count{route="index"} 1\n' in text
+    assert 'nosht_request_queue_seconds_bucket{route="index",le="+Inf"} 1\n' in text
+    # X-Request-Start was a long time ago
+    assert 'nosht_request_queue_seconds_bucket{route="index",le="10"} 0\n' in text
@@ -654,6 +654,20 @@ async def test_session_updated(cli, url, factory: Factory, login, mocker):
     assert 'Set-Cookie' in r.headers
 
 
+async def test_session_cached(cli, url, factory: Factory, login, mocker):
+    await factory.create_company()
+    await factory.create_user()
+    await login()
+
+    decrypt = mocker.spy(fernet.Fernet, 'decrypt')
+    r = await cli.get(url('event-categories'))
+    assert r.status == 200, await r.text()
+    r = await cli.get(url('event-categories'))
+    assert r.status == 200, await r.text()
+    # the cookie was cached when it was created
+    assert decrypt.call_count == 0
+
+
 async def test_login_captcha_required(cli, url, factory: Factory):
     await factory.create_company()
 
@@ -1,7 +1,13 @@
+from time import time
+
 import pytest
+from buildpg import asyncpg
 from pytest_toolbox.comparison import AnyInt, RegexStr
 
 from shared.actions import ActionTypes
+from shared.inventory import reconcile_inventory
+from shared.reservations import ReservationsActor
+from web.cache import clear_event_cache
 from web.stripe import Reservation
 from web.utils import decrypt_json, encrypt_json
 
@@ -78,6 +84,13 @@ async def test_booking_info_inactive(cli, url, factory: Factory, login, db_conn)
     }
 
     await db_conn.execute('update ticket_types set active=false where id=$1', ticket_type2_id)
+    # ticket types are cached until clear_event_cache is called
+    r = await cli.get(url('event-booking-info-public', category=cat_slug, event=event_slug))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert len(data['ticket_types']) == 2
+
+    await clear_event_cache(cli.app['main_app'], factory.event_id)
     r = await cli.get(url('event-booking-info-public', category=cat_slug, event=event_slug))
     assert r.status == 200, await r.text()
     data = await r.json()
@@ -88,6 +101,34 @@ async def test_booking_info_inactive(cli, url, factory: Factory, login, db_conn)
     }
 
 
+async def test_booking_info_read_only(cli, url, factory: Factory, login, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(ticket_limit=8, status='published')
+    await login()
+
+    await factory.create_reservation()
+    res = await factory.create_reservation()
+    await db_conn.execute(
+        "update tickets set created_ts=now() - '3600 seconds'::interval where reserve_action=$1", res.action_id
+    )
+    assert 6 == await db_conn.fetchval('select ticket_limit - tickets_taken from events')
+
+    cat_slug, event_slug = await db_conn.fetchrow(
+        'SELECT cat.slug, e.slug FROM events AS e JOIN categories cat on e.category = cat.id WHERE e.id=$1',
+        factory.event_id,
+    )
+    r = await cli.get(url('event-booking-info-public', category=cat_slug, event=event_slug))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['tickets_remaining'] == 7
+
+    # the expired reservation is counted as released but not updated
+    assert 0 == await db_conn.fetchval('select count(*) from tickets where reservation_expired')
+    assert 6 == await db_conn.fetchval('select ticket_limit - tickets_taken from events')
+
+
 async def test_booking_info_sig(cli, url, factory: Factory, login, settings, db_conn):
     await factory.create_company()
     await factory.create_cat()
@@ -362,6 +403,25 @@ async def test_reserve_tickets_cover_costs(cli, url, factory: Factory, login):
     }
 
 
+async def test_reserve_tickets_cover_costs_zero(cli, url, factory: Factory, login, db_conn):
+    await factory.create_company()
+    await factory.create_cat(cover_costs_message='Help!', cover_costs_percentage=0)
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+    await login()
+
+    data = {
+        'tickets': [{'t': True, 'email': 'frank@example.org', 'cover_costs': True}],
+        'ticket_type': factory.ticket_type_id,
+    }
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['extra_donated'] is None
+    assert data['total_price'] == 10.0
+    assert await db_conn.fetchval('SELECT extra_donated FROM tickets') is None
+
+
 async def test_reserve_tickets_free(cli, url, factory: Factory, login):
     await factory.create_company()
     await factory.create_cat()
@@ -464,6 +524,19 @@ async def test_reserve_tickets_none_left(cli, url, factory: Factory, login):
     }
 
 
+async def test_reserve_tickets_wrong_event(cli, url, factory: Factory, login):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+    await login()
+
+    data = {'tickets': [{'t': True, 'email': 'foo1@example.org'}], 'ticket_type': factory.ticket_type_id}
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id + 1), data=data)
+    assert r.status == 404, await r.text()
+    assert await r.json() == {'message': 'Event not found'}
+
+
 async def test_reserve_tickets_none_left_no_precheck(cli, url, factory: Factory, login, settings):
     settings.ticket_reservation_precheck = False
     await factory.create_company()
@@ -484,6 +557,156 @@ async def test_reserve_tickets_none_left_no_precheck(cli, url, factory: Factory,
     }
 
 
+async def test_reserve_tickets_inventory(cli, url, factory: Factory, login, settings, db_conn, redis):
+    settings.redis_inventory = True
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user(first_name='Ticket', last_name=None, email='ticket.buyer@example.org')
+    await factory.create_event(status='published', price=10, ticket_limit=2)
+    await login(email='ticket.buyer@example.org')
+    key = f'inventory:{factory.event_id}'
+
+    assert 1 == await reconcile_inventory(db_conn, redis)
+    assert await redis.hget(key, 'available') == b'2'
+
+    data = {'tickets': [{'t': True, 'email': 'foo1@example.org'}], 'ticket_type': factory.ticket_type_id}
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+    booking_token = (await r.json())['booking_token']
+    assert await redis.hget(key, 'available') == b'1'
+
+    data = {
+        'tickets': [{'t': True, 'email': 'foo1@example.org'}, {'t': True, 'email': 'foo2@example.org'}],
+        'ticket_type': factory.ticket_type_id,
+    }
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 470, await r.text()
+    assert await r.json() == {'message': 'only 1 tickets remaining', 'tickets_remaining': 1}
+    assert await redis.hget(key, 'available') == b'1'
+
+    # redis is out of sync, postgres rejects the reservation and the slots are returned
+    await redis.hset(key, 'available', 5)
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 470, await r.text()
+    assert await redis.hget(key, 'available') == b'5'
+
+    await reconcile_inventory(db_conn, redis)
+    assert await redis.hget(key, 'available') == b'1'
+    r = await cli.json_post(url('event-cancel-reservation'), data={'booking_token': booking_token})
+    assert r.status == 200, await r.text()
+    assert await redis.hget(key, 'available') == b'2'
+    assert 0 == await db_conn.fetchval('select tickets_taken from events')
+
+
+async def test_waiting_room(cli, url, factory: Factory, login, redis, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+    await login()
+    key = f'waiting-room:{factory.event_id}'
+
+    r = await cli.json_post(url('event-queue-join', id=factory.event_id))
+    assert r.status == 200, await r.text()
+    assert await r.json() == {'token': None, 'admitted': True, 'ahead': 0, 'retry_after': 0}
+
+    r = await cli.json_post(url('event-set-waiting-room', id=factory.event_id), data={'rate': 1})
+    assert r.status == 200, await r.text()
+    assert 1 == await db_conn.fetchval('select waiting_room_rate from events')
+    # the waiting room lasts until a day after the event starts
+    start_ts = await db_conn.fetchval('select start_ts from events')
+    assert abs(await redis.ttl(key) - (start_ts.timestamp() + 24 * 3600 - time())) < 5
+
+    data = {'tickets': [{'t': True, 'email': 'foo1@example.org'}], 'ticket_type': factory.ticket_type_id}
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 429, await r.text()
+    assert await r.json() == {'message': 'waiting room active, join the queue to book', 'waiting_room': True}
+
+    # two guests are already in the queue, ts in the future means no more are admitted during the test
+    await redis.hmset_dict(key, joined=2, admitted=0, ts=time() + 1000)
+    r = await cli.json_post(url('event-queue-join', id=factory.event_id))
+    assert r.status == 200, await r.text()
+    queue = await r.json()
+    assert queue == {'token': RegexStr('.+'), 'admitted': False, 'ahead': 2, 'retry_after': 3}
+
+    data['admission_token'] = queue['token']
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 429, await r.text()
+    assert await r.json() == {
+        'message': 'not yet admitted from the waiting room',
+        'waiting_room': True,
+        'ahead': 2,
+        'retry_after': 3,
+    }
+
+    await redis.hset(key, 'admitted', 3)
+    r = await cli.get(url('event-queue-position', id=factory.event_id, query={'token': queue['token']}))
+    assert r.status == 200, await r.text()
+    assert await r.json() == {'admitted': True, 'ahead': 0, 'retry_after': 0}
+
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+
+    r = await cli.json_post(url('event-set-waiting-room', id=factory.event_id), data={'rate': None})
+    assert r.status == 200, await r.text()
+    assert not await redis.exists(key)
+    assert None is await db_conn.fetchval('select waiting_room_rate from events')
+    del data['admission_token']
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+
+
+async def test_restore_waiting_rooms(factory: Factory, db_conn, db_pool, settings, redis):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+    await db_conn.execute('update events set waiting_room_rate=5')
+    key = f'waiting-room:{factory.event_id}'
+    await redis.hset(key, 'joined', 3)
+
+    actor = ReservationsActor(settings=settings, pg=db_pool, concurrency_enabled=False)
+    await actor.startup()
+    try:
+        await actor.reap_reservations.direct()
+    finally:
+        await actor.close(shutdown=True)
+
+    assert await redis.hgetall(key) == {b'rate': b'5', b'joined': b'3'}
+    assert await redis.ttl(key) > 0
+
+
+async def test_booking_nowait(cli, url, factory: Factory, login, db_conn, settings):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+    await login()
+
+    r = await cli.json_post(url('event-set-booking-nowait', id=factory.event_id), data={'nowait': True})
+    assert r.status == 200, await r.text()
+    assert await db_conn.fetchval('select booking_nowait from events')
+
+    data = {'tickets': [{'t': True, 'email': 'foo1@example.org'}], 'ticket_type': factory.ticket_type_id}
+    # another booking for the event is in progress
+    other_conn = await asyncpg.connect_b(dsn=settings.pg_dsn)
+    try:
+        await other_conn.execute('SELECT pg_advisory_lock($1)', factory.event_id)
+        r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+        assert r.status == 429, await r.text()
+        assert await r.json() == {'message': 'event busy, please try again', 'retry_after': 1}
+    finally:
+        await other_conn.close()
+
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+    assert 1 == await db_conn.fetchval('select count(*) from tickets')
+
+    r = await cli.get(url('metrics'))
+    assert r.status == 200, await r.text()
+    assert 'nosht_booking_lock_wait_seconds_count{route="event-reserve-tickets"} 1\n' in await r.text()
+
+
 async def test_reserve_tickets_too_many(cli, url, factory: Factory, login):
     await factory.create_company()
     await factory.create_cat()
@@ -829,7 +1052,7 @@ async def test_cancel_ticket_refund_too_much(factory: Factory, cli, url, buy_tic
     assert 'POST stripe_root_url/refunds' not in dummy_server.app['log']
 
 
-async def test_ticket_expiry(factory: Factory, db_conn, settings):
+async def test_ticket_expiry(factory: Factory, db_conn, settings, db_pool):
     await factory.create_company()
     await factory.create_cat()
     await factory.create_user()
@@ -849,9 +1072,86 @@ async def test_ticket_expiry(factory: Factory, db_conn, settings):
     await db_conn.execute("update tickets set created_ts=now() - '10 days'::interval where id=$1", ticket_id)
 
     assert 2 == await db_conn.fetchval('select check_tickets_remaining($1, $2)', factory.event_id, settings.ticket_ttl)
+    assert await db_conn.fetchval('select count(*) from tickets') == 1
+
+    actor = ReservationsActor(settings=settings, pg=db_pool, concurrency_enabled=False)
+    await actor.startup()
+    try:
+        assert (0, 1) == await actor.reap_reservations.direct()
+    finally:
+        await actor.close(shutdown=True)
     assert await db_conn.fetchval('select count(*) from tickets') == 0
 
 
+async def test_reap_reservations(factory: Factory, db_conn, settings, db_pool):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10, ticket_limit=10)
+    e2 = await factory.create_event(name='Another Event', status='published', price=10, ticket_limit=10)
+    tt2 = await db_conn.fetchval('select id from ticket_types where event=$1', e2)
+
+    await factory.create_reservation()
+    await factory.create_reservation()
+    await factory.create_reservation(event_id=e2, ticket_type_id=tt2)
+    old_res = await factory.create_reservation(event_id=e2, ticket_type_id=tt2)
+    booked_res = await factory.create_reservation(event_id=e2, ticket_type_id=tt2)
+    await db_conn.execute("update tickets set status='booked' where reserve_action=$1", booked_res.action_id)
+    await db_conn.execute("update tickets set created_ts=now() - '3600 seconds'::interval")
+    await db_conn.execute(
+        "update tickets set created_ts=now() - '10 days'::interval where reserve_action=$1", old_res.action_id
+    )
+    assert 2 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+    assert 3 == await db_conn.fetchval('select tickets_taken from events where id=$1', e2)
+
+    settings.reservation_reap_batch = 2
+    actor = ReservationsActor(settings=settings, pg=db_pool, concurrency_enabled=False)
+    await actor.startup()
+    try:
+        assert (4, 1) == await actor.reap_reservations.direct()
+        assert (0, 0) == await actor.reap_reservations.direct()
+    finally:
+        await actor.close(shutdown=True)
+
+    assert 0 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+    assert 1 == await db_conn.fetchval('select tickets_taken from events where id=$1', e2)
+    assert 4 == await db_conn.fetchval('select count(*) from tickets')
+    assert 3 == await db_conn.fetchval('select count(*) from tickets where reservation_expired')
+
+
+async def test_tickets_taken_trigger(factory: Factory, db_conn, settings):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10, ticket_limit=3)
+
+    res = await factory.create_reservation()
+    await factory.create_reservation()
+    assert 2 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+    await db_conn.execute("update tickets set status='booked' where reserve_action=$1", res.action_id)
+    assert 2 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+    await db_conn.execute("update tickets set status='cancelled' where reserve_action=$1", res.action_id)
+    assert 1 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+    await db_conn.execute('update ticket_types set slots_used=3 where id=$1', factory.ticket_type_id)
+    assert 3 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+    await db_conn.execute("update tickets set created_ts=now() - '3600 seconds'::interval where status='reserved'")
+    assert 3 == await db_conn.fetchval('select check_tickets_remaining($1, $2)', factory.event_id, settings.ticket_ttl)
+    assert 0 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+    assert await db_conn.fetchval("select reservation_expired from tickets where status='reserved'") is True
+
+    await db_conn.execute("update tickets set status='booked' where status='reserved'")
+    assert 3 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+    await db_conn.execute('delete from tickets')
+    assert 0 == await db_conn.fetchval('select tickets_taken from events where id=$1', factory.event_id)
+
+
+# responses would be shared with the request before the change
+@pytest.mark.settings(single_flight_ttl=0)
 async def test_index_sold_out(factory: Factory, cli, url, buy_tickets, db_conn):
     await factory.create_company()
     await factory.create_cat(slug='testing', cover_costs_percentage=5)
@@ -1,9 +1,14 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
 from aiohttp import FormData
 from pytest_toolbox.comparison import RegexStr
 
 from .conftest import Factory, create_image
 
 
+# responses would be shared with the request before the change
+@pytest.mark.settings(single_flight_ttl=0)
 async def test_cat_event_list(cli, url, db_conn, factory: Factory):
     await factory.create_company()
     await factory.create_cat()
@@ -30,6 +35,7 @@ async def test_cat_event_list(cli, url, db_conn, factory: Factory):
                 'allow_tickets': True,
             },
         ],
+        'next': None,
     }
     await db_conn.execute("update events set secondary_image='second-image', location_name='loc-name'")
     r = await cli.get(url('category', category=slug))
@@ -53,9 +59,75 @@ async def test_cat_event_list(cli, url, db_conn, factory: Factory):
                 'allow_tickets': True,
             },
         ],
+        'next': None,
     }
 
 
+async def test_cat_event_list_cache_headers(cli, url, factory: Factory):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published')
+
+    r = await cli.get(url('category', category='supper-clubs'))
+    assert r.status == 200, await r.text()
+    assert r.headers['Cache-Control'] == 'public, max-age=60, stale-while-revalidate=600'
+    assert r.headers['Surrogate-Key'] == (
+        f'category-{factory.category_id} event-{factory.event_id} company-{factory.company_id}'
+    )
+
+    r = await cli.get(url('category', category='missing'))
+    assert r.status == 200, await r.text()
+    assert await r.json() == {'events': [], 'next': None}
+    assert r.headers['Surrogate-Key'] == f'company-{factory.company_id}'
+
+
+async def test_cat_event_list_pages(cli, url, factory: Factory, mocker):
+    mocker.patch('web.views.categories.CATEGORY_PAGE_SIZE', 2)
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    start_ts = datetime(2032, 6, 28, 19, 0, tzinfo=timezone.utc)
+    e1 = await factory.create_event(name='first', status='published', start_ts=start_ts)
+    e3 = await factory.create_event(name='third', status='published', start_ts=start_ts + timedelta(days=1))
+    e2 = await factory.create_event(name='second', status='published', start_ts=start_ts)
+
+    r = await cli.get(url('category', category='supper-clubs'))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert [e['id'] for e in data['events']] == [e1, e2]
+    assert data['next']
+
+    r = await cli.get(url('category', category='supper-clubs', query={'after': data['next']}))
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert [e['id'] for e in data['events']] == [e3]
+    assert data['next'] is None
+
+    r = await cli.get(url('category', category='supper-clubs', query={'after': 'foobar'}))
+    assert r.status == 400, await r.text()
+    assert await r.json() == {'message': 'invalid cursor'}
+
+
+async def test_cat_event_list_pages_same_start(cli, url, factory: Factory, mocker):
+    mocker.patch('web.views.categories.CATEGORY_PAGE_SIZE', 2)
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    start_ts = datetime(2032, 6, 28, 19, 0, tzinfo=timezone.utc)
+    event_ids = [await factory.create_event(name=f'event {i}', status='published', start_ts=start_ts) for i in range(5)]
+
+    ids, query = [], {}
+    for _ in range(3):
+        r = await cli.get(url('category', category='supper-clubs', query=query))
+        assert r.status == 200, await r.text()
+        data = await r.json()
+        ids += [e['id'] for e in data['events']]
+        query = {'after': data['next']}
+    assert ids == sorted(event_ids)
+    assert data['next'] is None
+
+
 async def test_create_cat(cli, url, db_conn, factory: Factory, login):
     await factory.create_company()
     await factory.create_user()
@@ -132,6 +204,23 @@ async def test_edit_cat(cli, url, db_conn, factory: Factory, login):
     assert cat['description'] == 'x'
 
 
+async def test_edit_cat_purge(cli, url, factory: Factory, login, purged_keys):
+    await factory.create_company()
+    await factory.create_user()
+    await factory.create_cat()
+    await factory.create_event()
+    await login()
+    assert await purged_keys() == []
+
+    r = await cli.json_post(url('category-edit', pk=factory.category_id), data=dict(description='x'))
+    assert r.status == 200, await r.text()
+    assert await purged_keys() == [
+        f'index-{factory.company_id}',
+        f'event-{factory.event_id}',
+        f'category-{factory.category_id}',
+    ]
+
+
 async def test_delete_cat(cli, url, db_conn, factory: Factory, login):
     await factory.create_company()
     await factory.create_user()
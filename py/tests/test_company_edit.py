@@ -50,6 +50,22 @@ async def test_company_edit(cli, url, login, factory: Factory, db_conn):
     assert 'New Name' == await db_conn.fetchval('SELECT name FROM companies')
 
 
+async def test_company_edit_domain(cli, url, login, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_user()
+    await login()
+    assert len(cli.app['main_app']['domain_cache']) == 1
+
+    r = await cli.json_post(url('company-edit', pk=factory.company_id), data={'domain': 'example.com'})
+    assert r.status == 200, await r.text()
+    assert 'example.com' == await db_conn.fetchval('SELECT domain FROM companies')
+    assert len(cli.app['main_app']['domain_cache']) == 0
+
+    r = await cli.get(url('index'))
+    assert r.status == 400, await r.text()
+    assert await r.json() == {'message': 'no company found for this host'}
+
+
 async def test_upload_image(cli, url, factory: Factory, login, db_conn, dummy_server):
     await factory.create_company()
     await factory.create_user()
@@ -67,6 +67,48 @@ async def test_event_public(cli, url, factory: Factory, db_conn):
     }
 
 
+async def test_event_cached(cli, url, factory: Factory, db_conn, login, redis):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', ticket_limit=10)
+    cat_slug, event_slug = await db_conn.fetchrow(
+        'SELECT cat.slug, e.slug FROM events AS e JOIN categories cat on e.category = cat.id WHERE e.id=$1',
+        factory.event_id,
+    )
+    event_url = url('event-get-public', category=cat_slug, event=event_slug)
+
+    r = await cli.get(event_url)
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['event']['name'] == 'The Event Name'
+    assert data['event']['tickets_available'] is None
+    assert await redis.exists(f'event:{factory.event_id}')
+
+    # the public part is cached, tickets available and the user's tickets are not
+    await db_conn.execute("UPDATE events SET name='Changed'")
+    res = await factory.create_reservation()
+    await factory.book_free(res)
+    await login()
+    r = await cli.get(event_url)
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['event']['name'] == 'The Event Name'
+    assert data['event']['tickets_available'] == 9
+    assert data['existing_tickets'] == 1
+    assert data['on_waiting_list'] is False
+
+    r = await cli.json_post(url('event-edit', pk=factory.event_id), data=dict(ticket_limit=20))
+    assert r.status == 200, await r.text()
+    assert not await redis.exists(f'event:{factory.event_id}')
+
+    r = await cli.get(event_url)
+    assert r.status == 200, await r.text()
+    data = await r.json()
+    assert data['event']['name'] == 'Changed'
+    assert data['event']['tickets_available'] is None
+
+
 async def test_event_wrong_slug(cli, url, factory: Factory):
     await factory.create_company()
 
@@ -130,6 +172,42 @@ async def test_private_event_bad_sig(cli, url, factory: Factory, db_conn, settin
     assert {'message': 'event not found'} == await r.json()
 
 
+async def test_event_sig_cached(cli, url, factory: Factory, db_conn, login):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(public=False, status='published')
+    await login()
+
+    cat_slug, event_slug = await db_conn.fetchrow(
+        'SELECT cat.slug, e.slug FROM events AS e JOIN categories cat on e.category = cat.id WHERE e.id=$1',
+        factory.event_id,
+    )
+    r = await cli.get(url('event-get-public', category=cat_slug, event=event_slug))
+    assert r.status == 404, await r.text()
+    sig_cache = cli.app['main_app']['event_sig_cache']
+    assert len(sig_cache) == 1
+
+    # cached, so the event is still private
+    await db_conn.execute('UPDATE events SET public=TRUE')
+    r = await cli.get(url('event-get-public', category=cat_slug, event=event_slug))
+    assert r.status == 404, await r.text()
+
+    r = await cli.json_post(url('event-set-status', id=factory.event_id), data=dict(status='published'))
+    assert r.status == 200, await r.text()
+    assert len(sig_cache) == 0
+
+    r = await cli.get(url('event-get-public', category=cat_slug, event=event_slug))
+    assert r.status == 200, await r.text()
+    assert (await r.json())['event']['id'] == factory.event_id
+
+    # missing events aren't cached
+    r = await cli.get(url('event-get-public', category=cat_slug, event='missing'))
+    assert r.status == 404, await r.text()
+    assert len(sig_cache) == 1
+    assert (factory.company_id, cat_slug, 'missing') not in sig_cache
+
+
 async def test_bread_browse(cli, url, factory: Factory, login):
     await factory.create_company()
     await factory.create_cat()
@@ -214,6 +292,8 @@ async def test_bread_retrieve(cli, url, factory: Factory, login):
         'description_image': None,
         'external_ticket_url': None,
         'external_donation_url': None,
+        'booking_nowait': False,
+        'waiting_room_rate': None,
         'host': factory.user_id,
         'host_name': 'Frank Spencer',
         'link': '/pvt/supper-clubs/the-event-name/8d2a9334aa29f2151668a54433df2e9d/',
@@ -331,6 +411,8 @@ async def test_create_event(cli, url, db_conn, factory: Factory, login, dummy_se
         'ticket_limit': None,
         'donation_target': None,
         'tickets_taken': 0,
+        'booking_nowait': False,
+        'waiting_room_rate': None,
         'image': None,
         'secondary_image': None,
     }
@@ -699,7 +781,7 @@ async def test_edit_past_event(cli, url, db_conn, factory: Factory, login):
     assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='edit-event'")
 
 
-async def test_set_event_status(cli, url, db_conn, factory: Factory, login):
+async def test_set_event_status(cli, url, db_conn, factory: Factory, login, purged_keys):
     await factory.create_company()
     await factory.create_cat()
     await factory.create_user()
@@ -707,11 +789,17 @@ async def test_set_event_status(cli, url, db_conn, factory: Factory, login):
     await login()
 
     assert 'pending' == await db_conn.fetchval('SELECT status FROM events')
+    assert await purged_keys() == []
 
     r = await cli.json_post(url('event-set-status', id=factory.event_id), data=dict(status='published'))
     assert r.status == 200, await r.text()
 
     assert 'published' == await db_conn.fetchval('SELECT status FROM events')
+    assert await purged_keys() == [
+        f'index-{factory.company_id}',
+        f'event-{factory.event_id}',
+        f'category-{factory.category_id}',
+    ]
 
 
 async def test_set_event_status_bad(cli, url, db_conn, factory: Factory, login):
@@ -1613,6 +1701,8 @@ async def test_clone_event(cli, url, factory: Factory, db_conn, login):
         'ticket_limit': 42,
         'donation_target': None,
         'tickets_taken': 0,
+        'booking_nowait': False,
+        'waiting_room_rate': None,
         'image': None,
         'secondary_image': None,
     }
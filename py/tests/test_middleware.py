@@ -4,7 +4,17 @@ from aiohttp_session import new_session, session_middleware
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
 from shared.db import SimplePgPool
-from web.middleware import error_middleware, exc_extra
+from shared.trace import QueryTrace
+from web.middleware import (
+    LOG_BODY_MAX,
+    LOG_BURST,
+    LOG_SAMPLE_RATE,
+    ErrorLog,
+    LazyConnection,
+    compression_middleware,
+    error_middleware,
+    exc_extra,
+)
 
 from .conftest import Factory
 
@@ -24,6 +34,10 @@ async def handle_errors(request):
         raise ValueError('snap')
     elif do == 'return_499':
         return web.Response(text='499 response', status=499)
+    elif do == 'return_429':
+        return web.Response(text='429 response', status=429)
+    elif do.startswith('error_'):
+        raise ValueError(do)
     return web.Response(text='ok')
 
 
@@ -41,7 +55,7 @@ async def _fix_cli(settings, db_conn, aiohttp_client, redis):
     )
     app.add_routes([web.get('/user', handle_user), web.get('/{do}', handle_errors)])
 
-    app.update(test_conn=db_conn, settings=settings)
+    app.update(test_conn=db_conn, settings=settings, error_log=ErrorLog())
     app.on_startup.append(pre_startup_app)
     cli = await aiohttp_client(app)
 
@@ -91,10 +105,17 @@ async def test_499(cli, caplog):
     assert len(caplog.records) == 1
     record = caplog.records[0]
     assert record.data.keys() == {'request_duration', 'request', 'response'}
+    assert record.fingerprint == ['/{do}', '499']
     assert record.user == {'ip_address': '127.0.0.1'}
     assert record.tags == {}
 
 
+async def test_429(cli, caplog):
+    r = await cli.get('/return_429')
+    assert r.status == 429, await r.text()
+    assert len(caplog.records) == 0
+
+
 async def test_value_error(cli, caplog):
     r = await cli.get('/value_error')
     assert r.status == 500, await r.text()
@@ -117,20 +138,106 @@ async def test_user(cli, caplog, db_conn, fire_stripe_webhook):
     assert len(caplog.records) == 1
     record = caplog.records[0]
     assert record.data.keys() == {'request_duration', 'request', 'response'}
-    assert record.user == {
-        'ip_address': '127.0.0.1',
-        'email': 'frank@example.org',
-        'company_name': 'Testing',
-        'company_id': factory.company_id,
-        'role': 'admin',
-        'status': 'active',
-        'username': 'Frank Spencer',
-    }
-    assert record.tags == {
-        'user_status': 'active',
-        'user_role': 'admin',
-        'company': factory.company_id,
-    }
+    assert record.user == {'ip_address': '127.0.0.1', 'user_id': factory.user_id}
+    assert record.tags == {}
+
+
+async def test_rate_limited(cli, caplog):
+    for _ in range(LOG_BURST + LOG_SAMPLE_RATE):
+        r = await cli.get('/return_499')
+        assert r.status == 499, await r.text()
+    await cli.app['error_log'].join()
+    assert len(caplog.records) == LOG_BURST + 1
+    assert caplog.records[-1].data['suppressed'] == LOG_SAMPLE_RATE - LOG_BURST - 1
+    assert 'suppressed' not in caplog.records[-2].data
+
+
+async def test_rate_limited_by_route(cli, caplog):
+    for i in range(LOG_BURST + LOG_SAMPLE_RATE):
+        r = await cli.get(f'/error_{i}')
+        assert r.status == 500, await r.text()
+    await cli.app['error_log'].join()
+    assert len(caplog.records) == LOG_BURST + 1
+    assert caplog.records[0].fingerprint == ['ValueError', 'error_0']
+    assert caplog.records[0].data['request']['url'] == '/error_0'
+    assert caplog.records[-1].data['suppressed'] == LOG_SAMPLE_RATE - LOG_BURST - 1
+
+
+async def test_large_body(cli, caplog):
+    r = await cli.get('/500', data='x' * (LOG_BODY_MAX + 1))
+    assert r.status == 500, await r.text()
+    await cli.app['error_log'].join()
+    assert len(caplog.records) == 1
+    assert caplog.records[0].data['request']['text'] is None
+
+
+async def test_lazy_connection(db_pool):
+    conn = LazyConnection(db_pool)
+    assert not conn.acquired
+    assert await conn.fetchval('SELECT 1') == 1
+    assert conn.acquired
+
+    async with conn.transaction():
+        assert await conn.fetchval_b('SELECT :v', v=2) == 2
+        await conn.release()
+        # connections aren't released inside a transaction
+        assert conn.acquired
+
+    await conn.release()
+    assert not conn.acquired
+    assert await conn.fetchrow('SELECT 3') == (3,)
+    assert conn.acquired
+
+
+async def test_lazy_connection_cursor(db_pool):
+    conn = LazyConnection(db_pool)
+    with pytest.raises(RuntimeError):
+        conn.cursor('SELECT 1')
+
+    async with conn.transaction():
+        assert [r[0] async for r in conn.cursor('SELECT generate_series(1, 3)')] == [1, 2, 3]
+
+
+async def test_lazy_connection_trace(db_pool, caplog):
+    conn = LazyConnection(db_pool, trace=QueryTrace())
+    assert await conn.fetchval('SELECT 1') == 1
+    assert await conn.fetch('SELECT generate_series(1, 3)') == [(1,), (2,), (3,)]
+    assert await conn.execute('SELECT   generate_series(1,\n 2)') == 'SELECT 2'
+    assert [(q.method, q.sql, q.rows) for q in conn.trace.queries] == [
+        ('fetchval', 'SELECT 1', 1),
+        ('fetch', 'SELECT generate_series(1, 3)', 3),
+        ('execute', 'SELECT generate_series(1, 2)', 2),
+    ]
+
+    conn.trace.log_if_slow('GET foobar', 60)
+    assert 'foobar' not in caplog.text
+    conn.trace.log_if_slow('GET foobar', 0)
+    assert 'GET foobar slow:' in caplog.text
+    assert 'execute    SELECT generate_series(1, 2)' in caplog.text
+
+
+async def test_compression(aiohttp_client):
+    async def handler(request):
+        return web.json_response({'data': ['x' * 100] * int(request.query['n'])})
+
+    app = web.Application(middlewares=(compression_middleware,))
+    app.router.add_get('/', handler)
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/?n=100', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert int(r.headers['Content-Length']) < 1000
+    assert await r.json() == {'data': ['x' * 100] * 100}
+
+    r = await cli.get('/?n=100', headers={'Accept-Encoding': 'br'})
+    assert r.headers['Content-Encoding'] == 'br'
+    assert int(r.headers['Content-Length']) < 1000
+
+    r = await cli.get('/?n=1', headers={'Accept-Encoding': 'gzip, br'})
+    assert 'Content-Encoding' not in r.headers
+    assert await r.json() == {'data': ['x' * 100]}
 
 
 def test_exc_extra_ok():
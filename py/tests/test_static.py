@@ -1,5 +1,6 @@
 import os
 
+import brotli
 import pytest
 from aiohttp.test_utils import make_mocked_request
 from aiohttp.web_exceptions import HTTPNotFound
@@ -26,6 +27,20 @@ async def test_file(cli, setup_static):
     assert r.headers.get('X-Robots-Tag') is None
 
 
+async def test_file_brotli(cli, setup_static, tmpdir):
+    tmpdir.join('test.js.br').write_binary(brotli.compress(b'this is test.js'))
+    r = await cli.get('/test.js', headers={'Accept-Encoding': 'gzip, br'})
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Type'] == 'application/javascript'
+    assert r.headers['Content-Encoding'] == 'br'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+
+    r = await cli.get('/test.js', headers={'Accept-Encoding': 'gzip'})
+    assert r.status == 200, await r.text()
+    assert 'Content-Encoding' not in r.headers
+    assert await r.text() == 'this is test.js'
+
+
 async def test_wrong(cli, setup_static):
     request = make_mocked_request('GET', '/D:\\path', match_info={'path': '../path'}, app=cli.app)
     with pytest.raises(HTTPNotFound):
@@ -5,7 +5,7 @@ import os
 from time import time
 
 import pytest
-from pytest_toolbox.comparison import AnyInt, RegexStr
+from pytest_toolbox.comparison import AnyInt, CloseToNow, RegexStr
 
 from shared.actions import ActionTypes
 from shared.stripe_base import get_stripe_processing_fee
@@ -171,7 +171,7 @@ async def test_real_webhook(cli, url, login, db_conn, factory: Factory, settings
     await stripe.post(f'payment_intents/{payment_intent_id}', payment_method='card_1FEzKsC8giHSw9x7rBL3xl0j')
     payment_intent = await stripe.post(f'payment_intents/{payment_intent_id}/confirm')
 
-    data = {'type': 'payment_intent.succeeded', 'data': {'object': payment_intent}}
+    data = {'id': 'evt_' + payment_intent_id, 'type': 'payment_intent.succeeded', 'data': {'object': payment_intent}}
     body = json.dumps(data)
     t = int(time())
     sig = hmac.new(b'stripe_webhook_secret_xxx', f'{t}.{body}'.encode(), hashlib.sha256).hexdigest()
@@ -254,8 +254,8 @@ async def test_webhook_bought_late(factory: Factory, db_conn, settings):
     await db_conn.execute("update tickets set created_ts=now() - '3600 seconds'::interval where id=$1", ticket_id)
 
     assert 2 == await db_conn.fetchval('select check_tickets_remaining($1, $2)', factory.event_id, settings.ticket_ttl)
-    r = await factory.fire_stripe_webhook(res.action_id, expected_status=233)
-    assert await r.text() == 'ticket bought too late'
+    await factory.fire_stripe_webhook(res.action_id)
+    assert 'ticket bought too late' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert not await db_conn.fetchval("SELECT id FROM actions WHERE type='buy-tickets'")
 
@@ -266,8 +266,8 @@ async def test_webhook_ticket_not_found(factory: Factory, db_conn):
     await factory.create_user()
     await factory.create_event(status='published', price=10, ticket_limit=2)
 
-    r = await factory.fire_stripe_webhook(0, expected_status=231)
-    assert await r.text() == 'ticket not found'
+    await factory.fire_stripe_webhook(0)
+    assert 'ticket not found' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert not await db_conn.fetchval("SELECT id FROM actions WHERE type='buy-tickets'")
 
@@ -286,8 +286,8 @@ async def test_webhook_fired_late_exceeded_limit(factory: Factory, db_conn, sett
     await factory.create_reservation()
     assert 0 == await db_conn.fetchval('select check_tickets_remaining($1, $2)', factory.event_id, settings.ticket_ttl)
 
-    r = await factory.fire_stripe_webhook(res.action_id, fire_delay=3590, expected_status=234)
-    assert await r.text() == 'ticket limit exceeded'
+    await factory.fire_stripe_webhook(res.action_id, fire_delay=3590)
+    assert 'ticket limit exceeded' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert not await db_conn.fetchval("SELECT id FROM actions WHERE type='buy-tickets'")
 
@@ -333,6 +333,55 @@ async def test_existing_customer_no_customer(cli, url, login, dummy_server, fact
     ]
 
 
+async def test_existing_customer_verified(cli, url, login, dummy_server, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user(stripe_customer_id='xxx')
+    await factory.create_event(status='published', price=10)
+
+    await login()
+    data = {
+        'tickets': [{'t': True, 'email': 'frank@example.org'}],
+        'ticket_type': factory.ticket_type_id,
+    }
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+    assert await db_conn.fetchval('SELECT stripe_customer_verified_ts FROM users WHERE id=$1', factory.user_id)
+
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+
+    assert dummy_server.app['log'] == [
+        'GET stripe_root_url/customers/xxx',
+        'POST stripe_root_url/payment_intents',
+        'POST stripe_root_url/payment_intents',
+    ]
+
+
+async def test_verified_customer_deleted(cli, url, login, dummy_server, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user(stripe_customer_id='cus_deleted')
+    await factory.create_event(status='published', price=10)
+    await db_conn.execute('UPDATE users SET stripe_customer_verified_ts=now() WHERE id=$1', factory.user_id)
+
+    await login()
+    data = {
+        'tickets': [{'t': True, 'email': 'frank@example.org'}],
+        'ticket_type': factory.ticket_type_id,
+    }
+    r = await cli.json_post(url('event-reserve-tickets', id=factory.event_id), data=data)
+    assert r.status == 200, await r.text()
+
+    assert dummy_server.app['log'] == [
+        'POST stripe_root_url/payment_intents',
+        'POST stripe_root_url/customers',
+        'POST stripe_root_url/payment_intents',
+    ]
+    customer_id = await db_conn.fetchval('SELECT stripe_customer_id FROM users WHERE id=$1', factory.user_id)
+    assert customer_id == 'customer-id'
+
+
 async def test_buy_webhook_repeat(factory: Factory, cli, url, login, db_conn):
     await factory.create_company()
     await factory.create_cat(cover_costs_message='Help!', cover_costs_percentage=5)
@@ -354,8 +403,8 @@ async def test_buy_webhook_repeat(factory: Factory, cli, url, login, db_conn):
     assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
     assert 'booked' == await db_conn.fetchval('select status from tickets')
 
-    r = await factory.fire_stripe_webhook(action_id, expected_status=232)
-    assert await r.text() == 'ticket not reserved'
+    await factory.fire_stripe_webhook(action_id)
+    assert 'ticket not reserved' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='book-free-tickets'")
     assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets-offline'")
@@ -380,8 +429,8 @@ async def test_donate_after_webhook_repeat(factory: Factory, dummy_server, db_co
     assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM donations')
     await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate')
 
-    r = await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate', expected_status=240)
-    assert await r.text() == 'donation already performed'
+    await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate')
+    assert 'donation already performed' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM donations')
 
@@ -408,8 +457,8 @@ async def test_donate_direct_webhook(factory: Factory, dummy_server, db_conn, cl
     assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM donations')
     await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate-direct')
 
-    r = await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate-direct', expected_status=240)
-    assert await r.text() == 'donation already performed'
+    await factory.fire_stripe_webhook(action_id, amount=20_00, purpose='donate-direct')
+    assert 'donation already performed' == await db_conn.fetchval('SELECT result FROM stripe_events ORDER BY id DESC')
 
     assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM donations')
 
@@ -420,10 +469,10 @@ async def test_donate_direct_webhook(factory: Factory, dummy_server, db_conn, cl
     ]
 
 
-async def test_donate_webhook_missing_action(factory: Factory, fire_stripe_webhook):
+async def test_donate_webhook_missing_action(factory: Factory, fire_stripe_webhook, db_conn):
     await factory.create_company()
 
-    r = await fire_stripe_webhook(
+    await fire_stripe_webhook(
         user_id=1,
         event_id=1,
         reserve_action_id=1,
@@ -431,11 +480,104 @@ async def test_donate_webhook_missing_action(factory: Factory, fire_stripe_webho
         purpose='donate-direct',
         webhook_type='payment_intent.succeeded',
         charge_id='charge-id',
-        expected_status=240,
+        expected_status=204,
         fire_delay=0,
         metadata=None,
     )
-    assert await r.text() == 'action not found'
+    assert 'action not found' == await db_conn.fetchval('SELECT result FROM stripe_events')
+
+
+async def test_webhook_duplicate(factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+
+    res = await factory.create_reservation()
+    await factory.fire_stripe_webhook(res.action_id, stripe_event_id='evt_123')
+    r = await factory.fire_stripe_webhook(res.action_id, stripe_event_id='evt_123', expected_status=208)
+    assert await r.text() == 'event already received'
+
+    assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    r = await db_conn.fetchrow('SELECT stripe_id, event, attempts, processed_ts, result FROM stripe_events')
+    assert dict(r) == {
+        'stripe_id': 'evt_123',
+        'event': factory.event_id,
+        'attempts': 1,
+        'processed_ts': CloseToNow(delta=3),
+        'result': None,
+    }
+
+
+async def test_webhook_retry(cli, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+
+    res = await factory.create_reservation()
+    await factory.fire_stripe_webhook(res.action_id, user_id=999)
+
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    attempts, processed_ts, result = await db_conn.fetchrow('SELECT attempts, processed_ts, result FROM stripe_events')
+    assert attempts == 1
+    assert processed_ts is None
+    assert result.startswith('ForeignKeyViolationError(')
+
+    await db_conn.execute(
+        """
+        UPDATE stripe_events SET received_ts=now() - '5 minutes'::interval,
+        payload=jsonb_set(payload, '{data,object,metadata,user_id}', to_jsonb($1::int))
+        """,
+        factory.user_id,
+    )
+    await cli.app['main_app']['stripe_events_actor'].retry_events.direct()
+
+    assert 1 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    assert 'booked' == await db_conn.fetchval('select status from tickets')
+    assert 2 == await db_conn.fetchval('SELECT attempts FROM stripe_events WHERE processed_ts IS NOT NULL')
+
+
+async def test_webhook_retry_order(cli, factory: Factory, db_conn):
+    await factory.create_company()
+    await factory.create_cat()
+    await factory.create_user()
+    await factory.create_event(status='published', price=10)
+
+    res1 = await factory.create_reservation()
+    res2 = await factory.create_reservation()
+    await factory.fire_stripe_webhook(res1.action_id, user_id=999, stripe_event_id='evt_1')
+    # evt_1 failed so evt_2 waits for it to be retried
+    await factory.fire_stripe_webhook(res2.action_id, stripe_event_id='evt_2')
+
+    assert 0 == await db_conn.fetchval("SELECT COUNT(*) FROM actions WHERE type='buy-tickets'")
+    events = await db_conn.fetch('SELECT stripe_id, attempts, processed_ts FROM stripe_events ORDER BY id')
+    assert [dict(e) for e in events] == [
+        {'stripe_id': 'evt_1', 'attempts': 2, 'processed_ts': None},
+        {'stripe_id': 'evt_2', 'attempts': 0, 'processed_ts': None},
+    ]
+
+    await db_conn.execute(
+        """
+        UPDATE stripe_events SET received_ts=now() - '5 minutes'::interval,
+        payload=jsonb_set(payload, '{data,object,metadata,user_id}', to_jsonb($1::int))
+        WHERE stripe_id='evt_1'
+        """,
+        factory.user_id,
+    )
+    await db_conn.execute("UPDATE stripe_events SET received_ts=now() - '5 minutes'::interval")
+    await cli.app['main_app']['stripe_events_actor'].retry_events.direct()
+
+    booked = await db_conn.fetch(
+        """
+        SELECT t.reserve_action FROM tickets AS t
+        JOIN actions AS a ON t.booked_action = a.id
+        WHERE t.status='booked'
+        ORDER BY a.id
+        """
+    )
+    assert [r[0] for r in booked] == [res1.action_id, res2.action_id]
+    assert 2 == await db_conn.fetchval('SELECT COUNT(*) FROM stripe_events WHERE processed_ts IS NOT NULL')
 
 
 async def test_price_low(cli, factory: Factory, db_conn):
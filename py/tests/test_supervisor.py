@@ -0,0 +1,129 @@
+import signal
+
+import pytest
+
+from web.supervisor import MAX_RESTART_DELAY, MIN_WORKER_LIFETIME, Supervisor, start_web
+
+
+class FakeProcess:
+    def __init__(self, *, target, args, name):
+        self.args = args
+        self.name = name
+        self.pid = None
+        self.exitcode = None
+        self.alive = False
+        self.terminated = False
+
+    def start(self):
+        self.pid = 1000 + len(processes)
+        self.alive = True
+        processes.append(self)
+
+    def is_alive(self):
+        return self.alive
+
+    def die(self, exitcode=1):
+        self.alive = False
+        self.exitcode = exitcode
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self, timeout=None):
+        if self.terminated:
+            self.die(-signal.SIGTERM)
+
+
+processes = []
+
+
+@pytest.fixture(name='supervisor')
+def _fix_supervisor(settings_session, mocker):
+    processes.clear()
+    get_context = mocker.patch('web.supervisor.multiprocessing.get_context')
+    get_context.return_value.Process = FakeProcess
+    mocker.patch('web.supervisor.time', return_value=100)
+    s = Supervisor(settings_session, 2)
+    for worker_id in range(s.workers):
+        s._start(worker_id)
+    return s
+
+
+def test_start(supervisor):
+    assert [(p.name, p.args[1], p.pid) for p in processes] == [('web-worker-0', 0, 1000), ('web-worker-1', 1, 1001)]
+    supervisor._check_workers()
+    assert len(processes) == 2
+
+
+def test_restart_backoff(supervisor, mocker, caplog):
+    time = mocker.patch('web.supervisor.time')
+    now = 100
+    for delay in (1, 3, 7, 15, 31, 60, 60):
+        # dies straight after starting so the delay before restarting increases
+        processes[-1].die()
+        time.return_value = now
+        supervisor._check_workers()
+        assert supervisor._pending == {1: now + delay}
+        assert caplog.records[-1].data['worker_id'] == 1
+
+        time.return_value = now + delay - 1
+        supervisor._check_workers()
+        assert supervisor._pending == {1: now + delay}
+
+        time.return_value = now = now + delay
+        count = len(processes)
+        supervisor._check_workers()
+        assert supervisor._pending == {}
+        assert len(processes) == count + 1
+        assert processes[-1].args[1] == 1
+    assert delay == MAX_RESTART_DELAY
+
+    # worker ran for long enough, the failures are reset and it's restarted immediately
+    time.return_value = now + MIN_WORKER_LIFETIME
+    processes[-1].die()
+    supervisor._check_workers()
+    assert supervisor._failures == {1: 0}
+    assert supervisor._pending == {}
+    assert processes[-1].args[1] == 1 and processes[-1].alive
+    assert processes[0].alive
+
+
+def test_sigterm(supervisor, mocker):
+    kill = mocker.patch('web.supervisor.os.kill')
+    supervisor._handle_signal(signal.SIGTERM, None)
+    assert supervisor._stopping is True
+
+    # workers aren't restarted once stopping
+    processes[0].die()
+    supervisor._check_workers()
+    assert supervisor._pending == {}
+    assert len(processes) == 2
+
+    supervisor._stop()
+    assert [p.terminated for p in processes] == [False, True]
+    assert [p.alive for p in processes] == [False, False]
+    assert not kill.called
+
+
+def test_stop_kill(supervisor, mocker):
+    kill = mocker.patch('web.supervisor.os.kill')
+    kill.side_effect = lambda pid, sig: processes[pid - 1000].die(-sig)
+    processes[1].join = lambda timeout=None: None
+
+    supervisor._stop()
+    assert [p.exitcode for p in processes] == [-signal.SIGTERM, -signal.SIGKILL]
+    kill.assert_called_once_with(1001, signal.SIGKILL)
+
+
+@pytest.mark.parametrize('args,workers', [([], None), (['--workers', '1'], None), (['--workers', '3'], 3)])
+def test_start_web(args, workers, settings_session, mocker):
+    supervisor = mocker.patch('web.supervisor.Supervisor')
+    run_web = mocker.patch('web.supervisor.run_web')
+    start_web(settings_session, args)
+    if workers:
+        supervisor.assert_called_once_with(settings_session, workers)
+        supervisor.return_value.run.assert_called_once_with()
+        assert not run_web.called
+    else:
+        assert not supervisor.called
+        run_web.assert_called_once_with(settings_session)
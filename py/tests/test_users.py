@@ -136,6 +136,8 @@ async def test_edit_user(cli, url, login, factory: Factory, db_conn):
     r = await cli.json_post(url('user-edit', pk=factory.user_id), data={'first_name': 'foo'})
     assert r.status == 200, await r.text()
     assert 'foo' == await db_conn.fetchval('SELECT first_name FROM users')
+    # cached by user_middleware for the request, then cleared by the edit
+    assert factory.user_id not in cli.app['main_app']['user_company_cache']
 
 
 async def test_add_user_wrong_role_type(cli, url, login, factory: Factory):
@@ -1,15 +1,22 @@
+import asyncio
 import json
 from datetime import datetime, timedelta
 
 import pytest
 from aiohttp.test_utils import make_mocked_request
+from pytest_toolbox.comparison import RegexStr
 
+from shared.trace import normalize_sql, row_count
 from shared.utils import RequestError, format_duration, ticket_id_signed
+from web.cache import SingleFlight, TTLCache
 from web.utils import (
     JsonErrors,
+    accepted_encodings,
     clean_markdown,
+    etag_matches,
     get_ip,
     get_offset,
+    make_etag,
     prepare_search_query,
     pretty_lenient_json,
     split_name,
@@ -133,3 +140,127 @@ def test_get_offset():
 )
 def test_prepare_search_query(input, output):
     assert prepare_search_query(Request(**input)) == output
+
+
+def test_ttl_cache():
+    cache = TTLCache(max_size=2, ttl=60)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # b was least recently used
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    cache.pop('a')
+    assert 'a' not in cache
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_ttl_cache_expired():
+    cache = TTLCache(max_size=10, ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+async def test_single_flight(loop):
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    single_flight = SingleFlight(max_size=10, ttl=60)
+    assert await asyncio.gather(*[single_flight.run('a', func) for _ in range(3)]) == [1, 1, 1]
+    assert len(calls) == 1
+    # result is kept
+    assert await single_flight.run('a', func) == 1
+    assert await single_flight.run('b', func) == 2
+    assert len(calls) == 2
+
+
+async def test_single_flight_no_ttl(loop):
+    calls = []
+
+    async def func():
+        calls.append(1)
+        return len(calls)
+
+    single_flight = SingleFlight(max_size=10, ttl=0)
+    assert await single_flight.run('a', func) == 1
+    assert await single_flight.run('a', func) == 2
+
+
+async def test_single_flight_error(loop):
+    calls = []
+
+    async def func():
+        calls.append(1)
+        call_count = len(calls)
+        await asyncio.sleep(0.01)
+        if call_count == 1:
+            raise RuntimeError('broken')
+        return call_count
+
+    single_flight = SingleFlight(max_size=10, ttl=60)
+    results = await asyncio.gather(*[single_flight.run('a', func) for _ in range(3)], return_exceptions=True)
+    assert isinstance(results[0], RuntimeError)
+    # the other calls ran func themselves
+    assert results[1:] == [2, 3]
+    assert len(calls) == 3
+
+
+def test_normalize_sql():
+    assert normalize_sql('\n  SELECT *\n  FROM   events\n  WHERE id=$1\n') == 'SELECT * FROM events WHERE id=$1'
+    assert normalize_sql('SELECT ' + 'x' * 300) == 'SELECT ' + 'x' * 192 + '…'
+
+
+@pytest.mark.parametrize(
+    'method,result,expected',
+    [
+        ('fetchval', 123, 1),
+        ('fetchval_b', None, 0),
+        ('fetchrow', None, 0),
+        ('fetch_b', [1, 2], 2),
+        ('execute', 'INSERT 0 5', 5),
+        ('execute_b', 'UPDATE 3', 3),
+        ('execute', 'CREATE TABLE', None),
+        ('execute', None, None),
+    ],
+)
+def test_row_count(method, result, expected):
+    assert row_count(method, result) == expected
+
+
+@pytest.mark.parametrize(
+    'header,expected',
+    [
+        ('', set()),
+        ('gzip, deflate, br', {'gzip', 'deflate', 'br'}),
+        ('GZIP;q=1.0, br;q=0', {'gzip'}),
+        ('br; q=0.5, identity; q=0.000', {'br'}),
+    ],
+)
+def test_accepted_encodings(header, expected):
+    request = make_mocked_request('GET', '/', headers={'Accept-Encoding': header})
+    assert accepted_encodings(request) == expected
+
+
+def test_make_etag():
+    assert make_etag(b'foobar') == make_etag(b'foobar')
+    assert make_etag(b'foobar') != make_etag(b'foo', b'bar')
+    assert make_etag(1, 'x') == RegexStr(r'"[0-9a-f]{32}"')
+
+
+@pytest.mark.parametrize(
+    'header,expected',
+    [(None, False), ('"abc"', True), ('W/"abc"', True), ('"x", "abc"', True), ('"x"', False), ('*', True)],
+)
+def test_etag_matches(header, expected):
+    request = make_mocked_request('GET', '/', headers={'If-None-Match': header} if header else {})
+    assert etag_matches(request, '"abc"') is expected
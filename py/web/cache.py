@@ -0,0 +1,157 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple
+
+_missing = object()
+# surrogate keys of responses which should be purged from reverse proxies and CDNs are published to this redis channel,
+# separated by spaces in the same format as the Surrogate-Key header
+PURGE_CHANNEL = 'cache-purge'
+
+
+class TTLCache:
+    """
+    Simple in-process LRU cache where entries also expire after "ttl" seconds.
+
+    Every worker process has its own cache, so only use this for data where staleness up to "ttl" is acceptable,
+    writes which clear entries only clear them in the process which made the write.
+    """
+
+    __slots__ = '_data', 'max_size', 'ttl'
+
+    def __init__(self, *, max_size: int, ttl: float):
+        self._data = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def get(self, key: Hashable, default=None) -> Any:
+        v = self._data.get(key, _missing)
+        if v is _missing:
+            return default
+        expires, value = v
+        if expires < monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = monotonic() + self.ttl, value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key so only one runs and the others wait for its result, results
+    are then kept for "ttl" seconds.
+
+    If the call fails or returns None the waiting calls run themselves.
+    """
+
+    __slots__ = '_results', '_in_flight'
+
+    def __init__(self, *, max_size: int, ttl: float):
+        self._results = TTLCache(max_size=max_size, ttl=ttl)
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        result = self._results.get(key)
+        if result is not None:
+            return result
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            # shielded so a waiting request being cancelled doesn't cancel the future for the others
+            result = await asyncio.shield(in_flight)
+            return await func() if result is None else result
+
+        in_flight = self._in_flight[key] = asyncio.get_event_loop().create_future()
+        result = None
+        try:
+            result = await func()
+        finally:
+            del self._in_flight[key]
+            in_flight.set_result(result)
+        if result is not None and self._results.ttl > 0:
+            self._results.set(key, result)
+        return result
+
+
+class CachePolicy(NamedTuple):
+    """
+    HTTP caching policy for a route, see cache_control_middleware.
+    """
+
+    max_age: int
+    stale_while_revalidate: int = 0
+    # private responses may only be cached by the browser, not by proxies or CDNs
+    private: bool = False
+
+
+def surrogate_key(kind: str, id: int) -> str:
+    return f'{kind}-{id}'
+
+
+def add_surrogate_keys(request, *keys: str) -> None:
+    """
+    Add keys to the Surrogate-Key header of a response so proxies can purge it when the underlying data changes.
+    """
+    request.setdefault('surrogate_keys', []).extend(keys)
+
+
+async def purge_surrogate_keys(app, *keys: str) -> None:
+    if keys:
+        await app['redis'].publish(PURGE_CHANNEL, ' '.join(keys))
+
+
+def index_cache_key(company_id: int) -> str:
+    return f'index:{company_id}'
+
+
+async def clear_index_cache(app, company_id: int) -> None:
+    """
+    Clear the company part of the index response cached in redis and purge index responses from proxies, this should
+    be called after categories, highlighted events or the company are modified.
+    """
+    await app['redis'].delete(index_cache_key(company_id))
+    await purge_surrogate_keys(app, surrogate_key('index', company_id))
+
+
+def event_cache_key(event_id: int) -> str:
+    return f'event:{event_id}'
+
+
+def ticket_types_cache_key(event_id: int) -> str:
+    return f'event-ticket-types:{event_id}'
+
+
+async def clear_event_cache(app, *event_ids: int) -> None:
+    """
+    Clear the public part of event_get responses cached in redis and purge responses including the events from
+    proxies, this should be called after events or their ticket types are modified. The event's ticket types
+    cached for booking_info are also cleared.
+
+    This also clears this process's cache of event ids and signatures used by check_event_sig, other processes
+    rely on "event_sig_cache_ttl".
+    """
+    app['event_sig_cache'].clear()
+    if event_ids:
+        await app['redis'].delete(
+            *(event_cache_key(event_id) for event_id in event_ids),
+            *(ticket_types_cache_key(event_id) for event_id in event_ids),
+        )
+        await purge_surrogate_keys(app, *(surrogate_key('event', event_id) for event_id in event_ids))
@@ -4,7 +4,6 @@ from pathlib import Path
 
 from aiohttp import ClientSession, ClientTimeout, web
 from aiohttp_session import session_middleware
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
 from arq import create_pool_lenient
 from buildpg import asyncpg
 from cryptography import fernet
@@ -14,10 +13,24 @@ from shared.donorfy import DonorfyActor
 from shared.emails import EmailActor
 from shared.logs import setup_logging
 from shared.settings import Settings
+from shared.stripe_events import StripeEventsActor
 from shared.utils import mk_password
 
-from .middleware import csrf_middleware, error_middleware, pg_middleware, user_middleware
-from .views import index, ses_webhook, sitemap
+from .cache import CachePolicy, SingleFlight, TTLCache
+from .metrics import Metrics
+from .middleware import (
+    ErrorLog,
+    cache_control_middleware,
+    compression_middleware,
+    csrf_middleware,
+    error_middleware,
+    metrics_middleware,
+    pg_middleware,
+    single_flight_middleware,
+    user_middleware,
+)
+from .session import CachedCookieStorage
+from .views import index, metrics, ses_webhook, sitemap
 from .views.auth import (
     authenticate_token,
     guest_signup,
@@ -38,6 +51,8 @@ from .views.booking import (
     donating_info,
     waiting_list_add,
     waiting_list_remove,
+    waiting_room_join,
+    waiting_room_position,
 )
 from .views.categories import (
     CategoryBread,
@@ -63,8 +78,10 @@ from .views.events import (
     EventBread,
     EventClone,
     EventUpdate,
+    SetBookingNowait,
     SetEventStatus,
     SetTicketTypes,
+    SetWaitingRoom,
     event_categories,
     event_donations_export,
     event_get,
@@ -94,11 +111,19 @@ async def startup(app: web.Application):
     await prepare_database(settings, False)
     redis = await create_pool_lenient(settings.redis_settings, app.loop)
     http_client = ClientSession(timeout=ClientTimeout(total=20), loop=app.loop)
+    email_actor = EmailActor(settings=settings, existing_redis=redis, http_client=http_client)
+    donorfy_actor = DonorfyActor(settings=settings, existing_redis=redis)
     app.update(
-        pg=app.get('pg') or await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=2),
+        pg=app.get('pg')
+        or await asyncpg.create_pool_b(
+            dsn=settings.pg_dsn, min_size=settings.pg_pool_min_size, max_size=settings.pg_pool_max_size
+        ),
         redis=redis,
-        email_actor=EmailActor(settings=settings, existing_redis=redis, http_client=http_client),
-        donorfy_actor=DonorfyActor(settings=settings, existing_redis=redis),
+        email_actor=email_actor,
+        donorfy_actor=donorfy_actor,
+        stripe_events_actor=StripeEventsActor(
+            settings=settings, existing_redis=redis, email_actor=email_actor, donorfy_actor=donorfy_actor
+        ),
         http_client=http_client,
         # custom stripe client to make stripe requests as speedy as possible
         stripe_client=ClientSession(timeout=ClientTimeout(total=9), loop=app.loop),
@@ -109,6 +134,7 @@ async def cleanup(app: web.Application):
     await asyncio.gather(
         app['email_actor'].close(),
         app['donorfy_actor'].close(),
+        app['stripe_events_actor'].close(),
         app['pg'].close(),
         app['http_client'].close(),
         app['stripe_client'].close(),
@@ -118,17 +144,51 @@ async def cleanup(app: web.Application):
     transport and await transport.close()
 
 
+# HTTP caching policies by route name, see cache_control_middleware
+CACHE_POLICIES = {
+    'index': CachePolicy(max_age=60, stale_while_revalidate=600),
+    'sitemap': CachePolicy(max_age=600, stale_while_revalidate=3600),
+    'category': CachePolicy(max_age=60, stale_while_revalidate=600),
+    # tickets available is included so event responses are only cached briefly
+    'event-get-public': CachePolicy(max_age=30, stale_while_revalidate=60),
+    'event-get-private': CachePolicy(max_age=30, stale_while_revalidate=60, private=True),
+}
+# identical concurrent requests to these routes from anonymous users share one response, see single_flight_middleware
+SINGLE_FLIGHT_ROUTES = {'index', 'category', 'event-get-public', 'event-get-private'}
+
+
+async def wrapper_cleanup(app: web.Application):
+    await app['error_log'].close()
+
+
 def create_app(*, settings: Settings = None, logging_client=None):
     logging_client = logging_client or setup_logging()
     settings = settings or Settings()
 
-    app = web.Application(logger=None, middlewares=(pg_middleware, user_middleware, csrf_middleware))
+    app = web.Application(
+        logger=None,
+        middlewares=(
+            metrics_middleware,
+            pg_middleware,
+            user_middleware,
+            single_flight_middleware,
+            cache_control_middleware,
+            csrf_middleware,
+        ),
+    )
 
     app.update(
         settings=settings,
         auth_fernet=fernet.Fernet(settings.auth_key),
         dummy_password_hash=mk_password(settings.dummy_password, settings),
         logging_client=logging_client,
+        domain_cache=TTLCache(max_size=settings.company_cache_size, ttl=settings.domain_cache_ttl),
+        user_company_cache=TTLCache(max_size=settings.company_cache_size * 10, ttl=settings.company_cache_ttl),
+        event_sig_cache=TTLCache(max_size=settings.event_sig_cache_size, ttl=settings.event_sig_cache_ttl),
+        metrics=Metrics(),
+        cache_policies=CACHE_POLICIES,
+        single_flight_routes=SINGLE_FLIGHT_ROUTES,
+        single_flight=SingleFlight(max_size=settings.single_flight_cache_size, ttl=settings.single_flight_ttl),
     )
     app.on_startup.append(startup)
     app.on_cleanup.append(cleanup)
@@ -138,12 +198,15 @@ def create_app(*, settings: Settings = None, logging_client=None):
             web.get(r'/', index, name='index'),
             web.get(r'/sitemap.xml', sitemap, name='sitemap'),
             web.post(r'/ses-webhook/', ses_webhook, name='ses-webhook'),
+            web.get(r'/metrics/', metrics, name='metrics'),
             web.get(r'/cat/{category}/', category_public, name='category'),
             # event admin
             web.get(r'/events/categories/', event_categories, name='event-categories'),
             *EventBread.routes(r'/events/'),
             web.get(r'/events/search/', event_search, name='event-search'),
             web.post(r'/events/{id:\d+}/set-status/', SetEventStatus.view(), name='event-set-status'),
+            web.post(r'/events/{id:\d+}/waiting-room/', SetWaitingRoom.view(), name='event-set-waiting-room'),
+            web.post(r'/events/{id:\d+}/booking-nowait/', SetBookingNowait.view(), name='event-set-booking-nowait'),
             web.post(r'/events/{id:\d+}/set-image/new/', set_event_image_new, name='event-set-image-new'),
             web.post(
                 r'/events/{id:\d+}/set-image/existing/', set_event_image_existing, name='event-set-image-existing'
@@ -178,6 +241,8 @@ def create_app(*, settings: Settings = None, logging_client=None):
             web.get(r'/events/{id:\d+}/updates/list/', event_updates_sent, name='event-updates-sent'),
             web.post(r'/events/{id:\d+}/switch-highlight/', switch_highlight, name='event-switch-highlight'),
             web.post(r'/events/{id:\d+}/waiting-list/add/', waiting_list_add, name='event-waiting-list-add'),
+            web.post(r'/events/{id:\d+}/queue/join/', waiting_room_join, name='event-queue-join'),
+            web.get(r'/events/{id:\d+}/queue/', waiting_room_position, name='event-queue-position'),
             web.get(
                 r'/events/{id:\d+}/waiting-list/remove/{user_id:\d+}/',
                 waiting_list_remove,
@@ -248,14 +313,23 @@ def create_app(*, settings: Settings = None, logging_client=None):
     wrapper_app = web.Application(
         client_max_size=settings.max_request_size,
         middlewares=(
-            session_middleware(EncryptedCookieStorage(settings.auth_key, cookie_name='nosht')),
+            session_middleware(
+                CachedCookieStorage(
+                    settings.auth_key,
+                    cookie_name='nosht',
+                    cache_size=settings.session_cache_size,
+                    cache_ttl=settings.cookie_max_age,
+                )
+            ),
             error_middleware,
+            compression_middleware,
         ),
         logger=None,
     )
     wrapper_app.update(
-        settings=settings, main_app=app,
+        settings=settings, main_app=app, error_log=ErrorLog(),
     )
+    wrapper_app.on_cleanup.append(wrapper_cleanup)
     static_dir = settings.custom_static_dir or (Path(__file__).parent / '../../js/build').resolve()
     assert static_dir.exists(), f'js static directory "{static_dir}" does not exists'
     logger.debug('serving static files "%s"', static_dir)
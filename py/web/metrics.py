@@ -0,0 +1,69 @@
+from bisect import bisect_left
+from collections import defaultdict
+from functools import partial
+from typing import Dict, Tuple
+
+TIME_BUCKETS = 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+COUNT_BUCKETS = 0, 1, 2, 3, 5, 8, 13, 21, 34
+
+
+class Histogram:
+    __slots__ = 'buckets', 'counts', 'sum', 'count'
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str):
+        cumulative = 0
+        for le, c in zip(self.buckets, self.counts):
+            cumulative += c
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:0.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class Metrics:
+    """
+    Per route request metrics for this process, rendered in prometheus text format by the "metrics" view.
+    """
+
+    histograms = (
+        ('nosht_request_duration_seconds', 'Time taken to process requests', TIME_BUCKETS),
+        ('nosht_request_queue_seconds', 'Time between X-Request-Start and the request being processed', TIME_BUCKETS),
+        ('nosht_pg_queries', 'Postgres queries per request', COUNT_BUCKETS),
+        ('nosht_pg_wait_seconds', 'Time per request waiting for a postgres connection from the pool', TIME_BUCKETS),
+        ('nosht_booking_lock_wait_seconds', 'Time reservations waited for the event booking lock', TIME_BUCKETS),
+    )
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, Histogram]] = {
+            name: defaultdict(partial(Histogram, buckets)) for name, _, buckets in self.histograms
+        }
+
+    def record(self, route: str, *, duration: float, queue: float, pg_queries: int, pg_wait: float):
+        self._data['nosht_request_duration_seconds'][route].observe(duration)
+        self._data['nosht_request_queue_seconds'][route].observe(queue)
+        self._data['nosht_pg_queries'][route].observe(pg_queries)
+        self._data['nosht_pg_wait_seconds'][route].observe(pg_wait)
+
+    def record_booking_lock_wait(self, route: str, wait: float):
+        self._data['nosht_booking_lock_wait_seconds'][route].observe(wait)
+
+    def render(self) -> str:
+        lines = []
+        for name, help_, _ in self.histograms:
+            lines += [f'# HELP {name} {help_}', f'# TYPE {name} histogram']
+            for route, h in sorted(self._data[name].items()):
+                lines.extend(h.render(name, f'route="{route}"'))
+        return '\n'.join(lines) + '\n'
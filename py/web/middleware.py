@@ -1,19 +1,45 @@
+import asyncio
 import contextlib
+import gzip
 import logging
 import re
 from time import time
-
-from aiohttp.hdrs import METH_GET, METH_OPTIONS, METH_POST
+from typing import Optional
+
+import brotli
+from aiohttp.hdrs import (
+    ACCEPT_ENCODING,
+    CACHE_CONTROL,
+    CONTENT_ENCODING,
+    COOKIE,
+    ETAG,
+    IF_MODIFIED_SINCE,
+    IF_NONE_MATCH,
+    METH_GET,
+    METH_OPTIONS,
+    METH_POST,
+    VARY,
+)
 from aiohttp.web_exceptions import HTTPException, HTTPInternalServerError
 from aiohttp.web_middlewares import middleware
 from aiohttp.web_response import Response
-from aiohttp_session import get_session
-from asyncpg import PostgresError
+from aiohttp_session import SESSION_KEY, get_session
+from buildpg.asyncpg import BuildPgConnection
 
+from shared.trace import QueryTrace
 from shared.utils import lenient_json
 
 from .auth import remove_port
-from .utils import HEADER_CROSS_ORIGIN, JSON_CONTENT_TYPE, JsonErrors, get_ip, request_root
+from .cache import CachePolicy, TTLCache, add_surrogate_keys, surrogate_key
+from .utils import (
+    HEADER_CROSS_ORIGIN,
+    JSON_CONTENT_TYPE,
+    JsonErrors,
+    get_ip,
+    is_compressible,
+    preferred_encoding,
+    request_root,
+)
 
 logger = logging.getLogger('nosht.middleware')
 
@@ -29,21 +55,41 @@ def exc_extra(exc):
             return lenient_json(v)
 
 
-async def log_extra(request, response=None, **more):
-    request_text = response_text = None
+# request and response bodies are truncated to this length in logs, larger request bodies aren't read
+LOG_BODY_MAX = 4096
+LOG_EXCLUDE_HEADERS = {'cookie', 'authorization'}
+# each fingerprint is logged LOG_BURST times per LOG_WINDOW seconds, after that only one in LOG_SAMPLE_RATE is logged
+LOG_BURST = 10
+LOG_WINDOW = 60
+LOG_SAMPLE_RATE = 100
+
+
+async def read_request_text(request) -> Optional[str]:
+    """
+    Request body for logs, this has to be read before the response is sent, larger bodies aren't read.
+    """
     with contextlib.suppress(Exception):  # UnicodeDecodeError or HTTPRequestEntityTooLarge maybe other things too
-        request_text = await request.text()
+        if (request.content_length or 0) <= LOG_BODY_MAX:
+            return (await request.text())[:LOG_BODY_MAX]
+
+
+def log_extra(request, request_text, ip_address, end_time, response=None, **more):
+    """
+    Details of the request for logs, this is called in ErrorLog's background task after the response is sent so
+    user details come from the session if it had been loaded.
+    """
+    response_text = None
     with contextlib.suppress(Exception):  # UnicodeDecodeError
-        response_text = lenient_json(getattr(response, 'text', None))
-    start = request.get('start_time') or time()
+        response_text = lenient_json(getattr(response, 'text', None)[:LOG_BODY_MAX])
+    start = request.get('start_time') or end_time
     data = dict(
-        request_duration=f'{(time() - start) * 1000:0.2f}ms',
+        request_duration=f'{(end_time - start) * 1000:0.2f}ms',
         request=dict(
             url=str(request.rel_url),
             user_agent=request.headers.get('User-Agent'),
             method=request.method,
             host=request.host,
-            headers=dict(request.headers),
+            headers={k: v for k, v in request.headers.items() if k.lower() not in LOG_EXCLUDE_HEADERS},
             text=lenient_json(request_text),
         ),
         response=dict(
@@ -55,41 +101,116 @@ async def log_extra(request, response=None, **more):
     )
 
     tags = dict()
-    user = dict(ip_address=get_ip(request))
-    session = await get_session(request)
-    user_id = session.get('user_id')
-    if user_id:
-        with contextlib.suppress(PostgresError):  # eg. InFailedSQLTransactionError
-            async with request.app['main_app']['pg'].acquire() as conn:
-                user_info = await conn.fetchrow(
-                    """
-                    SELECT u.email, c.name AS company_name, c.id AS company_id, role, status,
-                    full_name(u.first_name, u.last_name) as username
-                    FROM users AS u
-                    JOIN companies AS c ON u.company = c.id
-                    WHERE u.id=$1
-                    """,
-                    user_id,
-                )
-                if user_info:
-                    tags.update(
-                        user_status=user_info['status'], user_role=user_info['role'], company=user_info['company_id'],
-                    )
-                    user.update(user_info)
+    user = dict(ip_address=ip_address)
+    company_id = request.get('company_id')
+    if company_id:
+        tags['company'] = company_id
+    session = request.get('session') or request.get(SESSION_KEY)
+    if session and session.get('user_id'):
+        user.update({k: session[k] for k in ('user_id', 'email', 'role', 'status') if session.get(k) is not None})
+        tags.update({f'user_{k}': session[k] for k in ('role', 'status') if session.get(k) is not None})
     return dict(data=data, user=user, tags=tags)
 
 
+def route_template(request) -> str:
+    """
+    Template of the route which matched the request, eg. "/api/events/{id}/", rather than its url.
+    """
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+class ErrorLog:
+    """
+    Logs errors and warnings from error_middleware in a background task so the response isn't delayed by
+    building log details, logging or sending to sentry.
+
+    Records are rate limited by route template and status or exception type: after LOG_BURST records in LOG_WINDOW
+    seconds only one in LOG_SAMPLE_RATE is logged with the number of records suppressed. Records are also dropped
+    if the queue is full.
+    """
+
+    def __init__(self, *, max_queue_size=1000):
+        self._max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # limit key: [records in this window, records suppressed since the last one logged], keys don't include urls
+        # or exception messages so distinct requests can't flood the cache and evict the counts
+        self._windows = TTLCache(max_size=1000, ttl=LOG_WINDOW)
+
+    def _check_limit(self, key) -> Optional[int]:
+        """
+        :return: None if this record should be dropped, otherwise the number of records suppressed
+        """
+        counts = self._windows.get(key)
+        if counts is None:
+            counts = [0, 0]
+            self._windows.set(key, counts)
+        counts[0] += 1
+        if counts[0] <= LOG_BURST or counts[0] % LOG_SAMPLE_RATE == 0:
+            suppressed, counts[1] = counts[1], 0
+            return suppressed
+        counts[1] += 1
+
+    async def log(self, level, request, fingerprint, msg, *args, response=None, exc_info=None, **more):
+        limit_key = route_template(request), exc_info.__class__.__name__ if exc_info else response.status
+        suppressed = self._check_limit(limit_key)
+        if suppressed is None:
+            return
+
+        if self._queue is None:
+            self._queue = asyncio.Queue(self._max_queue_size)
+            self._task = asyncio.get_event_loop().create_task(self._run())
+        if self._queue.full():
+            return
+        extra_args = dict(
+            request=request,
+            request_text=await read_request_text(request),
+            ip_address=get_ip(request),
+            end_time=time(),
+            response=response,
+            **more,
+        )
+        with contextlib.suppress(asyncio.QueueFull):
+            self._queue.put_nowait((level, msg, args, exc_info, fingerprint, suppressed, extra_args))
+
+    async def _run(self):
+        while True:
+            level, msg, args, exc_info, fingerprint, suppressed, extra_args = await self._queue.get()
+            try:
+                extra = log_extra(**extra_args)
+                extra['fingerprint'] = [str(f) for f in fingerprint]
+                if suppressed:
+                    extra['data']['suppressed'] = suppressed
+                logger.log(level, msg, *args, exc_info=exc_info, extra=extra)
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        if self._task is not None:
+            await self.join()
+            self._task.cancel()
+
+
 async def log_warning(request, response):
-    logger.warning(
+    await request.app['error_log'].log(
+        logging.WARNING,
+        request,
+        [route_template(request), response.status],
         '%s %d',
         request.rel_url,
         response.status,
-        extra={'fingerprint': [request.rel_url, str(response.status)], **await log_extra(request, response)},
+        response=response,
     )
 
 
 def should_warn(r):
-    return r.status > 310 and r.status not in {401, 402, 404, 470}
+    # 429 is expected flow control from waiting rooms and busy events
+    return r.status > 310 and r.status not in {401, 402, 404, 429, 470}
 
 
 def get_request_start(request):
@@ -109,14 +230,15 @@ async def error_middleware(request, handler):
             await log_warning(request, e)
         raise
     except Exception as exc:
-        logger.exception(
+        await request.app['error_log'].log(
+            logging.ERROR,
+            request,
+            [exc.__class__.__name__, exc],
             '%s: %s',
             exc.__class__.__name__,
             exc,
-            extra={
-                'fingerprint': [exc.__class__.__name__, str(exc)],
-                **await log_extra(request, exception_extra=exc_extra(exc)),
-            },
+            exc_info=exc,
+            exception_extra=exc_extra(exc),
         )
         raise HTTPInternalServerError()
     else:
@@ -125,19 +247,204 @@ async def error_middleware(request, handler):
     return r
 
 
+# larger responses are compressed in a thread so they don't block the event loop
+COMPRESS_EXECUTOR_SIZE = 256 * 1024
+BROTLI_QUALITY = 4
+GZIP_LEVEL = 6
+
+
+def _compress(encoding: str, body: bytes) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+@middleware
+async def compression_middleware(request, handler):
+    """
+    Compress responses with brotli or gzip, static files are compressed in advance, see static_handler.
+    """
+    r = await handler(request)
+    if (
+        not isinstance(r, Response)
+        or not isinstance(r.body, bytes)
+        or not is_compressible(r.body, r.content_type)
+        or CONTENT_ENCODING in r.headers
+    ):
+        return r
+
+    encoding = preferred_encoding(request)
+    r.headers.add(VARY, ACCEPT_ENCODING)
+    if encoding:
+        if len(r.body) > COMPRESS_EXECUTOR_SIZE:
+            r.body = await request.loop.run_in_executor(None, _compress, encoding, r.body)
+        else:
+            r.body = _compress(encoding, r.body)
+        r.headers[CONTENT_ENCODING] = encoding
+        etag = r.headers.get(ETAG)
+        if etag and not etag.startswith('W/'):
+            # the compressed body isn't byte for byte identical to the uncompressed one, raw_json_response
+            # weakens the ETag of 304 responses in the same way
+            r.headers[ETAG] = 'W/' + etag
+    return r
+
+
+class LazyConnection:
+    """
+    Stand in for BuildPgConnection which only checks a connection out of the pool when it's first used.
+
+    release() can be called before slow external requests (eg. to stripe) to return the connection to the pool,
+    it'll be checked out again if it's used afterwards. The connection is never released inside a transaction.
+    """
+
+    __slots__ = '_pool', '_acquire_cm', '_conn', '_transactions', 'queries', 'wait_time', 'trace'
+
+    def __init__(self, pool, trace: Optional[QueryTrace] = None):
+        self._pool = pool
+        self._acquire_cm = None
+        self._conn: Optional[BuildPgConnection] = None
+        self._transactions = 0
+        # used by metrics_middleware
+        self.queries = 0
+        self.wait_time = 0
+        self.trace = trace
+
+    @property
+    def acquired(self) -> bool:
+        return self._conn is not None
+
+    async def get(self) -> BuildPgConnection:
+        if self._conn is None:
+            start = time()
+            acquire_cm = self._pool.acquire()
+            self._conn = await acquire_cm.__aenter__()
+            self._acquire_cm = acquire_cm
+            self.wait_time += time() - start
+        return self._conn
+
+    async def _query(self, method, *args, **kwargs):
+        self.queries += 1
+        conn = await self.get()
+        if self.trace is None:
+            return await getattr(conn, method)(*args, **kwargs)
+        else:
+            return await self.trace.run(conn, method, *args, **kwargs)
+
+    async def release(self, *, force=False):
+        if self._conn is not None and (force or not self._transactions):
+            acquire_cm = self._acquire_cm
+            self._conn = self._acquire_cm = None
+            await acquire_cm.__aexit__(None, None, None)
+
+    def transaction(self, **kwargs):
+        return _LazyTransaction(self, kwargs)
+
+    def cursor(self, *args, **kwargs):
+        if not self._transactions:
+            raise RuntimeError('cursors may only be used inside a transaction')
+        self.queries += 1
+        return self._conn.cursor(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._query('execute', *args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self._query('fetch', *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._query('fetchval', *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self._query('fetchrow', *args, **kwargs)
+
+    async def execute_b(self, *args, **kwargs):
+        return await self._query('execute_b', *args, **kwargs)
+
+    async def fetch_b(self, *args, **kwargs):
+        return await self._query('fetch_b', *args, **kwargs)
+
+    async def fetchval_b(self, *args, **kwargs):
+        return await self._query('fetchval_b', *args, **kwargs)
+
+    async def fetchrow_b(self, *args, **kwargs):
+        return await self._query('fetchrow_b', *args, **kwargs)
+
+
+class _LazyTransaction:
+    __slots__ = '_lazy_conn', '_kwargs', '_tr'
+
+    def __init__(self, lazy_conn: LazyConnection, kwargs):
+        self._lazy_conn = lazy_conn
+        self._kwargs = kwargs
+        self._tr = None
+
+    async def __aenter__(self):
+        conn = await self._lazy_conn.get()
+        self._tr = conn.transaction(**self._kwargs)
+        await self._tr.__aenter__()
+        self._lazy_conn._transactions += 1
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._lazy_conn._transactions -= 1
+        return await self._tr.__aexit__(exc_type, exc_val, exc_tb)
+
+
+@middleware
+async def metrics_middleware(request, handler):
+    start = time()
+    try:
+        return await handler(request)
+    finally:
+        conn = request.get('conn')
+        request.app['metrics'].record(
+            request.match_info.route.name or 'unknown',
+            duration=time() - start,
+            queue=max(start - request.get('start_time', start), 0),
+            pg_queries=conn.queries if conn else 0,
+            pg_wait=conn.wait_time if conn else 0,
+        )
+
+
 @middleware
 async def pg_middleware(request, handler):
-    async with request.app['pg'].acquire() as conn:
-        request['conn'] = conn
+    trace_threshold = request.app['settings'].sql_trace_threshold
+    conn = LazyConnection(request.app['pg'], trace=None if trace_threshold is None else QueryTrace())
+    request['conn'] = conn
+    try:
         return await handler(request)
+    finally:
+        await conn.release(force=True)
+        if conn.trace is not None:
+            conn.trace.log_if_slow(f'{request.method} {request.match_info.route.name or request.path}', trace_threshold)
 
 
-USER_COMPANY_SQL = """
-SELECT c.id
-FROM users
-JOIN companies AS c ON c.id=company
-WHERE c.domain=$1 AND users.id=$2
-"""
+async def get_company_id(app, conn, host):
+    """
+    Find the company for a host, company domains very rarely change so they're cached in app['domain_cache'],
+    CompanyBread clears the cache when a domain is edited, other processes rely on "domain_cache_ttl".
+    """
+    cache = app['domain_cache']
+    company_id = cache.get(host)
+    if company_id is None:
+        company_id = await conn.fetchval('SELECT id FROM companies WHERE domain=$1', host)
+        if company_id:
+            cache.set(host, company_id)
+    return company_id
+
+
+async def get_user_company_id(app, conn, user_id):
+    """
+    Find the company a user belongs to, this is cached in app['user_company_cache'] as it's needed by every request
+    with a session, entries are cleared when users are edited or deleted.
+    """
+    cache = app['user_company_cache']
+    company_id = cache.get(user_id)
+    if company_id is None:
+        company_id = await conn.fetchval('SELECT company FROM users WHERE id=$1', user_id)
+        if company_id:
+            cache.set(user_id, company_id)
+    return company_id
 
 
 @middleware
@@ -148,16 +455,12 @@ async def user_middleware(request, handler):
 
     # port is removed as won't matter and messes up on localhost:3000/8000
     host = remove_port(request.host)
-    company_id = None
-    if user_id:
-        company_id = await conn.fetchval(USER_COMPANY_SQL, host, user_id)
-        if not company_id:
-            request['session'].invalidate()
+    company_id = await get_company_id(request.app, conn, host)
+    if user_id and (not company_id or company_id != await get_user_company_id(request.app, conn, user_id)):
+        request['session'].invalidate()
 
     if not company_id:
-        company_id = await conn.fetchval('SELECT id FROM companies WHERE domain=$1', host)
-        if not company_id:
-            raise JsonErrors.HTTPBadRequest(message='no company found for this host')
+        raise JsonErrors.HTTPBadRequest(message='no company found for this host')
     request['company_id'] = company_id
     return await handler(request)
 
@@ -178,6 +481,78 @@ CROSS_ORIGIN_URLS = {
 }
 
 
+@middleware
+async def single_flight_middleware(request, handler):
+    """
+    Identical GET requests from anonymous users to routes in app['single_flight_routes'] which arrive while one is
+    already being handled share its response rather than all running the same queries, see SingleFlight.
+    """
+    route_name = request.match_info.route.name
+    if (
+        request.method != METH_GET
+        or route_name not in request.app['single_flight_routes']
+        or request['session'].get('user_id')
+    ):
+        return await handler(request)
+
+    key = (
+        route_name,
+        request['company_id'],
+        tuple(sorted(request.match_info.items())),
+        request.query_string,
+        request.headers.get(IF_NONE_MATCH),
+        request.headers.get(IF_MODIFIED_SINCE),
+        # the ETag of 304 responses depends on the encoding, see raw_json_response
+        preferred_encoding(request),
+    )
+    response = None
+
+    async def run():
+        nonlocal response
+        response = await handler(request)
+        if isinstance(response, Response) and isinstance(response.body, bytes) and response.status in {200, 304}:
+            return response.status, tuple(response.headers.items()), response.body
+
+    shared = await request.app['single_flight'].run(key, run)
+    if response is not None:
+        # this request's handler was called
+        return response
+    status, headers, body = shared
+    return Response(status=status, headers=headers, body=body)
+
+
+SURROGATE_KEY = 'Surrogate-Key'
+
+
+@middleware
+async def cache_control_middleware(request, handler):
+    """
+    Set Cache-Control for GET routes with a policy in app['cache_policies']. Public responses for anonymous users
+    may be cached by proxies and CDNs so they get a Surrogate-Key header listing the data they include, see
+    purge_surrogate_keys.
+    """
+    r = await handler(request)
+    policy: Optional[CachePolicy] = request.app['cache_policies'].get(request.match_info.route.name)
+    if policy is None or request.method != METH_GET or r.status not in {200, 304} or CACHE_CONTROL in r.headers:
+        return r
+
+    if request['session'].get('user_id'):
+        # responses can include details of the user, browsers should always revalidate with the etag
+        r.headers[CACHE_CONTROL] = 'private, no-cache'
+        return r
+
+    cache_control = f'{"private" if policy.private else "public"}, max-age={policy.max_age}'
+    if policy.stale_while_revalidate:
+        cache_control += f', stale-while-revalidate={policy.stale_while_revalidate}'
+    r.headers[CACHE_CONTROL] = cache_control
+    if not policy.private:
+        add_surrogate_keys(request, surrogate_key('company', request['company_id']))
+        r.headers[SURROGATE_KEY] = ' '.join(dict.fromkeys(request['surrogate_keys']))
+        # logged in users get different responses
+        r.headers.add(VARY, COOKIE)
+    return r
+
+
 def csrf_checks(request):
     """
     content-type, origin and referrer checks for CSRF
@@ -0,0 +1,56 @@
+import hashlib
+
+from aiohttp_session import Session
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
+from cryptography.fernet import InvalidToken
+
+from .cache import TTLCache
+
+LOADED_SESSION_KEY = 'nosht_loaded_session'
+
+
+def _cookie_key(cookie: str) -> bytes:
+    return hashlib.sha256(cookie.encode()).digest()
+
+
+class CachedCookieStorage(EncryptedCookieStorage):
+    """
+    EncryptedCookieStorage which caches decrypted sessions in process by a hash of the cookie, so the same cookie
+    isn't decrypted on every request.
+
+    Sessions are only encrypted and the cookie set when the session data has actually changed.
+    """
+
+    def __init__(self, secret_key, *, cache_size: int, cache_ttl: int, **kwargs):
+        super().__init__(secret_key, **kwargs)
+        self._cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+
+    async def load_session(self, request):
+        cookie = self.load_cookie(request)
+        if cookie is None:
+            return await super().load_session(request)
+
+        key = _cookie_key(cookie)
+        data = self._cache.get(key)
+        if data is None:
+            try:
+                data = self._decoder(self._fernet.decrypt(cookie.encode(), ttl=self.max_age).decode())
+            except InvalidToken:
+                # invalid cookies aren't cached, super() logs a warning and creates a new session
+                return await super().load_session(request)
+            self._cache.set(key, data)
+        request[LOADED_SESSION_KEY] = data
+        return Session(None, data=data, new=False, max_age=self.max_age)
+
+    async def save_session(self, request, response, session):
+        if session.empty:
+            return await super().save_session(request, response, session)
+
+        data = {'created': session.created, 'session': dict(session)}
+        if data == request.get(LOADED_SESSION_KEY):
+            # the session was modified but ended up the same, the client already has this cookie
+            return
+
+        cookie = self._fernet.encrypt(self._encoder(data).encode()).decode()
+        self.save_cookie(response, cookie, max_age=session.max_age)
+        self._cache.set(_cookie_key(cookie), data)
@@ -16,6 +16,7 @@ from pydantic import BaseModel
 from shared.stripe_base import StripeClient
 from shared.utils import RequestError
 
+from .middleware import LazyConnection
 from .utils import JsonErrors, decrypt_json
 
 logger = logging.getLogger('nosht.stripe')
@@ -103,7 +104,6 @@ async def book_free(m: BookFreeModel, company_id: int, session: dict, app, conn:
             confirm_action_id,
             res.action_id,
         )
-        await conn.execute('SELECT check_tickets_remaining($1, $2)', res.event_id, app['settings'].ticket_ttl)
         await conn.execute('delete from waiting_list where event=$1 and user_id=$2', res.event_id, user_id)
 
     return confirm_action_id
@@ -122,6 +122,7 @@ async def get_stripe_payment_method(
         user_id,
         company_id,
     )
+    await release_conn(conn)
     stripe = StripeClient(app, stripe_secret_key)
     try:
         data = await stripe.get(f'payment_methods/{payment_method_id}')
@@ -176,6 +177,14 @@ async def stripe_refund(
     )
 
 
+async def release_conn(conn: BuildPgConnection):
+    """
+    Return a request's connection to the pool while waiting for stripe, it's checked out again if needed afterwards.
+    """
+    if isinstance(conn, LazyConnection):
+        await conn.release()
+
+
 async def stripe_webhook_body(request) -> dict:
     """
     check the signature of a stripe webhook, then decode and return the body
@@ -191,13 +200,14 @@ async def stripe_webhook_body(request) -> dict:
     except (ValueError, KeyError):
         raise JsonErrors.HTTPForbidden(message='Invalid signature')
 
+    # read the body before touching the database so no connection is held while waiting for it
+    text = await request.text()
     stripe_webhook_secret = await request['conn'].fetchval(
         'select stripe_webhook_secret from companies where id=$1', request['company_id']
     )
     if not stripe_webhook_secret:
         raise JsonErrors.HTTPBadRequest(message='stripe webhooks not configured')
 
-    text = await request.text()
     payload = f'{ts}.{text}'.encode()
     if not secrets.compare_digest(hmac.new(stripe_webhook_secret.encode(), payload, hashlib.sha256).hexdigest(), sig):
         raise JsonErrors.HTTPForbidden(message='Invalid signature')
@@ -224,48 +234,85 @@ async def stripe_payment_intent(
     if price_cents is None or price_cents < 100:
         raise JsonErrors.HTTPBadRequest(message='booking price cent < 100')
 
-    user_name, user_email, user_role, stripe_customer_id, stripe_secret_key, currency = await conn.fetchrow(
+    r = await conn.fetchrow(
         """
         SELECT
-          full_name(first_name, last_name, email) AS name, email, role, stripe_customer_id, stripe_secret_key, currency
+          full_name(first_name, last_name, email) AS name, email, role, stripe_customer_id,
+          coalesce(stripe_customer_verified_ts > now() - ($3 || ' seconds')::interval, FALSE),
+          stripe_secret_key, currency
         FROM users AS u
         JOIN companies c on u.company = c.id
         WHERE u.id=$1 AND c.id=$2
         """,
         user_id,
         company_id,
+        str(app['settings'].stripe_customer_verify_ttl),
     )
+    user_name, user_email, user_role, stripe_customer_id, customer_verified, stripe_secret_key, currency = r
+
+    await release_conn(conn)
 
     # could move the customer stuff to the worker
-    new_customer = True
     stripe = StripeClient(app, stripe_secret_key)
-    if stripe_customer_id:
+    if stripe_customer_id and not customer_verified:
         try:
             await stripe.get(f'customers/{stripe_customer_id}')
         except RequestError as e:
             # 404 is ok, it happens when the customer has been deleted, we create a new customer below
             if e.status != 404:
                 raise
+            stripe_customer_id = None
         else:
-            new_customer = False
+            await conn.execute('UPDATE users SET stripe_customer_verified_ts=now() WHERE id=$1', user_id)
 
-    if new_customer:
+    async def new_customer():
         customer = await stripe.post(
             'customers',
             email=user_email,
             description=f'{user_name} ({user_role})',
             metadata={'role': user_role, 'user_id': user_id},
         )
-        stripe_customer_id = customer['id']
-        await conn.execute('UPDATE users SET stripe_customer_id=$1 WHERE id=$2', stripe_customer_id, user_id)
-    payment_intent = await stripe.post(
-        'payment_intents',
-        idempotency_key=idempotency_key,
-        amount=price_cents,
-        currency=currency,
-        setup_future_usage='on_session',
-        customer=stripe_customer_id,
-        description=description,
-        metadata=metadata,
-    )
-    return payment_intent['client_secret']
+        await conn.execute(
+            'UPDATE users SET stripe_customer_id=$1, stripe_customer_verified_ts=now() WHERE id=$2',
+            customer['id'],
+            user_id,
+        )
+        return customer['id']
+
+    async def create_payment_intent(key: str):
+        payment_intent = await stripe.post(
+            'payment_intents',
+            idempotency_key=key,
+            amount=price_cents,
+            currency=currency,
+            setup_future_usage='on_session',
+            customer=stripe_customer_id,
+            description=description,
+            metadata=metadata,
+        )
+        return payment_intent['client_secret']
+
+    if not stripe_customer_id:
+        stripe_customer_id = await new_customer()
+        return await create_payment_intent(idempotency_key)
+
+    try:
+        return await create_payment_intent(idempotency_key)
+    except RequestError as e:
+        if not _customer_missing(e):
+            raise
+    # the customer has been deleted since it was last verified, stripe stores the failed response against the
+    # idempotency key so a new key is required
+    logger.info('stripe customer %s missing, creating a new customer', stripe_customer_id)
+    stripe_customer_id = await new_customer()
+    return await create_payment_intent(f'{idempotency_key}-new-customer')
+
+
+def _customer_missing(e: RequestError) -> bool:
+    if e.status != 400:
+        return False
+    try:
+        error = json.loads(e.text)['error']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return error.get('code') == 'resource_missing' and error.get('param') == 'customer'
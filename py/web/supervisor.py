@@ -0,0 +1,151 @@
+"""
+Pre-fork supervisor used by "./run.py web --workers N" to run the web server in multiple processes.
+
+Each worker runs its own event loop, app, postgres and redis pools and binds to the port with SO_REUSEPORT so the
+kernel balances connections between workers. Workers which die are restarted, with a backoff if they're crashing
+straight after starting.
+
+State kept in memory isn't shared between workers:
+* /api/metrics/ only reports the requests handled by the worker which served the scrape
+* the in-process caches (domain_cache, user_company_cache, event_sig_cache and single_flight) are only cleared in
+  the worker which made a change, other workers may use stale entries until they expire after their ttl
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from multiprocessing.connection import wait
+from time import time
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+from shared.db import prepare_database
+from shared.settings import Settings
+
+logger = logging.getLogger('nosht.supervisor')
+SHUTDOWN_TIMEOUT = 6
+# workers which die within this many seconds of starting are considered to be crashing on startup
+MIN_WORKER_LIFETIME = 10
+MAX_RESTART_DELAY = 60
+
+
+def run_web(settings: Settings, *, reuse_port: bool = False):
+    from .main import create_app
+
+    app = create_app(settings=settings)
+    web.run_app(
+        app,
+        port=settings.port,
+        reuse_port=reuse_port,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+        access_log=None,
+        print=lambda *args: None,
+    )
+
+
+def start_web(settings: Settings, args: List[str]):
+    """
+    Run the web server for "./run.py web", in multiple processes if "--workers N" or settings.web_workers is above 1.
+    """
+    workers = settings.web_workers
+    if '--workers' in args:
+        workers = int(args[args.index('--workers') + 1])
+    if workers > 1:
+        logger.info('running web server with %d workers...', workers)
+        Supervisor(settings, workers).run()
+    else:
+        logger.info('running web server...')
+        run_web(settings)
+
+
+def _run_worker(settings: Settings, worker_id: int):
+    # signal handlers and the event loop are inherited from the supervisor, reset them before the app starts
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    logger.info('web worker %d started, pid %d', worker_id, os.getpid())
+    run_web(settings, reuse_port=True)
+
+
+class Supervisor:
+    def __init__(self, settings: Settings, workers: int):
+        self.settings = settings
+        self.workers = workers
+        self._context = multiprocessing.get_context('fork')
+        # worker_id: (process, start time)
+        self._processes: Dict[int, Tuple[multiprocessing.Process, float]] = {}
+        # worker_id: time to restart the worker
+        self._pending: Dict[int, float] = {}
+        # worker_id: number of consecutive times the worker died straight after starting
+        self._failures: Dict[int, int] = {}
+        self._stopping = False
+
+    def run(self):
+        logger.info('starting supervisor with %d workers, pid %d', self.workers, os.getpid())
+        # done once here so workers don't race to create the database
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(prepare_database(self.settings, False))
+        finally:
+            loop.close()
+
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for worker_id in range(self.workers):
+            self._start(worker_id)
+
+        try:
+            while not self._stopping:
+                wait([p.sentinel for p, _ in self._processes.values()], timeout=1)
+                self._check_workers()
+        finally:
+            self._stop()
+
+    def _handle_signal(self, signum, frame):
+        logger.info('supervisor received %s, stopping workers...', signal.Signals(signum).name)
+        self._stopping = True
+
+    def _start(self, worker_id: int):
+        p = self._context.Process(target=_run_worker, args=(self.settings, worker_id), name=f'web-worker-{worker_id}')
+        p.start()
+        self._processes[worker_id] = p, time()
+
+    def _check_workers(self):
+        now = time()
+        for worker_id, (p, started) in list(self._processes.items()):
+            if p.is_alive() or self._stopping:
+                continue
+            del self._processes[worker_id]
+            failures = self._failures.get(worker_id, 0) + 1 if now - started < MIN_WORKER_LIFETIME else 0
+            self._failures[worker_id] = failures
+            delay = min(2 ** failures - 1, MAX_RESTART_DELAY)
+            logger.warning(
+                'web worker %d (pid %d) died with exit code %s, restarting in %ds',
+                worker_id,
+                p.pid,
+                p.exitcode,
+                delay,
+                extra={'data': {'worker_id': worker_id, 'exitcode': p.exitcode, 'failures': failures}},
+            )
+            self._pending[worker_id] = now + delay
+
+        for worker_id, restart_at in list(self._pending.items()):
+            if restart_at <= now and not self._stopping:
+                del self._pending[worker_id]
+                self._start(worker_id)
+
+    def _stop(self):
+        for p, _ in self._processes.values():
+            if p.is_alive():
+                p.terminate()
+
+        deadline = time() + SHUTDOWN_TIMEOUT + 4
+        for worker_id, (p, _) in self._processes.items():
+            p.join(max(deadline - time(), 0))
+            if p.is_alive():
+                logger.warning('web worker %d (pid %d) failed to stop, killing it', worker_id, p.pid)
+                os.kill(p.pid, signal.SIGKILL)
+                p.join()
+        logger.info('all web workers stopped')
@@ -1,10 +1,12 @@
 import datetime
+import hashlib
 import json
 import re
 from decimal import Decimal
-from typing import Any, Optional, Type, TypeVar
+from typing import Any, Optional, Set, Type, TypeVar
 from uuid import UUID
 
+from aiohttp.hdrs import ACCEPT_ENCODING, ETAG, IF_NONE_MATCH
 from aiohttp.web import HTTPRequestEntityTooLarge, Response
 from aiohttp.web_exceptions import HTTPClientError
 from cryptography.fernet import InvalidToken
@@ -16,6 +18,19 @@ from shared.utils import encrypt_json as _encrypt_json
 
 JSON_CONTENT_TYPE = 'application/json'
 HEADER_CROSS_ORIGIN = {'Access-Control-Allow-Origin': 'null'}
+COMPRESS_CONTENT_TYPES = {
+    JSON_CONTENT_TYPE,
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/plain',
+    'text/xml',
+}
+# smaller responses aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
 
 
 class ImageModel(BaseModel):
@@ -50,8 +65,22 @@ def pretty_lenient_json(data):
     return json.dumps(data, indent=2, cls=UniversalEncoder) + '\n'
 
 
-def raw_json_response(json_str, status_=200):
-    return Response(body=json_str.encode() + b'\n', status=status_, content_type=JSON_CONTENT_TYPE)
+def raw_json_response(json_str, status_=200, *, request_=None, etag_=None):
+    """
+    If request_ is passed an ETag is set, this is either etag_ or a hash of the response body, if the client
+    already has this version of the response 304 is returned instead.
+    """
+    body = json_str.encode() + b'\n'
+    headers = None
+    if request_ is not None and status_ == 200:
+        etag = etag_ or make_etag(body)
+        if etag_matches(request_, etag):
+            if is_compressible(body, JSON_CONTENT_TYPE) and preferred_encoding(request_):
+                # the 200 would be compressed so compression_middleware would have weakened its ETag
+                etag = 'W/' + _strip_weak(etag)
+            return not_modified_response(etag)
+        headers = {ETAG: etag}
+    return Response(body=body, status=status_, content_type=JSON_CONTENT_TYPE, headers=headers)
 
 
 def json_response(*, status_=200, list_=None, headers_=None, **data):
@@ -63,6 +92,40 @@ def json_response(*, status_=200, list_=None, headers_=None, **data):
     )
 
 
+def make_etag(*parts) -> str:
+    """
+    Create a strong ETag, parts can be the response body or a cheap validator which changes whenever
+    the response would, eg. a version number or updated timestamp.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+        h.update(b'\0')
+    return f'"{h.hexdigest()}"'
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(request, etag: str) -> bool:
+    """
+    Check the If-None-Match header using weak comparison, compression_middleware weakens ETags of
+    compressed responses.
+    """
+    if_none_match = request.headers.get(IF_NONE_MATCH)
+    if not if_none_match:
+        return False
+    if if_none_match.strip(' ') == '*':
+        return True
+    etag = _strip_weak(etag)
+    return any(_strip_weak(tag.strip(' ')) == etag for tag in if_none_match.split(','))
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status=304, headers={ETAG: etag})
+
+
 T = TypeVar('Model', bound=BaseModel)
 
 
@@ -116,6 +179,34 @@ def request_root(request):
     return f'{scheme}://{request.host}'
 
 
+ZERO_QUALITY = re.compile(r' *q *= *0(?:\.0*)? *')
+
+
+def accepted_encodings(request) -> Set[str]:
+    """
+    Content codings the client accepts from the Accept-Encoding header, eg. {'gzip', 'br'}.
+    """
+    encodings = set()
+    for item in request.headers.get(ACCEPT_ENCODING, '').lower().split(','):
+        name, *params = item.split(';')
+        name = name.strip(' ')
+        if name and not any(ZERO_QUALITY.fullmatch(p) for p in params):
+            encodings.add(name)
+    return encodings
+
+
+def preferred_encoding(request) -> Optional[str]:
+    """
+    Encoding compression_middleware uses for compressible responses, None if the client accepts neither brotli nor gzip.
+    """
+    accepted = accepted_encodings(request)
+    return next((e for e in ('br', 'gzip') if e in accepted), None)
+
+
+def is_compressible(body: bytes, content_type: str) -> bool:
+    return len(body) >= COMPRESS_MIN_SIZE and content_type in COMPRESS_CONTENT_TYPES
+
+
 class JsonErrors:
     class _HTTPClientErrorJson(HTTPClientError):
         custom_reason = None
@@ -146,6 +237,9 @@ class JsonErrors:
     class HTTPConflict(_HTTPClientErrorJson):
         status_code = 409
 
+    class HTTPTooManyRequests(_HTTPClientErrorJson):
+        status_code = 429
+
     class HTTP470(_HTTPClientErrorJson):
         status_code = 470
         custom_reason = 'Invalid user input'
@@ -1,13 +1,17 @@
 import base64
+import gzip
 import json
 import logging
-from datetime import date
 from secrets import compare_digest
 
+from aiohttp.hdrs import ACCEPT_ENCODING, CONTENT_ENCODING, VARY
 from aiohttp.web_exceptions import HTTPUnauthorized
-from aiohttp.web_response import Response, StreamResponse
+from aiohttp.web_response import Response
 
-from web.utils import raw_json_response
+from shared.sitemap import get_sitemap
+from web.auth import is_admin
+from web.cache import add_surrogate_keys, index_cache_key, surrogate_key
+from web.utils import accepted_encodings, raw_json_response
 
 logger = logging.getLogger('nosht.views')
 
@@ -15,8 +19,7 @@ company_sql = """
 SELECT json_build_object(
   'categories', categories,
   'highlight_events', highlight_events,
-  'company', row_to_json(company),
-  'user', user_data
+  'company', row_to_json(company)
 )
 FROM (
   SELECT coalesce(array_to_json(array_agg(row_to_json(t))), '[]') AS categories FROM (
@@ -35,8 +38,7 @@ FROM (
       e.allow_tickets,
       e.allow_donations,
       e.start_ts AT TIME ZONE e.timezone AS start_ts, e.location_name,
-      extract(epoch FROM e.duration)::int AS duration,
-      coalesce(e.ticket_limit = e.tickets_taken, FALSE) AS sold_out
+      extract(epoch FROM e.duration)::int AS duration
     FROM events AS e
     JOIN categories as c on e.category = c.id
     WHERE c.company=$1 AND status='published' AND public=TRUE AND e.highlight IS TRUE AND e.start_ts > now()
@@ -47,89 +49,64 @@ FROM (
   SELECT id, name, image, currency, stripe_public_key, footer_links
   FROM companies
   WHERE id=$1
-) AS company,
-(
-  SELECT
-    CASE WHEN $2::int IS NULL THEN (
-      null
-    )
-    ELSE (
-      SELECT row_to_json(t) AS user_data FROM (
-        SELECT id, first_name, last_name, email, role, status
-        FROM users
-        WHERE id=$2
-      ) AS t
-    )
-    END
-) AS user_data;
+) AS company;
+"""
+# details which change too often to be cached with company_sql: the user and which highlighted events are sold out
+index_extra_sql = """
+SELECT
+  (
+    SELECT row_to_json(t) FROM (
+      SELECT id, first_name, last_name, email, role, status
+      FROM users
+      WHERE id=$1
+    ) AS t
+  ),
+  (
+    SELECT coalesce(array_agg(id), '{}')
+    FROM events
+    WHERE id=ANY($2) AND ticket_limit=tickets_taken
+  );
 """
 
 
 async def index(request):
     company_id = request['company_id']
-    user_id = request['session'].get('user_id', None)
-    # TODO could cache this in redis as it's called A LOT
-    json_str = await request['conn'].fetchval(company_sql, company_id, user_id)
-    return raw_json_response(json_str)
+    conn = request['conn']
+    redis = request.app['redis']
 
+    cache_key = index_cache_key(company_id)
+    company_json = await redis.get(cache_key)
+    if company_json is None:
+        company_json = await conn.fetchval(company_sql, company_id)
+        await redis.setex(cache_key, request.app['settings'].index_cache_ttl, company_json)
+    data = json.loads(company_json)
 
-sitemap_events_sql = """
-SELECT cat.slug || '/', cat.slug || '/' || e.slug || '/', MAX(a.ts), e.highlight
-FROM actions as a
-JOIN events as e ON a.event = e.id
-JOIN categories AS cat ON e.category = cat.id
-WHERE
-  (a.type = 'create-event' OR a.type = 'edit-event') AND
-  cat.live = TRUE AND e.status = 'published' AND e.public = TRUE AND e.start_ts > now()
-GROUP BY cat.slug, e.slug, e.highlight
-"""
+    user_id = request['session'].get('user_id', None)
+    highlight_event_ids = [e['id'] for e in data['highlight_events']]
+    user_json, sold_out = None, ()
+    if user_id or highlight_event_ids:
+        user_json, sold_out = await conn.fetchrow(index_extra_sql, user_id, highlight_event_ids)
+    for e in data['highlight_events']:
+        e['sold_out'] = e['id'] in sold_out
+    data['user'] = user_json and json.loads(user_json)
+    add_surrogate_keys(request, surrogate_key('index', company_id))
+    return raw_json_response(json.dumps(data), request_=request)
 
 
 async def sitemap(request):
-    response = StreamResponse()
-    response.content_type = 'application/xml'
-    await response.prepare(request)
-
-    await response.write(
-        b'<?xml version="1.0" encoding="UTF-8"?>\n' b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    )
-    try:
-        company_domain = await request['conn'].fetchval(
-            'SELECT domain FROM companies WHERE id=$1', request['company_id']
+    xml_gz, last_modified = await get_sitemap(request['conn'], request.app['redis'], request['company_id'])
+    # Last-Modified only has second precision
+    last_modified = last_modified.replace(microsecond=0)
+    if request.if_modified_since and last_modified <= request.if_modified_since:
+        response = Response(status=304)
+    elif 'gzip' in accepted_encodings(request):
+        response = Response(
+            body=xml_gz, content_type='application/xml', headers={CONTENT_ENCODING: 'gzip', VARY: ACCEPT_ENCODING}
         )
-
-        async def write_url(uri_, latest_update_, priority):
-            await response.write(
-                (
-                    f'<url>'
-                    f'<loc>https://{company_domain}/{uri_}</loc>'
-                    f'<lastmod>{latest_update_:%Y-%m-%d}</lastmod>'
-                    f'<changefreq>daily</changefreq>'
-                    f'<priority>{priority:0.1f}</priority>'
-                    f'</url>\n'
-                ).encode()
-            )
-
-        cats = {}
-        async with request['conn'].transaction():
-            async for (cat_uri, uri, latest_update, highlight) in request['conn'].cursor(sitemap_events_sql):
-                cat_latest_update = cats.get(cat_uri)
-                if cat_latest_update is None or latest_update > cat_latest_update:
-                    cats[cat_uri] = latest_update
-
-                await write_url(uri, latest_update, 0.7 if highlight else 0.5)
-
-        for cat_uri, latest_update in cats.items():
-            await write_url(cat_uri, latest_update, 0.9)
-
-        if cats:
-            await write_url('', max(cats.values()), 1)
-        else:
-            await write_url('', date.today(), 1)
-    except Exception:  # pragma no cover
-        logger.exception('error generating sitemap')
-
-    await response.write(b'</urlset>\n')
+    else:
+        # compression_middleware takes care of other encodings and Vary
+        response = Response(body=gzip.decompress(xml_gz), content_type='application/xml')
+    response.last_modified = last_modified
     return response
 
 
@@ -151,3 +128,11 @@ async def ses_webhook(request):
         assert sns_type == 'Notification', sns_type
         await request.app['email_actor'].record_email_event(data.get('Message'))
     return Response(status=204)
+
+
+@is_admin
+async def metrics(request):
+    """
+    Request metrics for this process in prometheus text format.
+    """
+    return Response(text=request.app['metrics'].render(), content_type='text/plain', charset='utf-8')
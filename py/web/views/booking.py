@@ -1,3 +1,4 @@
+import json
 import logging
 from secrets import compare_digest
 from time import time
@@ -5,16 +6,18 @@ from typing import List, Optional
 
 from aiohttp.web_exceptions import HTTPTemporaryRedirect
 from asyncpg import CheckViolationError
-from buildpg import MultipleValues, Values
 from buildpg.asyncpg import BuildPgConnection
 from pydantic import BaseModel, EmailStr, confloat, constr, validator
 
+from shared.inventory import return_inventory, take_inventory
 from shared.utils import waiting_list_sig
-from web.actions import ActionTypes, record_action, record_action_id
+from web.actions import ActionTypes, actions_request_extra, record_action
 from web.auth import check_session, is_auth
 from web.bread import UpdateView
+from web.cache import ticket_types_cache_key
 from web.stripe import BookFreeModel, Reservation, book_free, stripe_buy_intent
 from web.utils import JsonErrors, decrypt_json, encrypt_json, json_response, raw_json_response, request_root
+from web.waiting_room import join_queue, queue_position
 
 from .events import check_event_sig
 
@@ -26,31 +29,49 @@ class UpdateViewAuth(UpdateView):
         await check_session(self.request, 'admin', 'host', 'guest')
 
 
+# ticket types are only included when $4 is true, otherwise they come from redis
+booking_info_sql = """
+SELECT
+  tickets_remaining($1, $2),
+  (
+    SELECT COUNT(*)
+    FROM tickets
+    JOIN actions AS a ON tickets.reserve_action = a.id
+    WHERE tickets.event=$1 AND a.user_id=$3 AND status='booked'
+  ),
+  CASE WHEN $4 THEN (
+    SELECT coalesce(array_to_json(array_agg(row_to_json(t))), '[]') FROM (
+      SELECT id, name, price::float
+      FROM ticket_types
+      WHERE event=$1 AND mode='ticket' AND active=TRUE
+      ORDER BY id
+    ) AS t
+  ) END
+"""
+
+
 @is_auth
 async def booking_info(request):
+    """
+    Availability and ticket types for the booking modal, read only and one query as it's requested each time the
+    modal is opened, ticket types are cached in redis and cleared by clear_event_cache.
+    """
     event_id = await check_event_sig(request)
 
-    conn: BuildPgConnection = request['conn']
+    redis = request.app['redis']
     settings = request.app['settings']
-    tickets_remaining = await conn.fetchval('SELECT check_tickets_remaining($1, $2)', event_id, settings.ticket_ttl)
-    existing_tickets = await conn.fetchval(
-        """
-        SELECT COUNT(*)
-        FROM tickets
-        JOIN actions AS a ON tickets.reserve_action = a.id
-        WHERE tickets.event=$1 AND a.user_id=$2 AND status='booked'
-        """,
-        event_id,
-        request['session']['user_id'],
-    )
-    ticket_types = await conn.fetch(
-        "SELECT id, name, price::float FROM ticket_types WHERE event=$1 AND mode='ticket' AND active=TRUE ORDER BY id",
-        event_id,
+    cache_key = ticket_types_cache_key(event_id)
+    ticket_types_json = await redis.get(cache_key)
+    tickets_remaining, existing_tickets, db_ticket_types_json = await request['conn'].fetchrow(
+        booking_info_sql, event_id, settings.ticket_ttl, request['session']['user_id'], ticket_types_json is None
     )
+    if ticket_types_json is None:
+        ticket_types_json = db_ticket_types_json
+        await redis.setex(cache_key, settings.event_cache_ttl, ticket_types_json)
     return json_response(
         tickets_remaining=tickets_remaining if (tickets_remaining and tickets_remaining < 10) else None,
         existing_tickets=existing_tickets or 0,
-        ticket_types=[dict(tt) for tt in ticket_types],
+        ticket_types=json.loads(ticket_types_json),
     )
 
 
@@ -71,7 +92,7 @@ FROM (
 async def donating_info(request):
     event_id = await check_event_sig(request)
     json_str = await request['conn'].fetchval(get_donation_ticket_types, event_id)
-    return raw_json_response(json_str)
+    return raw_json_response(json_str, request_=request)
 
 
 class TicketModel(BaseModel):
@@ -93,6 +114,7 @@ class ReserveTickets(UpdateViewAuth):
         tickets: List[TicketModel]
         ticket_type: int
         custom_amount: Optional[confloat(ge=1, le=1000)] = None
+        admission_token: str = None
 
         @validator('tickets')
         def check_ticket_count(cls, v):
@@ -100,7 +122,7 @@ class ReserveTickets(UpdateViewAuth):
                 raise ValueError('at least one ticket must be purchased')
             return v
 
-    async def execute(self, m: Model):  # noqa: C901 (ignore complexity)
+    async def execute(self, m: Model):
         event_id = int(self.request.match_info['id'])
         ticket_count = len(m.tickets)
 
@@ -109,100 +131,55 @@ class ReserveTickets(UpdateViewAuth):
 
         user_id = self.session['user_id']
 
-        status, external_ticket_url, event_name, cover_costs_percentage = await self.conn.fetchrow(
-            """
-            SELECT e.status, e.external_ticket_url, e.name, c.cover_costs_percentage
-            FROM events AS e
-            JOIN categories c on e.category = c.id
-            WHERE c.company=$1 AND e.id=$2
-            """,
-            self.request['company_id'],
-            event_id,
-        )
-
-        if status != 'published':
-            raise JsonErrors.HTTPBadRequest(message='Event not published')
-
-        if external_ticket_url is not None:
-            raise JsonErrors.HTTPBadRequest(message='Cannot reserve ticket for an externally ticketed event')
-
-        r = await self.conn.fetchrow(
-            'SELECT price FROM ticket_types WHERE event=$1 AND active=TRUE AND id=$2', event_id, m.ticket_type,
-        )
-        if not r:
-            raise JsonErrors.HTTPBadRequest(message='Ticket type not found')
-        item_price, *_ = r
-
-        if self.settings.ticket_reservation_precheck:  # should only be false during CheckViolationError tests
-            tickets_remaining = await self.conn.fetchval(
-                'SELECT check_tickets_remaining($1, $2)', event_id, self.settings.ticket_ttl
+        position = await queue_position(self.app, event_id, user_id, m.admission_token)
+        if position and not position.admitted:
+            raise JsonErrors.HTTPTooManyRequests(
+                message='not yet admitted from the waiting room',
+                waiting_room=True,
+                ahead=position.ahead,
+                retry_after=position.retry_after,
             )
-            if tickets_remaining is not None and ticket_count > tickets_remaining:
-                raise JsonErrors.HTTP470(
-                    message=f'only {tickets_remaining} tickets remaining', tickets_remaining=tickets_remaining
-                )
 
-        total_price, item_extra_donated = None, None
+        inventory_slots = 0
+        if self.settings.redis_inventory:
+            r = await take_inventory(self.app['redis'], event_id, m.ticket_type, ticket_count)
+            if r:
+                slots, slots_remaining = r
+                if slots_remaining < 0:
+                    tickets_remaining = slots_remaining + slots
+                    raise JsonErrors.HTTP470(
+                        message=f'only {tickets_remaining} tickets remaining', tickets_remaining=tickets_remaining
+                    )
+                inventory_slots = slots
+
+        try:
+            r = await self.reserve(m, user_id, event_id)
+        except BaseException:
+            # including cancellation, the slots were taken from the redis counter but not from the event
+            await return_inventory(self.app['redis'], event_id, inventory_slots)
+            raise
+
+        item_price, item_extra_donated = r['item_price'], r['item_extra_donated']
+        total_price = None
         if item_price:
             total_price = item_price * ticket_count
-            if cover_costs_percentage and m.tickets[0].cover_costs:
-                item_extra_donated = item_price * cover_costs_percentage / 100
+            if item_extra_donated:
                 total_price += item_extra_donated * ticket_count
 
-        try:
-            async with self.conn.transaction():
-                update_user_preferences = await self.create_users(m.tickets)
-
-                action_id = await record_action_id(
-                    self.request, user_id, ActionTypes.reserve_tickets, event_id=event_id
-                )
-                ticket_values = [
-                    Values(
-                        email=t.email and t.email.lower(),
-                        first_name=t.first_name,
-                        last_name=t.last_name,
-                        extra_info=t.extra_info or None,
-                    )
-                    for t in m.tickets
-                ]
-
-                await self.conn.execute_b(
-                    """
-                    WITH v (email, first_name, last_name, extra_info) AS (VALUES :values)
-                    INSERT INTO tickets (event, reserve_action, ticket_type, price, extra_donated, user_id,
-                      first_name, last_name, extra_info)
-                    SELECT :event, :reserve_action, :ticket_type, :price, :extra_donated, u.id,
-                      v.first_name, v.last_name, v.extra_info FROM v
-                    LEFT JOIN users AS u ON v.email=u.email AND u.company=:company_id
-                    """,
-                    event=event_id,
-                    reserve_action=action_id,
-                    ticket_type=m.ticket_type,
-                    price=item_price,
-                    extra_donated=item_extra_donated,
-                    company_id=self.request['company_id'],
-                    values=MultipleValues(*ticket_values),
-                )
-                await self.conn.execute('SELECT check_tickets_remaining($1, $2)', event_id, self.settings.ticket_ttl)
-        except CheckViolationError as exc:
-            if exc.constraint_name != 'ticket_limit_check':  # pragma: no branch
-                raise  # pragma: no cover
-            logger.warning('CheckViolationError: %s', exc)
-            raise JsonErrors.HTTPBadRequest(message='insufficient tickets remaining')
-
+        action_id = r['reserve_action_id']
         res = Reservation(
             user_id=user_id,
             action_id=action_id,
             price_cent=total_price and int(total_price * 100),
             event_id=event_id,
             ticket_count=ticket_count,
-            event_name=event_name,
+            event_name=r['event_name'],
         )
         if total_price:
             client_secret = await stripe_buy_intent(res, self.request['company_id'], self.app, self.conn)
         else:
             client_secret = None
-        if update_user_preferences:
+        if r['update_user_preferences']:
             # has to happen after the transactions is finished
             await self.app['donorfy_actor'].update_user(self.request['session']['user_id'], update_user=False)
         return {
@@ -216,30 +193,54 @@ class ReserveTickets(UpdateViewAuth):
             'client_secret': client_secret,
         }
 
-    async def create_users(self, tickets: List[TicketModel]):
-        user_values = [
-            Values(company=self.request['company_id'], role='guest', email=t.email.lower()) for t in tickets if t.email
-        ]
-        if not user_values:
-            return
-
-        await self.conn.execute_b(
-            """
-            INSERT INTO users AS u (:values__names) VALUES :values
-            ON CONFLICT (company, email) DO NOTHING
-            """,
-            values=MultipleValues(*user_values),
-        )
-        if tickets[0].allow_marketing is not None and tickets[0].email == await self._user_email():
-            await self.conn.execute(
-                'UPDATE users SET allow_marketing=$1 WHERE id=$2',
-                tickets[0].allow_marketing,
-                self.request['session']['user_id'],
+    async def reserve(self, m: Model, user_id: int, event_id: int):
+        """
+        Check the event and ticket type then reserve the tickets with a single query, see reserve_tickets in logic.sql.
+
+        Reservations for the same event wait for each other, the time waited is recorded in app['metrics'].
+        """
+        try:
+            r = await self.conn.fetchrow(
+                'SELECT * FROM reserve_tickets($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)',
+                self.request['company_id'],
+                user_id,
+                event_id,
+                m.ticket_type,
+                self.settings.ticket_ttl,
+                self.settings.ticket_reservation_precheck,  # should only be false during CheckViolationError tests
+                m.tickets[0].cover_costs,
+                m.tickets[0].allow_marketing,
+                json.dumps(actions_request_extra(self.request)),
+                [t.email for t in m.tickets],
+                [t.first_name for t in m.tickets],
+                [t.last_name for t in m.tickets],
+                [t.extra_info or None for t in m.tickets],
             )
-            return True
+        except CheckViolationError as exc:
+            if exc.constraint_name != 'ticket_limit_check':  # pragma: no branch
+                raise  # pragma: no cover
+            logger.warning('CheckViolationError: %s', exc)
+            raise JsonErrors.HTTPBadRequest(message='insufficient tickets remaining')
 
-    async def _user_email(self):
-        return await self.conn.fetchval('SELECT email FROM users WHERE id=$1', self.request['session']['user_id'])
+        if r['lock_wait'] is not None:
+            self.app['metrics'].record_booking_lock_wait(self.request.match_info.route.name, r['lock_wait'])
+        error_code = r['error_code']
+        if error_code == 'event-not-found':
+            raise JsonErrors.HTTPNotFound(message='Event not found')
+        elif error_code == 'event-not-published':
+            raise JsonErrors.HTTPBadRequest(message='Event not published')
+        elif error_code == 'external-ticketing':
+            raise JsonErrors.HTTPBadRequest(message='Cannot reserve ticket for an externally ticketed event')
+        elif error_code == 'ticket-type-not-found':
+            raise JsonErrors.HTTPBadRequest(message='Ticket type not found')
+        elif error_code == 'event-busy':
+            raise JsonErrors.HTTPTooManyRequests(message='event busy, please try again', retry_after=1)
+        elif error_code == 'tickets-remaining':
+            tickets_remaining = r['tickets_remaining']
+            raise JsonErrors.HTTP470(
+                message=f'only {tickets_remaining} tickets remaining', tickets_remaining=tickets_remaining
+            )
+        return r
 
 
 class CancelReservedTickets(UpdateView):
@@ -251,14 +252,22 @@ class CancelReservedTickets(UpdateView):
         res = Reservation(**decrypt_json(self.app, m.booking_token))
         async with self.conn.transaction():
             user_id = await self.conn.fetchval('SELECT user_id FROM actions WHERE id=$1', res.action_id)
-            v = await self.conn.execute(
-                "DELETE FROM tickets WHERE reserve_action=$1 AND status='reserved'", res.action_id
+            deleted, slots = await self.conn.fetchrow(
+                """
+                WITH t AS (
+                  DELETE FROM tickets WHERE reserve_action=$1 AND status='reserved'
+                  RETURNING ticket_type, status, reservation_expired
+                )
+                SELECT COUNT(*), coalesce(SUM(ticket_slots(ticket_type, status, reservation_expired)), 0) FROM t
+                """,
+                res.action_id,
             )
-            if v == 'DELETE 0':
+            if deleted == 0:
                 # no tickets were deleted
                 raise JsonErrors.HTTPBadRequest(message='no tickets deleted')
-            await self.conn.execute('SELECT check_tickets_remaining($1, $2)', res.event_id, self.settings.ticket_ttl)
             await record_action(self.request, user_id, ActionTypes.cancel_reserved_tickets, event_id=res.event_id)
+        if self.settings.redis_inventory:
+            await return_inventory(self.app['redis'], res.event_id, slots)
 
 
 class BookFreeTickets(UpdateView):
@@ -290,6 +299,27 @@ async def waiting_list_add(request):
     return json_response(status='ok')
 
 
+@is_auth
+async def waiting_room_join(request):
+    event_id = int(request.match_info['id'])
+    user_id = request['session']['user_id']
+    token = await join_queue(request.app, event_id, user_id)
+    if token is None:
+        # no waiting room, the guest can book straight away
+        return json_response(token=None, admitted=True, ahead=0, retry_after=0)
+    position = await queue_position(request.app, event_id, user_id, token)
+    return json_response(token=token, **position._asdict())
+
+
+@is_auth
+async def waiting_room_position(request):
+    event_id = int(request.match_info['id'])
+    position = await queue_position(request.app, event_id, request['session']['user_id'], request.query.get('token'))
+    if position is None:
+        return json_response(admitted=True, ahead=0, retry_after=0)
+    return json_response(**position._asdict())
+
+
 async def waiting_list_remove(request):
     event_id = int(request.match_info['id'])
     user_id = int(request.match_info['user_id'])
@@ -1,4 +1,8 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Tuple
 
 from buildpg import V
 from buildpg.asyncpg import BuildPgConnection
@@ -9,36 +13,75 @@ from shared.images import delete_image, list_images, upload_background
 from shared.utils import slugify
 from web.auth import check_session, is_admin, is_admin_or_host
 from web.bread import Bread
+from web.cache import add_surrogate_keys, clear_event_cache, clear_index_cache, purge_surrogate_keys, surrogate_key
 from web.utils import ImageModel, JsonErrors, json_response, parse_request, raw_json_response, request_image
 
+# events in a category are returned in pages, the "next" cursor is given when there might be more events
+CATEGORY_PAGE_SIZE = 50
+# keyset pagination on (start_ts, id) using the event_category_listing index, the aggregates are ordered so the
+# last id and last_ts come from the same row
 category_public_sql = """
-SELECT json_build_object('events', events)
+SELECT
+  (SELECT id FROM categories WHERE company=$1 AND slug=$2),
+  coalesce(array_agg(t.id ORDER BY t.start_ts, t.id), '{}'),
+  (array_agg(t.start_ts ORDER BY t.start_ts DESC, t.id DESC))[1],
+  coalesce(array_to_json(array_agg(t.event ORDER BY t.start_ts, t.id)), '[]')
 FROM (
-  SELECT coalesce(array_to_json(array_agg(json_strip_nulls(row_to_json(t)))), '[]') AS events FROM (
-    SELECT e.id, e.name, c.slug as cat_slug, e.slug,
-      coalesce(e.image, c.image) AS image,
-      e.secondary_image,
-      e.short_description,
-      e.location_name,
-      e.allow_tickets,
-      e.allow_donations,
-      e.start_ts AT TIME ZONE e.timezone AS start_ts,
-      extract(epoch FROM e.duration)::int AS duration,
-      coalesce(e.ticket_limit = e.tickets_taken, FALSE) AS sold_out
-    FROM events AS e
-    JOIN categories as c on e.category = c.id
-    WHERE c.company=$1 AND c.slug=$2 AND status='published' AND public=TRUE AND e.start_ts > now()
-    ORDER BY start_ts
-  ) AS t
-) AS events;
+  SELECT e.id, e.start_ts, json_strip_nulls(json_build_object(
+    'id', e.id,
+    'name', e.name,
+    'cat_slug', c.slug,
+    'slug', e.slug,
+    'image', coalesce(e.image, c.image),
+    'secondary_image', e.secondary_image,
+    'short_description', e.short_description,
+    'location_name', e.location_name,
+    'allow_tickets', e.allow_tickets,
+    'allow_donations', e.allow_donations,
+    'start_ts', e.start_ts AT TIME ZONE e.timezone,
+    'duration', extract(epoch FROM e.duration)::int,
+    'sold_out', coalesce(e.ticket_limit = e.tickets_taken, FALSE)
+  )) AS event
+  FROM events AS e
+  JOIN categories AS c ON e.category = c.id
+  WHERE c.company=$1 AND c.slug=$2 AND e.status='published' AND e.public=TRUE AND e.start_ts > now() AND
+    e.start_ts >= $3 AND (e.start_ts, e.id) > ($3, $4)
+  ORDER BY e.start_ts, e.id
+  LIMIT $5
+) AS t
 """
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(start_ts: datetime, event_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{(start_ts - EPOCH) // MICROSECOND}:{event_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        ts, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return EPOCH + int(ts) * MICROSECOND, int(event_id)
+    except (ValueError, OverflowError):
+        raise JsonErrors.HTTPBadRequest(message='invalid cursor')
 
 
 async def category_public(request):
     company_id = request['company_id']
     category_slug = request.match_info['category']
-    json_str = await request['conn'].fetchval(category_public_sql, company_id, category_slug)
-    return raw_json_response(json_str)
+    cursor = request.query.get('after')
+    after_ts, after_id = decode_cursor(cursor) if cursor else (EPOCH, 0)
+    category_id, event_ids, last_ts, events_json = await request['conn'].fetchrow(
+        category_public_sql, company_id, category_slug, after_ts, after_id, CATEGORY_PAGE_SIZE
+    )
+    if category_id:
+        add_surrogate_keys(
+            request,
+            surrogate_key('category', category_id),
+            *(surrogate_key('event', event_id) for event_id in event_ids),
+        )
+    next_cursor = encode_cursor(last_ts, event_ids[-1]) if len(event_ids) == CATEGORY_PAGE_SIZE else None
+    return raw_json_response(f'{{"events": {events_json}, "next": {json.dumps(next_cursor)}}}', request_=request)
 
 
 cat_image_sql = """
@@ -82,6 +125,13 @@ async def _check_image_exists(request, m: ImageModel):
         raise JsonErrors.HTTPBadRequest(message='image does not exist')
 
 
+async def _clear_category_cache(request, cat_id: int):
+    await clear_index_cache(request.app, request['company_id'])
+    event_ids = await request['conn'].fetch('SELECT id FROM events WHERE category=$1', cat_id)
+    await clear_event_cache(request.app, *(r[0] for r in event_ids))
+    await purge_surrogate_keys(request.app, surrogate_key('category', cat_id))
+
+
 @is_admin
 async def category_set_image(request):
     m = await parse_request(request, ImageModel)
@@ -89,6 +139,7 @@ async def category_set_image(request):
 
     cat_id = int(request.match_info['cat_id'])
     await request['conn'].execute('UPDATE categories SET image = $1 WHERE id = $2', m.image, cat_id)
+    await _clear_category_cache(request, cat_id)
     return json_response(status='success')
 
 
@@ -169,3 +220,20 @@ class CategoryBread(Bread):
     async def prepare_add_data(self, data):
         data.update(company=self.request['company_id'], slug=slugify(data['name']))
         return data
+
+    async def add_execute(self, **data):
+        pk = await super().add_execute(**data)
+        await clear_index_cache(self.app, self.request['company_id'])
+        return pk
+
+    async def edit_execute(self, pk, **data):
+        await super().edit_execute(pk, **data)
+        await _clear_category_cache(self.request, pk)
+
+    async def delete_execute(self, pk):
+        # events are deleted with the category so their ids have to be found first
+        event_ids = await self.conn.fetch('SELECT id FROM events WHERE category=$1', pk)
+        await super().delete_execute(pk)
+        await clear_index_cache(self.app, self.request['company_id'])
+        await clear_event_cache(self.app, *(r[0] for r in event_ids))
+        await purge_surrogate_keys(self.app, surrogate_key('category', pk))
@@ -10,6 +10,7 @@ from shared.images import delete_image, upload_background, upload_other
 from shared.utils import Currencies
 from web.auth import check_session, is_admin
 from web.bread import Bread
+from web.cache import clear_index_cache, purge_surrogate_keys, surrogate_key
 from web.utils import JsonErrors, json_response, parse_request, request_image
 
 
@@ -59,6 +60,13 @@ class CompanyBread(Bread):
             data['email_reply_to'] = str(data['email_reply_to'])
         return data
 
+    async def edit_execute(self, pk, **data):
+        await super().edit_execute(pk, **data)
+        await clear_index_cache(self.app, pk)
+        await purge_surrogate_keys(self.app, surrogate_key('company', pk))
+        if 'domain' in data:
+            self.app['domain_cache'].clear()
+
 
 LOGO_SIZE = 256, 256
 upload_logo = partial(upload_other, req_size=LOGO_SIZE)
@@ -80,6 +88,7 @@ async def company_upload(request):
     image_url = await method(content, upload_path=upload_path, settings=request.app['settings'])
 
     await request['conn'].execute_b('UPDATE companies SET :set WHERE id=:id', set=V(field_name) == image_url, id=co_id)
+    await clear_index_cache(request.app, co_id)
 
     if old_image:
         await delete_image(old_image, request.app['settings'])
@@ -105,4 +114,5 @@ async def company_set_footer_link(request):
     m = await parse_request(request, FooterLinksModel)
     v = json.dumps([l.dict() for l in m.links], separators=(',', ':'))
     await request['conn'].execute('UPDATE companies SET footer_links=$1 WHERE id=$2', v, request['company_id'])
+    await clear_index_cache(request.app, request['company_id'])
     return json_response(status='success')
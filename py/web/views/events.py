@@ -1,5 +1,6 @@
 import hashlib
 import hmac
+import json
 import logging
 from datetime import datetime, timedelta, timezone
 from enum import Enum
@@ -17,10 +18,20 @@ from pydantic import BaseModel, HttpUrl, PositiveInt, condecimal, conint, constr
 from pytz.tzinfo import StaticTzInfo
 
 from shared.images import delete_image, upload_background, upload_force_shape, upload_other
+from shared.inventory import clear_inventory, return_inventory
 from shared.utils import pseudo_random_str, slugify, ticket_id_signed
+from shared.waiting_room import set_waiting_room
 from web.actions import ActionTypes, record_action, record_action_id
 from web.auth import check_session, is_admin, is_admin_or_host
 from web.bread import Bread, Method, UpdateView
+from web.cache import (
+    add_surrogate_keys,
+    clear_event_cache,
+    clear_index_cache,
+    event_cache_key,
+    purge_surrogate_keys,
+    surrogate_key,
+)
 from web.stripe import stripe_refund
 from web.utils import (
     ImageModel,
@@ -45,9 +56,7 @@ WHERE c.company = $1 AND c.slug = $2 AND e.slug = $3 AND e.status = 'published'
 event_info_sql = """
 SELECT json_build_object(
   'event', row_to_json(event),
-  'ticket_types', ticket_types,
-  'existing_tickets', existing_tickets,
-  'on_waiting_list', on_waiting_list
+  'ticket_types', ticket_types
 )
 FROM (
   SELECT e.id,
@@ -72,11 +81,6 @@ FROM (
          e.start_ts AT TIME ZONE e.timezone AS start_ts,
          tz_abbrev(e.start_ts, e.timezone) as tz,
          extract(epoch FROM e.duration)::int AS duration,
-         CASE
-           WHEN e.ticket_limit IS NULL THEN NULL
-           WHEN e.ticket_limit - e.tickets_taken >= 10 THEN NULL
-           ELSE e.ticket_limit - e.tickets_taken
-         END AS tickets_available,
          h.id AS host_id,
          h.first_name || ' ' || h.last_name AS host_name,
          c.id AS category_id,
@@ -100,18 +104,39 @@ FROM (
     WHERE e.id = $1 AND tt.active = TRUE AND tt.custom_amount = FALSE
     ORDER BY tt.price
   ) AS t
-) AS ticket_types,
-(
-  SELECT count(*) AS existing_tickets
-  FROM tickets t
-  JOIN actions AS a ON t.reserve_action = a.id
-  WHERE t.event=$1 AND t.status='booked' AND a.user_id=$2
-) AS existing_tickets,
-(
-  SELECT count(*) > 0 AS on_waiting_list
-  FROM waiting_list
-  WHERE event=$1 AND user_id=$2
-) AS on_waiting_list
+) AS ticket_types
+"""
+# details which can't be cached with event_info_sql: tickets_available changes with every booking
+event_tickets_available_sql = """
+SELECT
+  CASE
+    WHEN ticket_limit IS NULL THEN NULL
+    WHEN ticket_limit - tickets_taken >= 10 THEN NULL
+    ELSE ticket_limit - tickets_taken
+  END AS tickets_available
+FROM events
+WHERE id = $1
+"""
+event_user_info_sql = """
+SELECT
+  CASE
+    WHEN ticket_limit IS NULL THEN NULL
+    WHEN ticket_limit - tickets_taken >= 10 THEN NULL
+    ELSE ticket_limit - tickets_taken
+  END AS tickets_available,
+  (
+    SELECT count(*)
+    FROM tickets t
+    JOIN actions AS a ON t.reserve_action = a.id
+    WHERE t.event=$1 AND t.status='booked' AND a.user_id=$2
+  ) AS existing_tickets,
+  (
+    SELECT count(*) > 0
+    FROM waiting_list
+    WHERE event=$1 AND user_id=$2
+  ) AS on_waiting_list
+FROM events
+WHERE id = $1
 """
 
 
@@ -129,34 +154,72 @@ class TzInfo(StaticTzInfo):
 
 
 async def check_event_sig(request):
+    """
+    Find the id of a published event from the url and check the signature for events which aren't public.
+
+    The event id and expected signature are cached in app['event_sig_cache'] as booking an event involves a few
+    requests which all need this, the cache is cleared by clear_event_cache. Events which aren't found aren't
+    cached so requests for random urls can't fill the cache.
+    """
     company_id = request['company_id']
     category_slug = request.match_info['category']
     event_slug = request.match_info['event']
-    r = await request['conn'].fetchrow(event_id_public_sql, company_id, category_slug, event_slug)
-
-    # so we always do the hashing even for an event that does exist to avoid timing attack, probably over kill
-    if r:
-        event_id, event_is_public = r
-    else:
-        event_id, event_is_public = 0, False
-
-    if not event_is_public:
+    cache = request.app['event_sig_cache']
+    key = company_id, category_slug, event_slug
+    cached = cache.get(key)
+    if cached is None:
+        r = await request['conn'].fetchrow(event_id_public_sql, company_id, category_slug, event_slug)
+        # the signature is also calculated for events which don't exist to avoid a timing attack, probably over kill
+        event_id, event_is_public = r or (0, False)
+        if event_is_public:
+            sig = None
+        else:
+            sig = hmac.new(
+                request.app['settings'].auth_key.encode(),
+                f'/{category_slug}/{event_slug}/'.encode(),
+                digestmod=hashlib.md5,
+            ).hexdigest()
+        cached = event_id, sig
+        if r:
+            cache.set(key, cached)
+
+    event_id, sig = cached
+    if sig is not None:
         url_sig = request.match_info.get('sig')
-        if not url_sig:
-            raise JsonErrors.HTTPNotFound(message='event not found')
-        sig = hmac.new(
-            request.app['settings'].auth_key.encode(), f'/{category_slug}/{event_slug}/'.encode(), digestmod=hashlib.md5
-        ).hexdigest()
-        if not compare_digest(url_sig, sig):
+        if not url_sig or not compare_digest(url_sig, sig):
             raise JsonErrors.HTTPNotFound(message='event not found')
     return event_id
 
 
 async def event_get(request):
     event_id = await check_event_sig(request)
-    user_id = request['session'].get('user_id', 0)
-    json_str = await request['conn'].fetchval(event_info_sql, event_id, user_id)
-    return raw_json_response(json_str)
+    conn = request['conn']
+    redis = request.app['redis']
+
+    cache_key = event_cache_key(event_id)
+    event_json = await redis.get(cache_key)
+    if event_json is None:
+        event_json = await conn.fetchval(event_info_sql, event_id)
+        await redis.setex(cache_key, request.app['settings'].event_cache_ttl, event_json)
+    data = json.loads(event_json)
+    if data['event'] is None:
+        # private event with a valid signature which isn't published
+        raise JsonErrors.HTTPNotFound(message='event not found')
+
+    user_id = request['session'].get('user_id')
+    if user_id:
+        tickets_available, existing_tickets, on_waiting_list = await conn.fetchrow(
+            event_user_info_sql, event_id, user_id
+        )
+    else:
+        tickets_available = await conn.fetchval(event_tickets_available_sql, event_id)
+        existing_tickets, on_waiting_list = 0, False
+    data['event']['tickets_available'] = tickets_available
+    data.update(existing_tickets=existing_tickets, on_waiting_list=on_waiting_list)
+    add_surrogate_keys(
+        request, surrogate_key('event', event_id), surrogate_key('category', data['event']['category_id'])
+    )
+    return raw_json_response(json.dumps(data), request_=request)
 
 
 category_sql = """
@@ -261,6 +324,8 @@ class EventBread(Bread):
         'e.description_intro',
         'e.external_ticket_url',
         'e.external_donation_url',
+        'e.booking_nowait',
+        'e.waiting_room_rate',
         'e.host',
         'e.timezone',
         Func('full_name', V('uh.first_name'), V('uh.last_name'), V('uh.email')).as_('host_name'),
@@ -391,6 +456,8 @@ class EventBread(Bread):
             action_id = await record_action_id(
                 self.request, self.request['session']['user_id'], ActionTypes.create_event, event_id=pk
             )
+        await clear_index_cache(self.app, self.request['company_id'])
+        await purge_surrogate_keys(self.app, surrogate_key('category', data['category']))
         await self.app['email_actor'].send_event_created(action_id)
         await self.app['donorfy_actor'].event_created(pk)
         return pk
@@ -419,8 +486,16 @@ class EventBread(Bread):
                 event_id=pk,
                 subtype='edit-event',
             )
+            await clear_index_cache(self.app, self.request['company_id'])
+            await clear_event_cache(self.app, pk)
+            await clear_inventory(self.app['redis'], pk)
             await self.app['email_actor'].send_tickets_available(pk)
 
+    async def delete_execute(self, pk):
+        await super().delete_execute(pk)
+        await clear_index_cache(self.app, self.request['company_id'])
+        await clear_event_cache(self.app, pk)
+
 
 async def _check_event_permissions(request, check_upcoming=False):
     event_id = int(request.match_info['id'])
@@ -524,7 +599,7 @@ class CancelTickets(UpdateView):
         ticket_id = int(self.request.match_info['tid'])
         r = await self.conn.fetchrow(
             """
-            select a.type, t.price, a.extra->>'charge_id'
+            select a.type, t.price, a.extra->>'charge_id', ticket_slots(t.ticket_type, t.status, t.reservation_expired)
             from tickets as t
             join actions as a on t.booked_action = a.id
             where t.event = $1 and t.id = $2 and t.status = 'booked'
@@ -534,7 +609,7 @@ class CancelTickets(UpdateView):
         )
         if not r:
             raise JsonErrors.HTTPNotFound(message='Ticket not found')
-        booking_type, price, charge_id = r
+        booking_type, price, charge_id, slots = r
         if m.refund_amount is not None:
             if booking_type != ActionTypes.buy_tickets:
                 raise JsonErrors.HTTPBadRequest(message='Refund not possible unless ticket was bought through stripe.')
@@ -546,7 +621,6 @@ class CancelTickets(UpdateView):
             await self.conn.execute(
                 "update tickets set status='cancelled', cancel_action=$1 where id=$2", action_id, ticket_id
             )
-            await self.conn.execute('SELECT check_tickets_remaining($1, $2)', event_id, self.settings.ticket_ttl)
             if m.refund_amount is not None:
                 await stripe_refund(
                     refund_charge_id=charge_id,
@@ -557,6 +631,8 @@ class CancelTickets(UpdateView):
                     app=self.app,
                     conn=self.conn,
                 )
+        if self.settings.redis_inventory:
+            await return_inventory(self.app['redis'], event_id, slots)
         await self.app['email_actor'].send_tickets_available(event_id)
 
 
@@ -769,6 +845,8 @@ class SetTicketTypes(UpdateView):
                 event_id=event_id,
                 subtype='edit-ticket-types',
             )
+        await clear_event_cache(self.app, event_id)
+        await clear_inventory(self.app['redis'], event_id)
 
 
 get_image_sql = """
@@ -813,6 +891,8 @@ async def set_event_image_new(request):
     await record_action(
         request, request['session']['user_id'], ActionTypes.edit_event, event_id=event_id, subtype='set-image-new'
     )
+    await clear_index_cache(request.app, request['company_id'])
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -829,6 +909,8 @@ async def set_event_image_existing(request):
     await record_action(
         request, request['session']['user_id'], ActionTypes.edit_event, event_id=event_id, subtype='set-image-existing'
     )
+    await clear_index_cache(request.app, request['company_id'])
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -859,6 +941,8 @@ async def set_event_secondary_image(request):
             event_id=event_id,
             subtype='set-image-secondary',
         )
+    await clear_index_cache(request.app, request['company_id'])
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -879,6 +963,8 @@ async def remove_event_secondary_image(request):
             event_id=event_id,
             subtype='remove-image-secondary',
         )
+    await clear_index_cache(request.app, request['company_id'])
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -909,6 +995,7 @@ async def set_event_description_image(request):
             event_id=event_id,
             subtype='set-image-description',
         )
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -929,6 +1016,7 @@ async def remove_event_description_image(request):
             event_id=event_id,
             subtype='remove-image-description',
         )
+    await clear_event_cache(request.app, event_id)
     return json_response(status='success')
 
 
@@ -951,8 +1039,8 @@ class SetEventStatus(UpdateView):
 
     async def execute(self, m: Model):
         event_id = int(self.request.match_info['id'])
-        await self.conn.execute_b(
-            'UPDATE events SET status=:status WHERE id=:id', status=m.status.value, id=event_id,
+        category_id = await self.conn.fetchval_b(
+            'UPDATE events SET status=:status WHERE id=:id RETURNING category', status=m.status.value, id=event_id,
         )
         await record_action(
             self.request,
@@ -961,6 +1049,57 @@ class SetEventStatus(UpdateView):
             event_id=event_id,
             subtype='change-status',
         )
+        await clear_index_cache(self.app, self.request['company_id'])
+        await clear_event_cache(self.app, event_id)
+        # the event is added to or removed from the category's list of events
+        await purge_surrogate_keys(self.app, surrogate_key('category', category_id))
+
+
+class SetWaitingRoom(UpdateView):
+    class Model(BaseModel):
+        # guests admitted per second, None removes the waiting room
+        rate: conint(ge=1) = None
+
+    async def check_permissions(self):
+        await check_session(self.request, 'admin', 'host')
+        await _check_event_permissions(self.request, check_upcoming=True)
+
+    async def execute(self, m: Model):
+        event_id = int(self.request.match_info['id'])
+        start_ts = await self.conn.fetchval(
+            'UPDATE events SET waiting_room_rate=$1 WHERE id=$2 RETURNING start_ts', m.rate, event_id
+        )
+        await set_waiting_room(self.app['redis'], event_id, m.rate, start_ts)
+        await record_action(
+            self.request,
+            self.request['session']['user_id'],
+            ActionTypes.edit_event,
+            event_id=event_id,
+            subtype='set-waiting-room',
+            rate=m.rate,
+        )
+
+
+class SetBookingNowait(UpdateView):
+    class Model(BaseModel):
+        # reservations fail with a 429 rather than waiting for others to the same event, see reserve_tickets
+        nowait: bool
+
+    async def check_permissions(self):
+        await check_session(self.request, 'admin', 'host')
+        await _check_event_permissions(self.request, check_upcoming=True)
+
+    async def execute(self, m: Model):
+        event_id = int(self.request.match_info['id'])
+        await self.conn.execute('UPDATE events SET booking_nowait=$1 WHERE id=$2', m.nowait, event_id)
+        await record_action(
+            self.request,
+            self.request['session']['user_id'],
+            ActionTypes.edit_event,
+            event_id=event_id,
+            subtype='set-booking-nowait',
+            nowait=m.nowait,
+        )
 
 
 class EventUpdate(UpdateView):
@@ -990,6 +1129,7 @@ async def switch_highlight(request):
     await record_action(
         request, request['session']['user_id'], ActionTypes.edit_event, event_id=event_id, subtype='switch-highlight'
     )
+    await clear_index_cache(request.app, request['company_id'])
     return json_response(status='ok')
 
 
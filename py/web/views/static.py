@@ -1,15 +1,17 @@
 import logging
+import mimetypes
 import os
 import re
 from copy import deepcopy
 from pathlib import Path
 
+from aiohttp.hdrs import ACCEPT_ENCODING, CONTENT_ENCODING, CONTENT_TYPE, VARY
 from aiohttp.web import Response
 from aiohttp.web_exceptions import HTTPMovedPermanently, HTTPNotFound
 from aiohttp.web_fileresponse import FileResponse
 
 from shared.settings import Settings
-from web.utils import request_root
+from web.utils import accepted_encodings, request_root
 
 logger = logging.getLogger('nosht.web.static')
 
@@ -71,6 +73,20 @@ def get_csp_headers(settings: Settings):
     return {'Content-Security-Policy': ' '.join(f'{k} {" ".join(v)};' for k, v in csp.items())}
 
 
+def file_response(request, filepath: Path, headers) -> FileResponse:
+    """
+    FileResponse already serves precompressed "<filepath>.gz" files when the client accepts gzip, this adds
+    the same for brotli with "<filepath>.br".
+    """
+    if 'br' in accepted_encodings(request):
+        br_path = filepath.with_name(filepath.name + '.br')
+        if br_path.is_file():
+            content_type = mimetypes.guess_type(str(filepath))[0] or 'application/octet-stream'
+            headers = {**headers, CONTENT_TYPE: content_type, CONTENT_ENCODING: 'br', VARY: ACCEPT_ENCODING}
+            return FileResponse(br_path, headers=headers)
+    return FileResponse(filepath, headers=headers)
+
+
 async def static_handler(request):
     # modified from aiohttp_web_urldispatcher.StaticResource_handle
     request_path = request.match_info['path'].lstrip('/')
@@ -78,7 +94,7 @@ async def static_handler(request):
     directory = request.app['static_dir']
     csp_headers = request.app['csp_headers']
     if request_path == '':
-        return FileResponse(directory / 'index.html', headers=csp_headers)
+        return file_response(request, directory / 'index.html', csp_headers)
     elif request_path == 'sitemap.xml':
         raise HTTPMovedPermanently(location=f'https://{request.host}/api/sitemap.xml')
 
@@ -104,8 +120,8 @@ async def static_handler(request):
         # no csp header here, it's defined in the page as a http-equiv header
         return Response(text=content, content_type='text/html')
     elif is_file:
-        return FileResponse(filepath, headers=csp_headers)
+        return file_response(request, filepath, csp_headers)
     elif request_path.startswith('pvt/'):
-        return FileResponse(directory / 'index.html', headers={**csp_headers, **{'X-Robots-Tag': 'noindex'}})
+        return file_response(request, directory / 'index.html', {**csp_headers, **{'X-Robots-Tag': 'noindex'}})
     else:
-        return FileResponse(directory / 'index.html', headers=csp_headers)
+        return file_response(request, directory / 'index.html', csp_headers)
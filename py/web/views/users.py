@@ -83,8 +83,14 @@ class UserBread(Bread):
 
     async def edit_execute(self, pk, **data):
         await super().edit_execute(pk, **data)
+        self.app['user_company_cache'].pop(pk)
         await self.app['donorfy_actor'].update_user(pk, update_marketing='allow_marketing' in data)
 
+    async def delete_execute(self, pk):
+        await super().delete_execute(pk)
+        # otherwise the deleted user would still resolve to the company until the entry expires
+        self.app['user_company_cache'].pop(pk)
+
 
 class UserSelfBread(Bread):
     class Model(BaseModel):
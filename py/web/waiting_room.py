@@ -0,0 +1,82 @@
+"""
+Optional waiting room for events expected to sell out quickly.
+
+When active, guests join a queue and get a signed token with their position, positions are admitted at "rate" per
+second using a token bucket in redis and ReserveTickets refuses requests without a token which has been admitted.
+The rate is set by SetWaitingRoom, see shared/waiting_room.py.
+"""
+import math
+from time import time
+from typing import NamedTuple, Optional
+
+from shared.waiting_room import waiting_room_key
+
+from .utils import JsonErrors, decrypt_json, encrypt_json
+
+join_lua = """
+if redis.call('hexists', KEYS[1], 'rate') == 0 then
+  return nil
+end
+return redis.call('hincrby', KEYS[1], 'joined', 1)
+"""
+# add "rate" admissions per second since the last call, up to one second's worth more than the number who've
+# joined, returns nil if the waiting room isn't active, otherwise the rate and number admitted
+admit_lua = """
+local v = redis.call('hmget', KEYS[1], 'rate', 'joined', 'admitted', 'ts')
+if not v[1] then
+  return nil
+end
+local rate = tonumber(v[1])
+local now = tonumber(ARGV[1])
+local admitted = tonumber(v[3] or '0')
+local ts = tonumber(v[4] or ARGV[1])
+if not v[4] or now > ts then
+  admitted = math.min(tonumber(v[2] or '0') + rate, admitted + (now - ts) * rate)
+  redis.call('hmset', KEYS[1], 'admitted', tostring(admitted), 'ts', ARGV[1])
+end
+return {v[1], tostring(admitted)}
+"""
+
+
+class QueuePosition(NamedTuple):
+    admitted: bool
+    # number of guests ahead in the queue who haven't been admitted
+    ahead: int
+    # seconds until the guest should check their position again
+    retry_after: float
+
+
+async def join_queue(app, event_id: int, user_id: int) -> Optional[str]:
+    """
+    Join the queue for an event.
+
+    :return: None if the waiting room isn't active, otherwise a token recording the guest's position.
+    """
+    position = await app['redis'].eval(join_lua, keys=[waiting_room_key(event_id)])
+    if position is not None:
+        return encrypt_json(app, {'event_id': event_id, 'user_id': user_id, 'position': position})
+
+
+async def queue_position(app, event_id: int, user_id: int, token: Optional[str]) -> Optional[QueuePosition]:
+    """
+    Find whether a guest with a queue token has been admitted.
+
+    :return: None if the waiting room isn't active.
+    """
+    r = await app['redis'].eval(admit_lua, keys=[waiting_room_key(event_id)], args=[time()])
+    if r is None:
+        return
+    if not token:
+        raise JsonErrors.HTTPTooManyRequests(message='waiting room active, join the queue to book', waiting_room=True)
+
+    data = decrypt_json(app, token.encode(), ttl=app['settings'].waiting_room_token_ttl)
+    if data['event_id'] != event_id or data['user_id'] != user_id:
+        raise JsonErrors.HTTPBadRequest(message='invalid token')
+
+    rate, admitted = float(r[0]), float(r[1])
+    remaining = data['position'] - admitted
+    if remaining <= 0:
+        return QueuePosition(admitted=True, ahead=0, retry_after=0)
+    # poll at least every 30 seconds so guests see their position change
+    retry_after = round(min(max(remaining / rate, 1), 30), 1)
+    return QueuePosition(admitted=False, ahead=math.ceil(remaining) - 1, retry_after=retry_after)